@@ -0,0 +1,80 @@
+# Write-behind aggregation of resource access counts
+
+import threading
+from collections import defaultdict
+from sqlalchemy import Engine, bindparam
+from background import PeriodicTask
+from resource_entity import ResourceEntity
+
+
+class AccessCounter:
+    """Buffers access count increments in memory and persists them in batches.
+
+    Pending increments are flushed every flush_interval seconds, as soon as
+    max_pending distinct ids are buffered, and once more on stop(). Each flush
+    is a single executemany of UPDATE ... SET access_count = access_count + n,
+    so concurrent workers never overwrite each other's increments.
+    A flush_interval of 0 or less writes every increment through immediately."""
+
+    def __init__(
+        self, engine: Engine, flush_interval: float = 5.0, max_pending: int = 1000
+    ):
+        self.engine = engine
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: defaultdict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self._task = PeriodicTask("access-counter-flush", flush_interval, self.flush)
+
+    def start(self) -> None:
+        if self.flush_interval > 0:
+            self._task.start()
+
+    def stop(self) -> None:
+        self._task.stop()
+        self.flush()
+
+    def increment(self, id: str, n: int = 1) -> None:
+        with self._lock:
+            self._pending[id] += n
+            buffered = len(self._pending)
+        if self.flush_interval <= 0:
+            self.flush()
+        elif buffered >= self.max_pending:
+            self._task.wake()
+
+    def pending(self, id: str) -> int:
+        with self._lock:
+            return self._pending.get(id, 0)
+
+    def discard(self, id: str) -> None:
+        with self._lock:
+            self._pending.pop(id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pending.clear()
+
+    def flush(self) -> int:
+        with self._lock:
+            batch, self._pending = self._pending, defaultdict(int)
+        if not batch:
+            return 0
+        table = ResourceEntity.__table__
+        statement = (
+            table.update()
+            .where(table.c.id == bindparam("b_id"))
+            .values(access_count=table.c.access_count + bindparam("b_n"))
+        )
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(
+                    statement, [{"b_id": id, "b_n": n} for id, n in batch.items()]
+                )
+        except Exception:
+            # Put the increments back so the next flush retries them
+            with self._lock:
+                for id, n in batch.items():
+                    self._pending[id] += n
+            raise
+        return len(batch)
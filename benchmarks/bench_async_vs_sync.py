@@ -0,0 +1,131 @@
+"""Requests/sec and latency percentiles for DB_MODE=sync against DB_MODE=async.
+
+Starts the app under uvicorn once per mode against the database configured in
+the environment (point the POSTGRES_* variables at a local Postgres), seeds a
+set of links and snippets, then drives GET /{resource_id} with a fixed number
+of concurrent clients.
+
+The sync figures are those of DB_MODE=sync as it is, a single worker whose
+blocking Session runs every query on the event loop thread: requests wait in
+line behind each query, and its throughput is about one over the query
+latency. It is the baseline of blocking the loop, which is what the async mode
+removes, not of a sync driver run in a threadpool (as FastAPI runs plain def
+endpoints), which would overlap queries up to the threadpool size.
+
+Run from the repository root:
+    python -m benchmarks.bench_async_vs_sync --concurrency 64 --duration 20
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import httpx
+
+
+async def wait_until_ready(client: httpx.AsyncClient, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            await client.get("/docs")
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not start")
+
+
+async def seed(client: httpx.AsyncClient, count: int) -> list[str]:
+    ids = []
+    for i in range(count):
+        if i % 2:
+            body = {"id": "", "content": "https://example.com/", "type": "link"}
+            response = await client.post("/shorten-url", json=body)
+        else:
+            body = {"id": "", "content": f"snippet {i}", "type": "text"}
+            response = await client.post("/create-text", json=body)
+        response.raise_for_status()
+        ids.append(response.json()["id"])
+    return ids
+
+
+async def drive(
+    client: httpx.AsyncClient, ids: list[str], concurrency: int, duration: float
+) -> list[float]:
+    latencies: list[float] = []
+    deadline = time.monotonic() + duration
+
+    async def worker() -> None:
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            response = await client.get(
+                f"/{random.choice(ids)}", follow_redirects=False
+            )
+            latencies.append(time.perf_counter() - start)
+            if response.status_code not in (200, 307):
+                raise RuntimeError(f"Unexpected status {response.status_code}")
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+async def run_mode(mode: str, args: argparse.Namespace) -> dict[str, float]:
+    env = dict(os.environ, DB_MODE=mode)
+    # A single client, it must not be throttled
+    for group in ("SUE", "CAI", "AMY"):
+        env[f"RATE_LIMIT_{group}"] = ""
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "main:app",
+            "--port",
+            str(args.port),
+            "--log-level",
+            "warning",
+        ],
+        env=env,
+    )
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{args.port}", limits=limits
+        ) as client:
+            await wait_until_ready(client)
+            await client.delete("/admin/resources/all")
+            ids = await seed(client, args.resources)
+            latencies = await drive(client, ids, args.concurrency, args.duration)
+    finally:
+        server.terminate()
+        server.wait()
+    percentiles = statistics.quantiles(latencies, n=100)
+    return {
+        "requests_per_second": len(latencies) / args.duration,
+        "p50_ms": percentiles[49] * 1000,
+        "p99_ms": percentiles[98] * 1000,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--resources", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    print(f"{'mode':>6} {'req/s':>10} {'p50 ms':>9} {'p99 ms':>9}")
+    for mode in ("sync", "async"):
+        result = asyncio.run(run_mode(mode, args))
+        print(
+            f"{mode:>6} {result['requests_per_second']:>10.1f} "
+            f"{result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Memory per resource cache entry, measured with tracemalloc.
+
+Fills a database with --rows resources (links and short text snippets, plus
+every --compressed-th snippet large enough to be stored compressed) and
+reports the bytes allocated per entry of a ResourceCache holding them as:
+  record       ResourceRecord from a row, what the cache holds
+  resource     Resource model, from ResourceEntity.to_model()
+  entity       the ResourceEntity itself, loaded with its blob
+Each figure includes the cache's own bookkeeping, the same for every kind;
+"content" is the share of the record figure taken by the content strings.
+
+Run from the repository root:
+    python -m benchmarks.bench_cache_memory --rows 20000
+"""
+
+import argparse
+import asyncio
+import gc
+import os
+import sys
+import tempfile
+import tracemalloc
+
+os.environ.setdefault(
+    "DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+)
+os.environ.setdefault("DB_MODE", "sync")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from cache import ResourceCache, resource_cache
+from database import DatabaseService
+from database_startup import db_session, engine, get_access_counter
+from models import Resource, ResourceRecord, Type
+from resource_entity import ResourceEntity
+from resource_rows import row_record, select_records
+
+
+async def populate(rows: int, compressed: int) -> None:
+    async for session in db_session():
+        service = DatabaseService(session, resource_cache, get_access_counter())
+        await service.delete_all_entries()
+        for start in range(0, rows, 1000):
+            await service.add_entries(
+                [
+                    Resource(
+                        id=f"r{i:07d}",
+                        content=(
+                            f"https://example.com/{i}"
+                            if i % 2
+                            else f"snippet {i} " * (200 if i % compressed == 0 else 8)
+                        ),
+                        type=Type.url if i % 2 else Type.text,
+                        expiration_time=-1,
+                    )
+                    for i in range(start, min(start + 1000, rows))
+                ]
+            )
+
+
+def allocated(load) -> int:
+    """Bytes still allocated after caching the entries load() returns."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    cache = ResourceCache(max_size=1 << 30, ttl=3600)
+    for entry in load():
+        cache.put(entry.id, entry)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    del cache
+    return sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+
+
+def main(args: argparse.Namespace) -> None:
+    asyncio.run(populate(args.rows, args.compressed))
+
+    def records() -> list[ResourceRecord]:
+        with engine.connect() as connection:
+            return [row_record(row) for row in connection.execute(select_records())]
+
+    def resources() -> list[Resource]:
+        with Session(engine) as session:
+            entities = session.scalars(select(ResourceEntity)).unique()
+            return [entity.to_model() for entity in entities]
+
+    session = Session(engine)
+
+    def entities() -> list[ResourceEntity]:
+        # Kept in the open session's identity map, as a cache of them would be
+        return session.scalars(select(ResourceEntity)).unique().all()
+
+    results = {
+        "record": allocated(records),
+        "resource": allocated(resources),
+        "entity": allocated(entities),
+    }
+    session.close()
+    content = sum(sys.getsizeof(record.content) for record in records())
+    print(f"{'kind':10} {'bytes/entry':>12}")
+    for kind, size in results.items():
+        print(f"{kind:10} {size / args.rows:12.0f}")
+    print(f"{'content':10} {content / args.rows:12.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--compressed", type=int, default=10)
+    main(parser.parse_args())
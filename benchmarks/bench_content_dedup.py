@@ -0,0 +1,116 @@
+"""Table size and insert throughput with and without content deduplication.
+
+Builds a duplicate-heavy synthetic corpus (a few large pasted logs and
+boilerplate snippets repeated many times, plus some unique pastes) and inserts
+it into two fresh SQLite databases: once storing content inline in resources,
+as before content_blobs existed, and once through DatabaseService.add_entries,
+which stores each distinct content once. Reports database file size and
+inserts/sec for both.
+
+Run from the repository root:
+    python -m benchmarks.bench_content_dedup --items 20000 --distinct 50 --unique 0.1
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import string
+import tempfile
+import time
+
+os.environ.setdefault(
+    "DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+)
+os.environ.setdefault("DB_MODE", "sync")
+
+import sqlalchemy
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from access_counter import AccessCounter
+from cache import ResourceCache
+from database import DatabaseService
+from migrations import migrate
+from models import Resource, Type
+from resource_entity import ResourceEntity
+
+
+def corpus(items: int, distinct: int, unique: float) -> list[Resource]:
+    alphabet = string.ascii_letters + string.digits + " \n"
+    pastes = [
+        "".join(random.choices(alphabet, k=random.choice([200, 2000, 20000])))
+        for _ in range(distinct)
+    ]
+    resources = []
+    for i in range(items):
+        if random.random() < unique:
+            content = "".join(random.choices(alphabet, k=2000))
+        else:
+            # Skewed: a few pastes account for most of the duplicates
+            content = pastes[min(int(random.expovariate(0.2)), distinct - 1)]
+        resources.append(Resource(id=f"r{i}", content=content, type=Type.text))
+    return resources
+
+
+def fresh_engine(directory: str, name: str) -> sqlalchemy.Engine:
+    engine = sqlalchemy.create_engine(f"sqlite:///{os.path.join(directory, name)}")
+    migrate(engine)
+    return engine
+
+
+def insert_inline(engine: sqlalchemy.Engine, resources: list[Resource], batch: int):
+    for start in range(0, len(resources), batch):
+        with engine.begin() as connection:
+            rows = []
+            for resource in resources[start : start + batch]:
+                row = ResourceEntity.from_model(resource)
+                rows.append(
+                    {
+                        "id": row.id,
+                        "content": resource.content,
+                        "type": row.type,
+                        "access_count": 0,
+                        "created_at": row.created_at,
+                        "content_length": row.content_length,
+                    }
+                )
+            connection.execute(insert(ResourceEntity), rows)
+
+
+def insert_deduplicated(
+    engine: sqlalchemy.Engine, resources: list[Resource], batch: int
+):
+    with Session(engine, expire_on_commit=False) as session:
+        service = DatabaseService(
+            session, ResourceCache(), AccessCounter(engine, flush_interval=0)
+        )
+        for start in range(0, len(resources), batch):
+            asyncio.run(service.add_entries(resources[start : start + batch]))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=20000)
+    parser.add_argument("--distinct", type=int, default=50)
+    parser.add_argument("--unique", type=float, default=0.1)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    resources = corpus(args.items, args.distinct, args.unique)
+    directory = tempfile.mkdtemp()
+    print(f"{'storage':>14} {'size MB':>9} {'seconds':>9} {'inserts/sec':>12}")
+    for label, fn in (("inline", insert_inline), ("deduplicated", insert_deduplicated)):
+        engine = fresh_engine(directory, f"{label}.db")
+        start = time.perf_counter()
+        fn(engine, resources, args.batch_size)
+        elapsed = time.perf_counter() - start
+        engine.dispose()
+        size = os.path.getsize(os.path.join(directory, f"{label}.db")) / 1e6
+        print(
+            f"{label:>14} {size:>9.2f} {elapsed:>9.2f} "
+            f"{len(resources) / elapsed:>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Create latency against table size for each id generator.
+
+Seeds a SQLite database with N resources, then times creating resources with
+each generator: picking an id (plus the uniqueness probe for generators that
+can collide) and inserting the row, both through DatabaseService as the
+create endpoints do. The pool runs with its default size and low water mark,
+so with the default --creates its background refills happen inside the timed
+loop, and a create that finds it empty waits for one.
+
+Run from the repository root:
+    python -m benchmarks.bench_id_generation --sizes 1000 10000 100000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import string
+import tempfile
+import time
+
+os.environ.setdefault(
+    "DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'startup.db')}"
+)
+os.environ.setdefault("DB_MODE", "sync")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import sqlalchemy
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from access_counter import AccessCounter
+from cache import ResourceCache
+from database import DatabaseService
+from id_generator import (
+    IdGenerator,
+    PooledIdGenerator,
+    RandomIdGenerator,
+    SnowflakeIdGenerator,
+)
+from models import Resource, Type
+from resource_entity import Base, ResourceEntity
+
+
+def seed(engine: sqlalchemy.Engine, size: int) -> None:
+    alphabet = string.ascii_letters + string.digits
+    ids = {
+        "".join(random.choices(alphabet, k=random.randint(5, 9))) for _ in range(size)
+    }
+    with engine.begin() as connection:
+        connection.execute(
+            insert(ResourceEntity),
+            [{"id": id, "content": "seed", "type": "text"} for id in ids],
+        )
+
+
+async def time_creates(
+    engine: sqlalchemy.Engine, generator: IdGenerator, creates: int
+) -> list[float]:
+    timings = []
+    with Session(engine, expire_on_commit=False) as session:
+        service = DatabaseService(
+            session, ResourceCache(), AccessCounter(engine, flush_interval=0)
+        )
+        for _ in range(creates):
+            start = time.perf_counter()
+            generated_id = await generator.next_id_async()
+            while not generator.unique and await service.id_taken(generated_id):
+                generated_id = await generator.next_id_async()
+            await service.add_entry(
+                Resource(id=generated_id, content="https://example.com", type=Type.url)
+            )
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000]
+    )
+    parser.add_argument("--creates", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'table size':>10} {'generator':>10} {'mean ms':>9} {'p99 ms':>9}")
+    for size in args.sizes:
+        for name in ("random", "snowflake", "pool"):
+            with tempfile.TemporaryDirectory() as directory:
+                engine = sqlalchemy.create_engine(
+                    f"sqlite:///{os.path.join(directory, 'bench.db')}"
+                )
+                Base.metadata.create_all(engine)
+                seed(engine, size)
+                generator = {
+                    "random": lambda: RandomIdGenerator(),
+                    "snowflake": lambda: SnowflakeIdGenerator(worker_id=1),
+                    "pool": lambda: PooledIdGenerator(engine),
+                }[name]()
+                generator.start()
+                timings = asyncio.run(time_creates(engine, generator, args.creates))
+                generator.stop()
+                engine.dispose()
+            p99 = statistics.quantiles(timings, n=100)[98]
+            print(
+                f"{size:>10} {name:>10} {statistics.mean(timings) * 1000:>9.3f} {p99 * 1000:>9.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""CPU cost of the admin listing, GET /admin/resources.
+
+Fills a database with --rows resources (links and short text snippets) and
+reports the mean time per request, and per row, of the listing as one JSON
+array, as pages of --page-size rows, and streamed as NDJSON and CSV. With
+--profile, each format is also run under cProfile and the functions with the
+most own time are printed, and the stats are written to <profile>.<format>
+for pstats or snakeviz.
+
+Run from the repository root:
+    python -m benchmarks.bench_listing --rows 20000 --profile /tmp/listing
+"""
+
+import argparse
+import asyncio
+import cProfile
+import os
+import pstats
+import tempfile
+import time
+
+os.environ.setdefault(
+    "DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+)
+os.environ.setdefault("DB_MODE", "sync")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+for group in ("SUE", "CAI", "AMY"):
+    os.environ[f"RATE_LIMIT_{group}"] = ""
+
+import httpx
+from main import app
+from database_startup import db_session, get_access_counter
+from cache import resource_cache
+from database import DatabaseService
+from models import Resource, Type
+
+
+async def populate(rows: int) -> None:
+    async for session in db_session():
+        service = DatabaseService(session, resource_cache, get_access_counter())
+        await service.delete_all_entries()
+        for start in range(0, rows, 1000):
+            await service.add_entries(
+                [
+                    Resource(
+                        id=f"r{i:07d}",
+                        content=(
+                            f"https://example.com/{i}" if i % 2 else f"snippet {i} " * 8
+                        ),
+                        type=Type.url if i % 2 else Type.text,
+                        expiration_time=-1,
+                    )
+                    for i in range(start, min(start + 1000, rows))
+                ]
+            )
+
+
+async def list_all(client: httpx.AsyncClient, format: str, page_size: int) -> int:
+    if format != "pages":
+        response = await client.get("/admin/resources", params={"format": format})
+        response.raise_for_status()
+        return len(response.content)
+    size, after = 0, None
+    while True:
+        params = {"limit": page_size}
+        if after is not None:
+            params["after"] = after
+        response = await client.get("/admin/resources", params=params)
+        response.raise_for_status()
+        size += len(response.content)
+        after = response.headers.get("X-Next-Cursor")
+        if after is None:
+            return size
+
+
+async def main(args: argparse.Namespace) -> None:
+    await populate(args.rows)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        print(f"{'format':8} {'ms/request':>12} {'us/row':>8} {'bytes':>10}")
+        for format in ("json", "pages", "ndjson", "csv"):
+            # Warm up
+            await list_all(client, format, args.page_size)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                size = await list_all(client, format, args.page_size)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            print(
+                f"{format:8} {elapsed * 1e3:12.1f} "
+                f"{elapsed / args.rows * 1e6:8.2f} {size:10}"
+            )
+            if args.profile:
+                profiler = cProfile.Profile()
+                profiler.enable()
+                await list_all(client, format, args.page_size)
+                profiler.disable()
+                profiler.dump_stats(f"{args.profile}.{format}")
+                stats = pstats.Stats(profiler)
+                stats.sort_stats("tottime").print_stats(args.top)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--profile", help="Path prefix of the cProfile stats")
+    parser.add_argument("--top", type=int, default=12)
+    asyncio.run(main(parser.parse_args()))
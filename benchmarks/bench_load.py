@@ -0,0 +1,461 @@
+"""Load test: throughput, latency percentiles and queries per request by mix.
+
+Seeds --resources resources (ids k0, k1, ...; 70% text snippets of 50-2000
+characters, 30% links) into a SQLite file, the database in DATABASE_URL, or an
+ephemeral local Postgres (--postgres, needs initdb and pg_ctl on PATH). A
+database already holding the seeded ids is reused, so large seeds (10M) only
+have to be paid once per file.
+
+Then drives each --mix for --duration seconds with --concurrency clients:
+  read    GET /{resource_id}, ids drawn from a Zipf distribution (--zipf)
+  create  POST /create-text and /shorten-url
+  update  PATCH /admin/resources/{resource_id}, Zipf ids
+  admin   GET /admin/resources pages by random id prefix
+  mixed   90% read, 5% create, 4% update, 1% admin
+through an in-process ASGI client, or with --url over HTTP from --processes
+load generator processes against a server started separately against the
+same database, e.g.
+    DATABASE_URL=sqlite:///load.db uvicorn main:app --workers 4
+
+Queries per request are read from GET /admin/metrics/prometheus before and
+after each mix (with several server workers, from whichever worker answers
+the scrape).
+The JSON report (--output, default stdout) has per mix and per operation:
+requests, errors, throughput, p50/p95/p99 in milliseconds and queries per
+request. --compare prints the change against an earlier report.
+
+Run from the repository root:
+    python -m benchmarks.bench_load --resources 100000 --database load.db \\
+        --mix read mixed --duration 10 --output report.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+MIXES = {
+    "read": {"read": 1.0},
+    "create": {"create": 1.0},
+    "update": {"update": 1.0},
+    "admin": {"admin": 1.0},
+    "mixed": {"read": 0.9, "create": 0.05, "update": 0.04, "admin": 0.01},
+}
+SEED_BATCH_SIZE = 10000
+_STATEMENTS = re.compile(
+    r'^http_request_db_statements_(sum|count)\{route="([^"]*)",method="[^"]*"\} (\S+)$',
+    re.MULTILINE,
+)
+
+
+def _helper1(x: float) -> float:
+    # log1p(x) / x, accurate near 0
+    if abs(x) > 1e-8:
+        return math.log1p(x) / x
+    return 1 - x * (0.5 - x * (1 / 3 - 0.25 * x))
+
+
+def _helper2(x: float) -> float:
+    # expm1(x) / x, accurate near 0
+    if abs(x) > 1e-8:
+        return math.expm1(x) / x
+    return 1 + x * 0.5 * (1 + x / 3 * (1 + 0.25 * x))
+
+
+class ZipfSampler:
+    """Ranks 1..n with P(k) proportional to 1 / k**s, by rejection-inversion
+    (Hormann and Derflinger): O(1) time and memory for any n, so 10M keys need
+    no table of probabilities."""
+
+    def __init__(self, n: int, s: float, rng: random.Random):
+        self.n = n
+        self.s = s
+        self.rng = rng
+        self._h_x1 = self._h_integral(1.5) - 1
+        self._h_n = self._h_integral(n + 0.5)
+        self._threshold = 2 - self._h_integral_inverse(
+            self._h_integral(2.5) - self._h(2)
+        )
+
+    def sample(self) -> int:
+        while True:
+            u = self._h_n + self.rng.random() * (self._h_x1 - self._h_n)
+            x = self._h_integral_inverse(u)
+            k = min(max(int(x + 0.5), 1), self.n)
+            if k - x <= self._threshold or u >= self._h_integral(k + 0.5) - self._h(k):
+                return k
+
+    def _h(self, x: float) -> float:
+        return math.exp(-self.s * math.log(x))
+
+    def _h_integral(self, x: float) -> float:
+        log_x = math.log(x)
+        return _helper2((1 - self.s) * log_x) * log_x
+
+    def _h_integral_inverse(self, x: float) -> float:
+        t = max(x * (1 - self.s), -1)
+        return math.exp(_helper1(t) * x)
+
+
+def key(index: int) -> str:
+    return f"k{index}"
+
+
+class Keys:
+    """Zipf-distributed seeded ids. Ranks are spread over the ids by a fixed
+    permutation, so the hottest ids are not also the first inserted."""
+
+    def __init__(self, n: int, s: float, seed: int):
+        self.n = n
+        self.sampler = ZipfSampler(n, s, random.Random(seed))
+        self.stride = next(
+            p for p in range(n // 2 + 1, 2 * n + 2) if math.gcd(p, n) == 1
+        )
+
+    def next(self) -> str:
+        return key((self.sampler.sample() - 1) * self.stride % self.n)
+
+
+def text_content(rng: random.Random) -> str:
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "log", "error", "value"]
+    size = rng.randint(50, 2000)
+    return " ".join(rng.choices(words, k=size // 6))[:size]
+
+
+def seed(resources: int, rng: random.Random) -> float:
+    """Inserts the seeded resources unless they are already there. Returns the
+    seconds it took."""
+    from sqlalchemy.orm import Session
+    from access_counter import AccessCounter
+    from cache import ResourceCache
+    from database import DatabaseService
+    from database_startup import engine
+    from models import Resource, Type
+
+    start = time.perf_counter()
+    with Session(engine, expire_on_commit=False) as session:
+        service = DatabaseService(
+            session, ResourceCache(max_size=0), AccessCounter(engine, 0)
+        )
+        if asyncio.run(service.id_taken(key(resources - 1))):
+            return 0.0
+        now = datetime.datetime.now()
+        for batch in range(0, resources, SEED_BATCH_SIZE):
+            rows = []
+            for i in range(batch, min(batch + SEED_BATCH_SIZE, resources)):
+                if rng.random() < 0.7:
+                    content, type = text_content(rng), Type.text
+                else:
+                    content, type = f"https://example.com/{i}", Type.url
+                rows.append(
+                    Resource(id=key(i), content=content, type=type, created_at=now)
+                )
+            asyncio.run(service.add_entries(rows))
+            print(f"seeded {batch + len(rows)}/{resources}", file=sys.stderr)
+    return time.perf_counter() - start
+
+
+class Operations:
+    """The requests of each operation, for one client."""
+
+    def __init__(self, keys: Keys, rng: random.Random):
+        self.keys = keys
+        self.rng = rng
+
+    async def read(self, client) -> int:
+        response = await client.get(f"/{self.keys.next()}", follow_redirects=False)
+        return response.status_code
+
+    async def create(self, client) -> int:
+        if self.rng.random() < 0.7:
+            body = {"id": "", "content": text_content(self.rng), "type": "text"}
+            response = await client.post("/create-text", json=body)
+        else:
+            body = {"id": "", "content": "https://example.com/new", "type": "link"}
+            response = await client.post("/shorten-url", json=body)
+        return response.status_code
+
+    async def update(self, client) -> int:
+        response = await client.patch(
+            f"/admin/resources/{self.keys.next()}", json=text_content(self.rng)
+        )
+        return response.status_code
+
+    async def admin(self, client) -> int:
+        prefix = key(self.rng.randrange(self.keys.n))[:3]
+        response = await client.get(
+            "/admin/resources", params={"id_prefix": prefix, "limit": 100}
+        )
+        return response.status_code
+
+
+async def drive(client, mix: dict[str, float], args, seed: int) -> dict:
+    """Runs mix for args.duration seconds after args.warmup seconds. Returns the
+    latencies and error counts per operation."""
+    rng = random.Random(seed)
+    keys = Keys(args.resources, args.zipf, seed)
+    names, weights = list(mix), list(mix.values())
+    samples: dict[str, list[float]] = {name: [] for name in names}
+    errors: dict[str, int] = {name: 0 for name in names}
+    start = time.monotonic()
+    measure_from = start + args.warmup
+    deadline = measure_from + args.duration
+
+    async def worker(worker_seed: int) -> None:
+        operations = Operations(keys, random.Random(worker_seed))
+        while (now := time.monotonic()) < deadline:
+            name = rng.choices(names, weights)[0]
+            began = time.perf_counter()
+            status = await getattr(operations, name)(client)
+            elapsed = time.perf_counter() - began
+            if now >= measure_from:
+                samples[name].append(elapsed)
+                if status >= 400:
+                    errors[name] += 1
+
+    await asyncio.gather(*(worker(seed * 1000 + i) for i in range(args.concurrency)))
+    return {"samples": samples, "errors": errors}
+
+
+async def scrape_statements(client) -> dict[str, list[float]]:
+    """Route -> [statements, requests] from GET /admin/metrics/prometheus."""
+    totals: dict[str, list[float]] = {}
+    text = (await client.get("/admin/metrics/prometheus")).text
+    for kind, route, value in _STATEMENTS.findall(text):
+        if route != "/admin/metrics/prometheus":
+            totals.setdefault(route, [0.0, 0.0])[kind == "count"] += float(value)
+    return totals
+
+
+def queries_per_request(before: dict, after: dict) -> float | None:
+    statements = sum(after[r][0] - before.get(r, [0, 0])[0] for r in after)
+    requests = sum(after[r][1] - before.get(r, [0, 0])[1] for r in after)
+    return statements / requests if requests else None
+
+
+async def run_asgi(mix: dict[str, float], args) -> tuple[dict, float | None]:
+    import httpx
+    from main import app
+
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+            before = await scrape_statements(client)
+            result = await drive(client, mix, args, args.seed)
+            after = await scrape_statements(client)
+    return result, queries_per_request(before, after)
+
+
+async def _drive_http(mix: dict[str, float], args, seed: int) -> dict:
+    import httpx
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(
+        base_url=args.url, limits=limits, timeout=30
+    ) as client:
+        return await drive(client, mix, args, seed)
+
+
+def _http_process(job: tuple) -> dict:
+    mix, args, seed = job
+    return asyncio.run(_drive_http(mix, args, seed))
+
+
+def run_http(mix: dict[str, float], args) -> tuple[dict, float | None]:
+    import httpx
+
+    async def scrape() -> dict:
+        async with httpx.AsyncClient(base_url=args.url) as client:
+            return await scrape_statements(client)
+
+    before = asyncio.run(scrape())
+    jobs = [(mix, args, args.seed + i) for i in range(args.processes)]
+    with multiprocessing.Pool(args.processes) as pool:
+        parts = pool.map(_http_process, jobs)
+    after = asyncio.run(scrape())
+    result = {"samples": {name: [] for name in mix}, "errors": dict.fromkeys(mix, 0)}
+    for part in parts:
+        for name in mix:
+            result["samples"][name].extend(part["samples"][name])
+            result["errors"][name] += part["errors"][name]
+    return result, queries_per_request(before, after)
+
+
+def summarize(latencies: list[float], errors: int, duration: float) -> dict:
+    summary = {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / duration,
+    }
+    if len(latencies) >= 2:
+        percentiles = statistics.quantiles(latencies, n=100)
+        for p in (50, 95, 99):
+            summary[f"p{p}_ms"] = percentiles[p - 1] * 1000
+    return summary
+
+
+def report_mix(result: dict, queries: float | None, duration: float) -> dict:
+    samples, errors = result["samples"], result["errors"]
+    every = [latency for latencies in samples.values() for latency in latencies]
+    report = summarize(every, sum(errors.values()), duration)
+    report["queries_per_request"] = queries
+    report["operations"] = {
+        name: summarize(samples[name], errors[name], duration) for name in samples
+    }
+    return report
+
+
+@contextlib.contextmanager
+def ephemeral_postgres(port: int):
+    """A throwaway Postgres cluster on port, removed afterwards."""
+    initdb, pg_ctl = shutil.which("initdb"), shutil.which("pg_ctl")
+    if initdb is None or pg_ctl is None:
+        raise SystemExit("--postgres needs initdb and pg_ctl on PATH")
+    directory = tempfile.mkdtemp()
+    data = os.path.join(directory, "data")
+    subprocess.run(
+        [initdb, "-D", data, "-U", "bench", "--auth=trust"],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    subprocess.run(
+        [
+            pg_ctl,
+            "-D",
+            data,
+            "-o",
+            f"-p {port} -k {directory} -h 127.0.0.1",
+            "-l",
+            os.path.join(directory, "log"),
+            "-w",
+            "start",
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        yield f"postgresql+psycopg://bench@127.0.0.1:{port}/postgres"
+    finally:
+        subprocess.run(
+            [pg_ctl, "-D", data, "-m", "fast", "-w", "stop"], stdout=subprocess.DEVNULL
+        )
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report: dict, baseline_path: str) -> None:
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    print(f"{'mix':>8} {'metric':>20} {'baseline':>10} {'now':>10} {'change':>8}")
+    for mix, now in report["mixes"].items():
+        before = baseline.get("mixes", {}).get(mix)
+        if before is None:
+            continue
+        for metric in ("throughput", "p50_ms", "p99_ms", "queries_per_request"):
+            if before.get(metric) and now.get(metric) is not None:
+                change = (now[metric] - before[metric]) / before[metric] * 100
+                print(
+                    f"{mix:>8} {metric:>20} {before[metric]:>10.2f} "
+                    f"{now[metric]:>10.2f} {change:>+7.1f}%"
+                )
+
+
+def run(args, database_url: str) -> dict:
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.setdefault(
+        "DB_MODE", "sync" if database_url.startswith("sqlite") else "async"
+    )
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # The load generator is a single client, it must not be throttled
+    for group in ("SUE", "CAI", "AMY"):
+        os.environ.setdefault(f"RATE_LIMIT_{group}", "")
+
+    seed_seconds = seed(args.resources, random.Random(args.seed))
+    report = {
+        "commit": git_commit(),
+        "database": database_url.split(":", 1)[0],
+        "db_mode": os.environ["DB_MODE"],
+        "driver": "http" if args.url else "asgi",
+        "resources": args.resources,
+        "seed_seconds": seed_seconds,
+        "zipf": args.zipf,
+        "concurrency": args.concurrency * (args.processes if args.url else 1),
+        "duration": args.duration,
+        "mixes": {},
+    }
+    for name in args.mix:
+        if args.url:
+            result, queries = run_http(MIXES[name], args)
+        else:
+            result, queries = asyncio.run(run_asgi(MIXES[name], args))
+        report["mixes"][name] = report_mix(result, queries, args.duration)
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--resources", type=int, default=10000)
+    parser.add_argument("--database", help="SQLite file, default a temporary one")
+    parser.add_argument("--postgres", action="store_true")
+    parser.add_argument("--postgres-port", type=int, default=55432)
+    parser.add_argument("--mix", nargs="+", choices=MIXES, default=["read", "mixed"])
+    parser.add_argument("--zipf", type=float, default=1.1)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--url", help="Drive a running server over HTTP instead")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--compare", help="Earlier JSON report to compare against")
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        if args.postgres:
+            database_url = stack.enter_context(ephemeral_postgres(args.postgres_port))
+        elif args.database:
+            database_url = f"sqlite:///{os.path.abspath(args.database)}"
+        else:
+            database_url = os.environ.get(
+                "DATABASE_URL",
+                f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'load.db')}",
+            )
+        report = run(args, database_url)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
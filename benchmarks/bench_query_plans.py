@@ -0,0 +1,109 @@
+"""Query plans and timings for the hot resources queries before and after the
+index migration.
+
+Seeds a database at schema version 1 (no secondary indexes), explains and
+times each query, then migrates to the latest version and repeats.
+
+Run from the repository root:
+    python -m benchmarks.bench_query_plans --rows 200000
+    python -m benchmarks.bench_query_plans --url postgresql+psycopg://user:pw@localhost/bench
+"""
+
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+import sqlalchemy
+from sqlalchemy import text
+from migrations import HEAD, migrate
+
+QUERIES = {
+    "vanity_url lookup": (
+        "SELECT id FROM resources WHERE vanity_url = :vanity_url",
+        {"vanity_url": "vanity-4242"},
+    ),
+    "type + access_count range": (
+        "SELECT id FROM resources WHERE type = :type AND access_count >= :count",
+        {"type": "link", "count": 990},
+    ),
+    "expired rows": (
+        "SELECT id FROM resources WHERE expires_at < :now LIMIT 100",
+        {"now": datetime.datetime(2020, 1, 2)},
+    ),
+}
+
+
+def seed(engine: sqlalchemy.Engine, rows: int) -> None:
+    base = datetime.datetime(2020, 1, 1)
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "INSERT INTO resources (id, content, vanity_url, type, expiration_time, access_count) "
+                "VALUES (:id, 'bench', :vanity_url, :type, :expiration_time, :access_count)"
+            ),
+            [
+                {
+                    "id": f"id-{i}",
+                    "vanity_url": f"vanity-{i}" if i % 10 == 0 else None,
+                    "type": random.choice(("text", "link")),
+                    "expiration_time": str(base + datetime.timedelta(minutes=i)),
+                    "access_count": random.randint(0, 1000),
+                }
+                for i in range(rows)
+            ],
+        )
+
+
+def explain(connection: sqlalchemy.Connection, sql: str, params: dict) -> list[str]:
+    prefix = (
+        "EXPLAIN QUERY PLAN " if connection.dialect.name == "sqlite" else "EXPLAIN "
+    )
+    return [
+        " ".join(str(column) for column in row)
+        for row in connection.execute(text(prefix + sql), params)
+    ]
+
+
+def report(engine: sqlalchemy.Engine, label: str, repeat: int) -> None:
+    print(f"=== {label}")
+    with engine.connect() as connection:
+        for name, (sql, params) in QUERIES.items():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                connection.execute(text(sql), params).all()
+            elapsed = (time.perf_counter() - start) / repeat
+            print(f"--- {name}: {elapsed * 1000:.3f} ms")
+            for line in explain(connection, sql, params):
+                print(f"    {line}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument(
+        "--url",
+        help="Empty database to run against, defaults to a temporary SQLite file",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        url = args.url or f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        engine = sqlalchemy.create_engine(url)
+        migrate(engine, target=1)
+        with engine.begin() as connection:
+            # The expires_at query needs the column to exist before the migration adds it
+            connection.execute(
+                text("ALTER TABLE resources ADD COLUMN expires_at TIMESTAMP")
+            )
+        seed(engine, args.rows)
+        report(engine, "schema version 1", args.repeat)
+        migrate(engine)
+        report(engine, f"schema version {HEAD}", args.repeat)
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Overhead of the rate limiter's admission decision per request.
+
+Reports the mean time per decision, in microseconds, for:
+  bucket       MemoryBackend.take_now alone, for clients drawn from --clients
+               distinct keys (more keys than --max-keys exercise eviction)
+  check        RateLimiter.check for GET /{resource_id}: route group lookup,
+               client key and bucket
+  unlimited    RateLimiter.check for a route whose group has no limit
+and the requests/sec of GET /{resource_id} (a 404, so no database row is read)
+through the ASGI app with no limits configured and with a limit that admits
+every request.
+
+Run from the repository root:
+    python -m benchmarks.bench_rate_limit --decisions 200000 --clients 1000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault(
+    "DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+)
+os.environ.setdefault("DB_MODE", "sync")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+for group in ("SUE", "CAI", "AMY"):
+    os.environ[f"RATE_LIMIT_{group}"] = ""
+
+import httpx
+from main import app
+from rate_limit import Limit, MemoryBackend, RateLimiter, rate_limiter
+
+
+def scope(path: str, client: str) -> dict:
+    return {
+        "type": "http",
+        "app": app,
+        "method": "GET",
+        "path": path,
+        "headers": [],
+        "client": (client, 1234),
+    }
+
+
+def per_decision(fn, n: int) -> float:
+    start = time.perf_counter()
+    fn(n)
+    return (time.perf_counter() - start) / n * 1e6
+
+
+async def requests_per_second(asgi_app, n: int) -> float:
+    transport = httpx.ASGITransport(app=asgi_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        start = time.perf_counter()
+        for _ in range(n):
+            await client.get("/missing")
+        return n / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--decisions", type=int, default=200000)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--max-keys", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    # Generous enough that every decision admits, as for most real traffic
+    limit = Limit(rate=1e9, burst=10**9)
+    clients = [f"10.0.{i // 256}.{i % 256}" for i in range(args.clients)]
+    keys = [f"cai:{client}" for client in clients]
+
+    backend = MemoryBackend(args.max_keys)
+
+    def bucket(n: int) -> None:
+        for i in range(n):
+            backend.take_now(keys[i % len(keys)], limit, i)
+
+    limiter = RateLimiter({"cai": limit, "amy": None}, MemoryBackend(args.max_keys))
+    scopes = [scope(f"/{random.getrandbits(32):x}", client) for client in clients]
+    admin = scope("/admin/cache", clients[0])
+
+    def check(n: int) -> None:
+        async def run():
+            for i in range(n):
+                await limiter.check(scopes[i % len(scopes)])
+
+        asyncio.run(run())
+
+    def unlimited(n: int) -> None:
+        async def run():
+            for _ in range(n):
+                await limiter.check(admin)
+
+        asyncio.run(run())
+
+    print(f"{'decision':>10} {'us/decision':>12}")
+    for label, fn in (("bucket", bucket), ("check", check), ("unlimited", unlimited)):
+        print(f"{label:>10} {per_decision(fn, args.decisions):>12.2f}")
+
+    print(f"\n{'limits':>10} {'requests/sec':>12}")
+    for label, cai in (("none", None), ("cai", limit)):
+        rate_limiter.limits["cai"] = cai
+        rps = asyncio.run(requests_per_second(app, args.requests))
+        print(f"{label:>10} {rps:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Stored size and read latency of snippet content by paste size and codec.
+
+For log-like pastes of each size, reports the bytes a blob stores with each
+codec and the time to turn the stored blob into a response body:
+  decoded      decompress, parse the stored JSON and render it again, as for a
+               client that does not accept the codec's Content-Encoding
+  passthrough  send the stored bytes as they are (gzip and zlib/deflate only)
+"identity" is content stored as text and rendered with json.dumps.
+
+Run from the repository root:
+    python -m benchmarks.bench_storage_codecs --sizes 1000 10000 100000 1000000
+"""
+
+import argparse
+import random
+import statistics
+import time
+from storage_codecs import CODECS, StorageCodec, decode_payload, json_payload
+
+
+def log_paste(size: int) -> str:
+    levels = ["INFO", "DEBUG", "WARN", "ERROR"]
+    lines = []
+    length = 0
+    while length < size:
+        line = (
+            f"2025-06-01T12:{random.randint(0, 59):02}:{random.randint(0, 59):02} "
+            f"{random.choice(levels)} worker-{random.randint(1, 8)} "
+            f"request {random.getrandbits(32):08x} took {random.randint(1, 999)}ms"
+        )
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)[:size]
+
+
+def median_seconds(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000]
+    )
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(
+        f"{'size':>9} {'codec':>9} {'stored':>10} {'ratio':>7} "
+        f"{'decoded ms':>11} {'passthrough':>12}"
+    )
+    for size in args.sizes:
+        content = log_paste(size)
+        identity = median_seconds(lambda: json_payload(content), args.repeat)
+        print(
+            f"{size:>9} {'identity':>9} {len(content.encode()):>10} {1.0:>7.2f} "
+            f"{identity * 1000:>11.3f} {'-':>12}"
+        )
+        for name, codec in CODECS.items():
+            _, data = StorageCodec(name, threshold=0).encode(content)
+            if data is None:
+                continue
+            decoded = median_seconds(
+                lambda: json_payload(decode_payload(name, data)), args.repeat
+            )
+            passthrough = codec.http_encoding or "-"
+            print(
+                f"{size:>9} {name:>9} {len(data):>10} "
+                f"{len(content.encode()) / len(data):>7.2f} "
+                f"{decoded * 1000:>11.3f} {passthrough:>12}"
+            )
+
+
+if __name__ == "__main__":
+    main()
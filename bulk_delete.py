@@ -0,0 +1,144 @@
+# Deleting resources in bounded batches, in the background for admin purges
+
+import datetime
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable
+from sqlalchemy import ColumnElement, Connection, Engine, delete, select
+import content_store
+from query_builder import InvalidFilterError, ResourceQuery
+from resource_entity import ResourceEntity
+
+logger = logging.getLogger(__name__)
+
+
+def delete_batch(
+    connection: Connection,
+    where: list[ColumnElement[bool]],
+    batch_size: int,
+    order_by=None,
+    skip_locked: bool = False,
+) -> list[str]:
+    """Deletes up to batch_size resources matching where and returns their ids.
+
+    The content blobs of the deleted resources are released in the same
+    transaction, so every way of deleting keeps the reference counts right.
+
+    Postgres has no DELETE ... LIMIT, so the batch is picked by a subquery.
+    Rows locked by another transaction are waited for, or with skip_locked
+    left out of the batch, so a short batch does not mean none are left."""
+    table = ResourceEntity.__table__
+    batch = (
+        select(table.c.id)
+        .where(*where)
+        .order_by(order_by if order_by is not None else table.c.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=skip_locked)
+    )
+    deleted = connection.execute(
+        delete(table)
+        .where(table.c.id.in_(batch.scalar_subquery()))
+        .returning(table.c.id, table.c.content_hash)
+    ).all()
+    content_store.release(connection, [row.content_hash for row in deleted])
+    return [row.id for row in deleted]
+
+
+class DeleteJob:
+    """Progress of one delete-by-filter run."""
+
+    def __init__(self, query: ResourceQuery):
+        self.id = uuid.uuid4().hex
+        self.query = query
+        self.status = "running"
+        self.deleted = 0
+        self.batches = 0
+        self.started_at = datetime.datetime.now()
+        self.finished_at: datetime.datetime | None = None
+        self.error: str | None = None
+
+    def stats(self) -> dict[str, int | str | None]:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "deleted": self.deleted,
+            "batches": self.batches,
+            "started_at": self.started_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "error": self.error,
+        }
+
+
+class BulkDeleter:
+    """Runs delete-by-filter jobs on background threads, one batch per transaction.
+
+    Each batch holds its row locks only briefly and pause seconds pass between
+    batches, so a large purge never stalls redirect traffic. on_deleted is
+    called with the ids of every batch. The last max_jobs jobs are kept for
+    progress reporting."""
+
+    def __init__(
+        self,
+        engine: Engine,
+        batch_size: int = 500,
+        pause: float = 0.0,
+        on_deleted: Callable[[list[str]], None] = lambda ids: None,
+        max_jobs: int = 100,
+    ):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.pause = pause
+        self.on_deleted = on_deleted
+        self.max_jobs = max_jobs
+        self._jobs: OrderedDict[str, DeleteJob] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(
+        self, query: ResourceQuery, now: datetime.datetime | None = None
+    ) -> DeleteJob:
+        """Starts deleting every resource matching query and returns the job."""
+        where = query.where(now)
+        # Deleting everything has its own endpoint; an empty filter is a mistake
+        if not where:
+            raise InvalidFilterError("At least one filter is required")
+        job = DeleteJob(query)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        threading.Thread(
+            target=self.run,
+            args=(job, where),
+            name=f"bulk-delete-{job.id}",
+            daemon=True,
+        ).start()
+        return job
+
+    def get(self, job_id: str) -> DeleteJob | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def run(self, job: DeleteJob, where: list[ColumnElement[bool]]) -> None:
+        try:
+            while True:
+                with self.engine.begin() as connection:
+                    ids = delete_batch(connection, where, self.batch_size)
+                if ids:
+                    self.on_deleted(ids)
+                job.deleted += len(ids)
+                job.batches += 1
+                if not ids:
+                    break
+                if self.pause:
+                    time.sleep(self.pause)
+            job.status = "done"
+            logger.info("Bulk delete %s removed %s resources", job.id, job.deleted)
+        except Exception as error:
+            job.status = "failed"
+            job.error = str(error)
+            logger.exception("Bulk delete %s failed", job.id)
+        finally:
+            job.finished_at = datetime.datetime.now()
@@ -0,0 +1,94 @@
+# In-process read-through cache for resolved resources
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+from env import getenv
+from models import ResourceRecord
+
+
+class ResourceCache:
+    """Bounded LRU cache with a per-entry TTL, keyed by resource id.
+
+    Entries are evicted least-recently-used first once max_size is reached, and
+    expire ttl seconds after they were stored so other workers' writes are
+    eventually picked up."""
+
+    def __init__(
+        self,
+        max_size: int = 10_000,
+        ttl: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries: OrderedDict[str, tuple[float, ResourceRecord]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._listeners: list[Callable[[str | None], None]] = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, id: str) -> ResourceRecord | None:
+        with self._lock:
+            entry = self._entries.get(id)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, resource = entry
+            if expires_at <= self._clock():
+                del self._entries[id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(id)
+            self.hits += 1
+            return resource
+
+    def put(self, id: str, resource: ResourceRecord) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[id] = (self._clock() + self.ttl, resource)
+            self._entries.move_to_end(id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, id: str) -> None:
+        with self._lock:
+            self._entries.pop(id, None)
+        for listener in self._listeners:
+            listener(id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+        for listener in self._listeners:
+            listener(None)
+
+    def on_invalidate(self, listener: Callable[[str | None], None]) -> None:
+        """Calls listener with every invalidated id, and with None on clear(),
+        for caches derived from resources (see hot_keys)."""
+        self._listeners.append(listener)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+resource_cache = ResourceCache(
+    max_size=int(getenv("RESOURCE_CACHE_SIZE", "10000")),
+    ttl=float(getenv("RESOURCE_CACHE_TTL", "60")),
+)
+
+
+def get_resource_cache() -> ResourceCache:
+    return resource_cache
@@ -0,0 +1,14 @@
+# Test configuration: run the app against a throwaway SQLite database
+
+import os
+import tempfile
+
+os.environ.setdefault(
+    "DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}"
+)
+os.environ.setdefault("DB_MODE", "sync")
+# Write access counts through immediately so tests can read them back
+os.environ.setdefault("ACCESS_COUNT_FLUSH_INTERVAL", "0")
+# Tests send bursts from one client; rate limiting is tested on its own
+for group in ("SUE", "CAI", "AMY"):
+    os.environ.setdefault(f"RATE_LIMIT_{group}", "")
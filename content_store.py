@@ -0,0 +1,219 @@
+# Content-addressed storage of text snippet content
+#
+# Each distinct content is stored once in content_blobs under its BLAKE2b hash,
+# with the number of resources pointing at it. acquire() and release() keep
+# that count in the same transaction as the resource rows they add or delete,
+# and a blob is deleted as soon as nothing refers to it (its file, if it has
+# one, is swept later, see file_store). Compressing content and writing its
+# file happen in blob_rows(), which the request path runs in the threadpool
+# before the transaction; only acquire_rows() runs inside it.
+#
+# UPLOAD_MAX_BYTES     largest body POST /create-text/raw accepts (default
+#                      67108864, 64 MiB)
+# UPLOAD_SPOOL_MEMORY  bytes of an upload kept in memory before it is spooled
+#                      to a temporary file, when there is no file store
+#                      (default 1048576)
+#
+# Uploads go through ContentSpool: the body is hashed, decoded and written out
+# as its JSON payload chunk by chunk, so it is never held as one str. With a
+# file store it is written straight into the store; otherwise only what the
+# database stores (the compressed payload, or the text of small or
+# incompressible content) is read back into memory.
+
+import codecs
+import hashlib
+import json
+import tempfile
+from collections import Counter
+from typing import IO, Iterable, Iterator
+from sqlalchemy import Connection, bindparam, delete, update
+from sqlalchemy.dialects import postgresql, sqlite
+from env import getenv
+from resource_entity import ContentBlobEntity
+import file_store
+from file_store import FileBlobStore
+from storage_codecs import StorageCodec, json_payload, storage_codec
+
+UPLOAD_MAX_BYTES = int(getenv("UPLOAD_MAX_BYTES", str(64 << 20)))
+UPLOAD_SPOOL_MEMORY = int(getenv("UPLOAD_SPOOL_MEMORY", str(1 << 20)))
+_READ_SIZE = 1 << 16
+
+
+class ContentTooLargeError(Exception):
+    """Exception raised when uploaded content exceeds the maximum size"""
+
+    pass
+
+
+class ContentSpool:
+    """Text content received in chunks, kept as its JSON payload in a temporary
+    file while its hash and length are computed.
+
+    Raises ContentTooLargeError once more than max_bytes have been fed, and
+    UnicodeDecodeError for content that is not UTF-8."""
+
+    def __init__(
+        self, max_bytes: int = UPLOAD_MAX_BYTES, files: FileBlobStore | None = None
+    ):
+        self.max_bytes = max_bytes
+        self.files = files
+        # In the store, so a large upload becomes its file with a rename
+        self.file: IO[bytes] = (
+            files.spool()
+            if files is not None
+            else tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MEMORY)
+        )
+        self.received = 0
+        # Characters of content and bytes of payload, as _blob_row counts them
+        self.length = 0
+        self.size = 0
+        self._hash = hashlib.blake2b(digest_size=32)
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._write(b'"')
+
+    @property
+    def hash(self) -> str:
+        # Same as ContentBlobEntity.hash_of: the UTF-8 bytes are the body's
+        return self._hash.hexdigest()
+
+    def feed(self, chunk: bytes) -> None:
+        self.received += len(chunk)
+        if self.received > self.max_bytes:
+            raise ContentTooLargeError
+        self._hash.update(chunk)
+        self._write_text(self._decoder.decode(chunk))
+
+    def finish(self) -> None:
+        self._write_text(self._decoder.decode(b"", final=True))
+        self._write(b'"')
+        self.file.flush()
+
+    def payload(self) -> Iterator[bytes]:
+        self.file.seek(0)
+        while chunk := self.file.read(_READ_SIZE):
+            yield chunk
+
+    def text(self) -> str:
+        self.file.seek(0)
+        return json.loads(self.file.read())
+
+    def close(self) -> None:
+        if self.files is not None:
+            self.files.discard(self.file)
+        else:
+            self.file.close()
+
+    def _write_text(self, text: str) -> None:
+        if text:
+            self.length += len(text)
+            # JSON escapes each character on its own, so chunks concatenate
+            self._write(json_payload(text)[1:-1])
+
+    def _write(self, data: bytes) -> None:
+        self.size += len(data)
+        self.file.write(data)
+
+
+def acquire(
+    connection: Connection,
+    contents: Iterable[str],
+    codec: StorageCodec = storage_codec,
+    files: FileBlobStore | None = None,
+) -> None:
+    """Adds a reference to the blob of each content, storing new blobs
+    compressed by codec, or as files in files (default: the configured file
+    store), when they are large enough."""
+    acquire_rows(connection, blob_rows(contents, codec, files))
+
+
+def blob_rows(
+    contents: Iterable[str],
+    codec: StorageCodec = storage_codec,
+    files: FileBlobStore | None = None,
+) -> list[dict]:
+    """The blob row of each distinct content, with a reference per time it
+    occurs, for acquire_rows(). Compresses the content or writes its file, so
+    it is built ahead of the transaction, off the event loop."""
+    files = files or file_store.file_blob_store
+    references: dict[str, list] = {}
+    for content in contents:
+        hash = ContentBlobEntity.hash_of(content)
+        if hash in references:
+            references[hash][1] += 1
+        else:
+            references[hash] = [content, 1]
+    return [
+        _blob_row(hash, content, n, codec, files)
+        for hash, (content, n) in references.items()
+    ]
+
+
+def acquire_rows(connection: Connection, rows: list[dict]) -> None:
+    """Adds the references of blob rows built ahead of the transaction, by
+    blob_rows() or spooled_blob_row()."""
+    if not rows:
+        return
+    table = ContentBlobEntity.__table__
+    dialect = postgresql if connection.dialect.name == "postgresql" else sqlite
+    insert = dialect.insert(table)
+    connection.execute(
+        insert.on_conflict_do_update(
+            index_elements=["hash"],
+            set_={"refcount": table.c.refcount + insert.excluded.refcount},
+        ),
+        rows,
+    )
+
+
+def _blob_row(
+    hash: str,
+    content: str,
+    refcount: int,
+    codec: StorageCodec,
+    files: FileBlobStore | None,
+) -> dict:
+    row = {"hash": hash, "size": len(content), "refcount": refcount}
+    if files is not None and len(content) >= files.threshold:
+        files.write(hash, [json_payload(content)])
+        return row | {"content": None, "data": None, "codec": None, "backend": "file"}
+    codec_name, data = codec.encode(content)
+    return row | {
+        "content": content if codec_name is None else None,
+        "data": data,
+        "codec": codec_name,
+        "backend": None,
+    }
+
+
+def spooled_blob_row(spool: ContentSpool, codec: StorageCodec = storage_codec) -> dict:
+    """The blob row _blob_row would build for the finished spool's content,
+    with one reference. Moves large content into the spool's file store."""
+    row = {"hash": spool.hash, "size": spool.length, "refcount": 1}
+    files = spool.files
+    if files is not None and spool.length >= files.threshold:
+        files.adopt(spool.hash, spool.file)
+        return row | {"content": None, "data": None, "codec": None, "backend": "file"}
+    codec_name, data = codec.encode_chunks(spool.length, spool.size, spool.payload())
+    return row | {
+        "content": spool.text() if codec_name is None else None,
+        "data": data,
+        "codec": codec_name,
+        "backend": None,
+    }
+
+
+def release(connection: Connection, hashes: Iterable[str | None]) -> None:
+    """Drops a reference to each blob, deleting blobs nothing refers to."""
+    references = Counter(hash for hash in hashes if hash is not None)
+    if not references:
+        return
+    table = ContentBlobEntity.__table__
+    connection.execute(
+        update(table)
+        .where(table.c.hash == bindparam("b_hash"))
+        .values(refcount=table.c.refcount - bindparam("b_n")),
+        [{"b_hash": hash, "b_n": n} for hash, n in references.items()],
+    )
+    connection.execute(
+        delete(table).where(table.c.hash.in_(references), table.c.refcount <= 0)
+    )
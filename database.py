@@ -1,116 +1,395 @@
 # Script for SQLite3 database creation. Runs on startup
 
+import datetime
+import logging
 import sqlite3
-from models import Resource, Type
-from database_startup import db_session
-from typing import Annotated
+from collections import Counter
+from models import Resource, ResourceRecord, Type
+from database_startup import (
+    db_session,
+    get_access_counter,
+    get_id_filter,
+    session_scope,
+)
+from typing import Annotated, AsyncIterator, Callable, Collection, TypeVar
 from fastapi import Depends
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import Row, delete, exists, insert, or_, select, union_all
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from resource_entity import ResourceEntity
+from resource_entity import (
+    ContentBlobEntity,
+    ResourceEntity,
+    ReservedIdEntity,
+    db_now,
+)
+from query_builder import ResourceQuery
+from resource_rows import row_record, select_record, select_rows
+from cache import ResourceCache, get_resource_cache
+from access_counter import AccessCounter
+from id_filter import IdFilter
+from bulk_delete import delete_batch
+import content_store
 
 # Go back and do error handling for all of methods
 
+T = TypeVar("T")
+
+# Debug records of this logger are sampled, see log_config
+logger = logging.getLogger(__name__)
+
+
+class DuplicateKeyError(ValueError):
+    """Exception raised when an id or vanity url is already taken"""
+
+    pass
+
+
+def _insert(session: Session, entry: ResourceEntity) -> datetime.datetime:
+    """Inserts entry and returns its created_at.
+
+    created_at is stamped by the database clock in the insert rather than when
+    the request arrived: the id filters of other replicas find new ids by it
+    against the same clock, and miss a row committed long after it."""
+    table = ResourceEntity.__table__
+    row = {column.key: getattr(entry, column.key) for column in table.c}
+    row["created_at"] = db_now()
+    try:
+        return session.execute(
+            insert(table).values(row).returning(table.c.created_at)
+        ).scalar_one()
+    except IntegrityError as error:
+        # The unique id and vanity url indexes reject a taken key, including
+        # one a concurrent create committed a moment ago
+        session.rollback()
+        raise DuplicateKeyError(
+            f"Resource with id {entry.id} already exists."
+        ) from error
+
 
 class DatabaseService:
-    __session: Session
+    __session: Session | AsyncSession
+    __cache: ResourceCache
+    __access_counter: AccessCounter
+    __id_filter: IdFilter | None
 
-    def __init__(self, session: Annotated[Session, Depends(db_session)]):
+    def __init__(
+        self,
+        session: Annotated[Session | AsyncSession, Depends(db_session)],
+        cache: Annotated[ResourceCache, Depends(get_resource_cache)],
+        access_counter: Annotated[AccessCounter, Depends(get_access_counter)],
+        id_filter: Annotated[IdFilter | None, Depends(get_id_filter)] = None,
+    ):
         self.__session = session
+        self.__cache = cache
+        self.__access_counter = access_counter
+        self.__id_filter = id_filter
 
-    def add_entry(self, resource: Resource) -> None:
-        entry = ResourceEntity.from_model(resource)
-        # Check if the resource already exists
-        if self.__session.query(ResourceEntity).filter_by(id=resource.id).count() == 0:
-            self.__session.add(entry)
-        else:
-            raise ValueError(f"Resource with id {resource.id} already exists.")
-        self.__session.commit()
-
-    def get_entry(self, id: str) -> Resource:
-        resource = self.__session.query(ResourceEntity).filter_by(id=id).first()
-        print("Get Entry Result: ", resource)
-        return resource
+    async def __run(self, fn: Callable[[Session], T]) -> T:
+        """Runs fn against a sync Session.
+
+        With an AsyncSession fn runs through run_sync, so its queries go through
+        the async driver without blocking the event loop. In sync mode (used by
+        the tests) fn is simply called with the session."""
+        if isinstance(self.__session, AsyncSession):
+            return await self.__session.run_sync(fn)
+        return fn(self.__session)
+
+    async def add_entry(self, resource: Resource) -> None:
+        blobs = []
+        if resource.type == Type.text:
+            blobs = await run_in_threadpool(content_store.blob_rows, [resource.content])
+
+        def add_entry(session: Session) -> None:
+            entry = ResourceEntity.from_model(resource)
+            resource.created_at = _insert(session, entry)
+            content_store.acquire_rows(session.connection(), blobs)
+            # The id is now owned by the resource, drop any pool reservation for it
+            session.query(ReservedIdEntity).filter_by(id=resource.id).delete()
+            session.commit()
+
+        self.__remember_ids([resource.id])
+        await self.__run(add_entry)
+        logger.debug("Added entry %s", resource.id)
+
+    async def add_blob_entry(self, resource: Resource, blob: dict) -> None:
+        """Adds a text snippet whose content is the blob row blob, built ahead
+        of time by content_store.spooled_blob_row, rather than resource.content."""
+
+        def add_blob_entry(session: Session) -> None:
+            entry = ResourceEntity.from_model(resource)
+            entry.content_hash = blob["hash"]
+            entry.content_length = blob["size"]
+            resource.created_at = _insert(session, entry)
+            content_store.acquire_rows(session.connection(), [blob])
+            session.query(ReservedIdEntity).filter_by(id=resource.id).delete()
+            session.commit()
+
+        self.__remember_ids([resource.id])
+        await self.__run(add_blob_entry)
+        logger.debug("Added entry %s from blob %s", resource.id, blob["hash"])
+
+    async def get_entry(self, id: str) -> Resource | None:
+        def get_entry(session: Session) -> Resource | None:
+            resource = session.query(ResourceEntity).filter_by(id=id).first()
+            logger.debug("Get entry %s found=%s", id, resource is not None)
+            return resource.to_model() if resource is not None else None
+
+        return await self.__run(get_entry)
+
+    async def get_cached_entry(self, id: str) -> ResourceRecord | None:
+        # Read-through: only a cache miss touches the database
+        record = self.__cache.get(id)
+        if record is not None:
+            return record
+        # Unknown ids are mostly answered by the id filter without a query
+        id_filter = self.__id_filter
+        if id_filter is not None and not id_filter.might_exist(id):
+            return None
+        statement = select_record(id)
+
+        def get_cached_entry(session: Session) -> ResourceRecord | None:
+            # A row, not an entity: nothing for the session to track
+            row = session.connection().execute(statement).first()
+            return row_record(row) if row is not None else None
+
+        record = await self.__run(get_cached_entry)
+        logger.debug("Cache miss for %s found=%s", id, record is not None)
+        if record is not None:
+            self.__cache.put(id, record)
+        elif id_filter is not None:
+            id_filter.missing(id)
+        return record
+
+    async def resource_exists(self, **kwargs) -> bool:
+        # SELECT EXISTS(...) instead of loading and converting matching rows
+        def resource_exists(session: Session) -> bool:
+            query = session.query(ResourceEntity)
+            for key, value in kwargs.items():
+                if key not in ("id", "vanity_url", "type"):
+                    raise ValueError(f"Unsupported filter: {key}")
+                query = query.filter(getattr(ResourceEntity, key) == value)
+            return session.query(query.exists()).scalar()
+
+        return await self.__run(resource_exists)
+
+    async def id_taken(self, key: str) -> bool:
+        """Checks whether key is already used as an id or a vanity url, or is
+        reserved by an id pool, in one query."""
+
+        def id_taken(session: Session) -> bool:
+            return session.query(
+                or_(
+                    exists().where(
+                        or_(ResourceEntity.id == key, ResourceEntity.vanity_url == key)
+                    ),
+                    exists().where(ReservedIdEntity.id == key),
+                )
+            ).scalar()
+
+        return await self.__run(id_taken)
 
-    def filter_by(self, **kwargs) -> list[Resource]:
-        # Print the arguments passed
-        print(
-            "````````````````````````````````````Filtering by:",
-            kwargs,
-            "````````````````````````````````````",
+    async def taken_keys(self, keys: Collection[str]) -> set[str]:
+        """The keys already used as an id or a vanity url, or reserved by an id
+        pool, in one query for the whole collection."""
+        if not keys:
+            return set()
+        statement = union_all(
+            select(ResourceEntity.id).where(ResourceEntity.id.in_(keys)),
+            select(ResourceEntity.vanity_url).where(
+                ResourceEntity.vanity_url.in_(keys)
+            ),
+            select(ReservedIdEntity.id).where(ReservedIdEntity.id.in_(keys)),
         )
-        query = self.__session.query(ResourceEntity)
-
-        for key, value in kwargs.items():
-            if key == "type":
-                query = query.filter_by(type=value)
-            elif key == "vanity_url":
-                query = query.filter_by(vanity_url=value)
-            elif key == "id":
-                query = query.filter_by(id=value)
-            if isinstance(value, tuple) and len(value) == 2:
-                operator, operand = value
-                print(key, " ", operator, " ", operand)
-                if operator is None or operand is None:
-                    continue
-                if operator == "=":
-                    query = query.filter(ResourceEntity.access_count == operand)
-                elif operator == "<":
-                    query = query.filter(ResourceEntity.access_count < operand)
-                elif operator == ">":
-                    query = query.filter(ResourceEntity.access_count > operand)
-                elif operator == "<=":
-                    query = query.filter(ResourceEntity.access_count <= operand)
-                elif operator == ">=":
-                    query = query.filter(ResourceEntity.access_count >= operand)
-                else:
-                    raise ValueError(f"Unsupported operator: {operator}")
-        # All Query entries should be made to go from Resource to ResourceEntity
-        query_result = query.all()
-        return [entity.to_model() for entity in query_result]
-
-    # Definnitely an issue here
-    def resource_exists(self, **kwargs) -> bool:
-        queried = self.filter_by(**kwargs)
-        print(f"Results: {queried}")
-        print("Resource exists queried")
-        return len(queried) > 0
-
-    def get_all_entries(self) -> list[Resource]:
-        resources = self.__session.query(ResourceEntity).all()
-        return [entity.to_model() for entity in resources]
-
-    def update_entry(self, id: str, content: str) -> None:
-        resource_entity = self.__session.query(ResourceEntity).filter_by(id=id).first()
-        if resource_entity is None:
-            raise ValueError(f"Resource with id {id} not found.")
-        resource_entity.content = content
-        self.__session.commit()
 
-    def update_access_count(self, id: str) -> None:
-        resource_entity = self.__session.query(ResourceEntity).filter_by(id=id).first()
-        if resource_entity is None:
-            raise ValueError(f"Resource with id {id} not found.")
-        resource_entity.access_count += 1
-        self.__session.commit()
-
-    def delete_entry(self, id: str) -> Resource:
-        resource_entity = self.__session.query(ResourceEntity).filter_by(id=id).first()
-        if resource_entity is None:
-            raise ValueError(f"Resource with id {id} not found.")
-        self.__session.delete(resource_entity)
-        self.__session.commit()
-        return resource_entity.to_model()
-
-    def delete_all_entries(self) -> None:
-        self.__session.query(ResourceEntity).delete()
-        self.__session.commit()
-
-    def tuple_to_resource(self, resource_tuple) -> Resource:
-        return Resource(
-            id=resource_tuple[0],
-            content=resource_tuple[1],
-            vanity_url=resource_tuple[2],
-            type=Type(resource_tuple[3]),
-            expiration_time=resource_tuple[4],
-            access_count=resource_tuple[5],
+        def taken_keys(session: Session) -> set[str]:
+            return set(session.scalars(statement))
+
+        return await self.__run(taken_keys)
+
+    async def add_entries(self, resources: list[Resource]) -> set[str]:
+        """Inserts resources with one executemany in one transaction.
+
+        Rows whose id or vanity url was taken concurrently are skipped instead
+        of failing the batch. Returns the ids that were inserted."""
+        table = ResourceEntity.__table__
+        rows = []
+        for resource in resources:
+            entity = ResourceEntity.from_model(resource)
+            # created_at is stamped by the insert, see _insert
+            rows.append(
+                {
+                    column.key: getattr(entity, column.key)
+                    for column in table.c
+                    if column.key != "created_at"
+                }
+            )
+        # Built for every snippet; the files of rows that turn out taken are
+        # swept as unreferenced
+        blobs = await run_in_threadpool(
+            content_store.blob_rows,
+            [resource.content for resource in resources if resource.type == Type.text],
         )
+
+        def add_entries(session: Session) -> set[str]:
+            if not rows:
+                return set()
+            dialect = (
+                postgresql
+                if session.get_bind().dialect.name == "postgresql"
+                else sqlite
+            )
+            inserted = set(
+                session.scalars(
+                    dialect.insert(table)
+                    .values(created_at=db_now())
+                    .on_conflict_do_nothing()
+                    .returning(table.c.id),
+                    rows,
+                )
+            )
+            if inserted:
+                session.execute(
+                    delete(ReservedIdEntity).where(ReservedIdEntity.id.in_(inserted))
+                )
+                references = Counter(
+                    row["content_hash"]
+                    for row in rows
+                    if row["id"] in inserted and row["content_hash"] is not None
+                )
+                content_store.acquire_rows(
+                    session.connection(),
+                    [
+                        blob | {"refcount": references[blob["hash"]]}
+                        for blob in blobs
+                        if blob["hash"] in references
+                    ],
+                )
+            session.commit()
+            return inserted
+
+        self.__remember_ids([row["id"] for row in rows])
+        inserted = await self.__run(add_entries)
+        logger.debug("Added %s of %s entries", len(inserted), len(rows))
+        return inserted
+
+    async def query_rows(self, query: ResourceQuery) -> list[Row]:
+        """Rows of resource_rows.ROW_COLUMNS matching query, filtered, ordered
+        and limited in one SELECT, without loading entities."""
+        statement = query.statement(base=select_rows())
+
+        def query_rows(session: Session) -> list[Row]:
+            # On the connection: plain rows need none of the ORM's loading
+            return session.connection().execute(statement).all()
+
+        return await self.__run(query_rows)
+
+    async def stream_rows(
+        self, query: ResourceQuery, batch_size: int = 500
+    ) -> AsyncIterator[list[Row]]:
+        """Yields the rows of query_rows in lists of up to batch_size rows.
+
+        Uses its own session, since streaming responses outlive the request's."""
+        statement = query.statement(base=select_rows()).execution_options(
+            yield_per=batch_size
+        )
+        async with session_scope() as session:
+            if isinstance(session, AsyncSession):
+                connection = await session.connection()
+                result = await connection.stream(statement)
+                async for rows in result.partitions():
+                    yield rows
+            else:
+                for rows in session.connection().execute(statement).partitions():
+                    yield rows
+
+    async def update_entry(self, id: str, content: str) -> None:
+        # Unused if the resource turns out to be a link
+        blobs = await run_in_threadpool(content_store.blob_rows, [content])
+
+        def update_entry(session: Session) -> None:
+            resource_entity = session.query(ResourceEntity).filter_by(id=id).first()
+            if resource_entity is None:
+                raise ValueError(f"Resource with id {id} not found.")
+            if resource_entity.type == Type.text:
+                # Acquire before releasing, the content may not have changed
+                previous_hash = resource_entity.content_hash
+                content_store.acquire_rows(session.connection(), blobs)
+                resource_entity.content_hash = ContentBlobEntity.hash_of(content)
+                resource_entity.content = None
+                content_store.release(session.connection(), [previous_hash])
+                session.expire(resource_entity, ["blob"])
+            else:
+                resource_entity.content = content
+            resource_entity.content_length = len(content)
+            # Changes the ETag, so cached copies of the old content revalidate
+            resource_entity.version = (resource_entity.version or 1) + 1
+            session.commit()
+
+        await self.__run(update_entry)
+        self.__cache.invalidate(id)
+
+    def update_access_count(self, id: str) -> None:
+        # Buffered and persisted in batches by the access counter
+        self.__access_counter.increment(id)
+
+    async def get_access_count(self, id: str) -> int | None:
+        def get_access_count(session: Session) -> int | None:
+            return (
+                session.query(ResourceEntity.access_count)
+                .filter(ResourceEntity.id == id)
+                .scalar()
+            )
+
+        access_count = await self.__run(get_access_count)
+        if access_count is None:
+            return None
+        return access_count + self.__access_counter.pending(id)
+
+    async def delete_entry(self, id: str) -> Resource | None:
+        # One DELETE ... RETURNING instead of loading the row first
+        def delete_entry(session: Session) -> Resource | None:
+            resource_entity = session.scalars(
+                delete(ResourceEntity)
+                .where(ResourceEntity.id == id)
+                .returning(ResourceEntity)
+            ).first()
+            resource = resource_entity.to_model() if resource_entity else None
+            if resource_entity is not None:
+                content_store.release(
+                    session.connection(), [resource_entity.content_hash]
+                )
+            session.commit()
+            return resource
+
+        resource = await self.__run(delete_entry)
+        logger.debug("Deleted entry %s found=%s", id, resource is not None)
+        self.__cache.invalidate(id)
+        self.__access_counter.discard(id)
+        if self.__id_filter is not None and resource is not None:
+            self.__id_filter.discard([id])
+        return resource
+
+    async def delete_all_entries(self, batch_size: int = 1000) -> None:
+        # Short transactions instead of one DELETE that locks the whole table
+        def delete_all_entries(session: Session) -> None:
+            while True:
+                ids = delete_batch(session.connection(), [], batch_size)
+                session.commit()
+                if not ids:
+                    break
+
+        await self.__run(delete_all_entries)
+        self.__cache.clear()
+        self.__access_counter.clear()
+
+    def __remember_ids(self, ids: list[str]) -> None:
+        # Before the insert, so no lookup can see the row but not the id; ids
+        # that end up not inserted only cost a query
+        if self.__id_filter is not None:
+            self.__id_filter.add(ids)
+
+    def cache_stats(self) -> dict[str, int]:
+        return self.__cache.stats()
@@ -1,10 +1,27 @@
 import sqlalchemy
+from contextlib import asynccontextmanager
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import Session
 from env import getenv
-from resource_entity import Base, ResourceEntity
+from engine_config import async_url, engine_options, pool_status
+from migrations import migrate
+from access_counter import AccessCounter
+from id_generator import IdGenerator, create_id_generator
+from expiry import ExpiryReaper
+from bulk_delete import BulkDeleter
+from file_store import FileBlobSweeper, file_blob_store
+from cache import resource_cache
+from hot_keys import hot_responses
+from id_filter import IdFilter
+from metrics import instrument_engine, registry
 
 
-def _engine_str(database: str = getenv("POSTGRES_DB")) -> str:
+def _engine_str(database: str | None = None) -> str:
+    # DATABASE_URL replaces the POSTGRES_* settings, e.g. sqlite:///test.db for tests
+    url = getenv("DATABASE_URL", "")
+    if url and database is None:
+        return url
+    database = database or getenv("POSTGRES_DB")
     user = getenv("POSTGRES_USER")
     password = getenv("POSTGRES_PASSWORD")
     host = getenv("POSTGRES_HOST")
@@ -12,13 +29,134 @@ def _engine_str(database: str = getenv("POSTGRES_DB")) -> str:
     return f"postgresql+psycopg://{user}:{password}@{host}:{port}/{database}"
 
 
-engine = sqlalchemy.create_engine(_engine_str())
-Base.metadata.create_all(engine)
+# "async" serves requests through AsyncSession, "sync" through a blocking Session
+DB_MODE = getenv("DB_MODE", "async")
+if DB_MODE not in ("async", "sync"):
+    raise ValueError(f"Unsupported DB_MODE: {DB_MODE}")
 
+# The sync engine runs migrations and background work on threads
+database_url = _engine_str()
+engine = sqlalchemy.create_engine(database_url, **engine_options(database_url))
+instrument_engine(engine)
+migrate(engine)
+async_engine = (
+    create_async_engine(
+        async_url(database_url), **engine_options(database_url, is_async=True)
+    )
+    if DB_MODE == "async"
+    else None
+)
+if async_engine is not None:
+    instrument_engine(async_engine.sync_engine)
 
-def db_session():
-    session = Session(engine)
-    try:
+
+def pool_metrics() -> dict[str, dict[str, float | str]]:
+    metrics = {"sync": pool_status(engine)}
+    if async_engine is not None:
+        metrics["async"] = pool_status(async_engine.sync_engine)
+    return metrics
+
+
+@asynccontextmanager
+async def session_scope():
+    """A session of the configured DB_MODE, for work that outlives a request."""
+    if async_engine is not None:
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            yield session
+    else:
+        session = Session(engine, expire_on_commit=False)
+        try:
+            yield session
+        finally:
+            session.close()
+
+
+async def db_session():
+    async with session_scope() as session:
         yield session
-    finally:
-        session.close()
+
+
+access_counter = AccessCounter(
+    engine,
+    flush_interval=float(getenv("ACCESS_COUNT_FLUSH_INTERVAL", "5")),
+    max_pending=int(getenv("ACCESS_COUNT_MAX_PENDING", "1000")),
+)
+
+
+def get_access_counter() -> AccessCounter:
+    return access_counter
+
+
+id_generator = create_id_generator(getenv("ID_GENERATOR", "pool"), engine)
+
+
+def get_id_generator() -> IdGenerator:
+    return id_generator
+
+
+# Rejects GETs of unknown ids without a query, see id_filter
+id_filter = (
+    IdFilter(
+        engine,
+        capacity=int(getenv("ID_FILTER_CAPACITY", "1000000")),
+        fp_rate=float(getenv("ID_FILTER_FP_RATE", "0.01")),
+        refresh_interval=float(getenv("ID_FILTER_REFRESH_INTERVAL", "1")),
+        rebuild_interval=float(getenv("ID_FILTER_REBUILD_INTERVAL", "3600")),
+        negative_ttl=float(getenv("ID_NEGATIVE_CACHE_TTL", "5")),
+        negative_size=int(getenv("ID_NEGATIVE_CACHE_SIZE", "10000")),
+    )
+    if getenv("ID_FILTER", "bloom") != "off"
+    else None
+)
+
+
+def get_id_filter() -> IdFilter | None:
+    return id_filter
+
+
+def _forget_deleted(ids: list[str]) -> None:
+    for id in ids:
+        resource_cache.invalidate(id)
+        access_counter.discard(id)
+    if id_filter is not None:
+        id_filter.discard(ids)
+
+
+expiry_reaper = ExpiryReaper(
+    engine,
+    interval=float(getenv("EXPIRY_REAP_INTERVAL", "60")),
+    batch_size=int(getenv("EXPIRY_REAP_BATCH_SIZE", "500")),
+    on_reaped=_forget_deleted,
+)
+
+bulk_deleter = BulkDeleter(
+    engine,
+    batch_size=int(getenv("BULK_DELETE_BATCH_SIZE", "500")),
+    # Seconds to yield to request traffic between batches
+    pause=float(getenv("BULK_DELETE_PAUSE", "0.01")),
+    on_deleted=_forget_deleted,
+)
+
+blob_sweeper = (
+    FileBlobSweeper(
+        file_blob_store,
+        engine,
+        interval=float(getenv("BLOB_STORE_SWEEP_INTERVAL", "600")),
+    )
+    if file_blob_store is not None
+    else None
+)
+
+registry.gauges("resource_cache", resource_cache.stats)
+registry.gauges("db_pool", lambda: pool_status(engine), engine="sync")
+if async_engine is not None:
+    registry.gauges(
+        "db_pool", lambda: pool_status(async_engine.sync_engine), engine="async"
+    )
+registry.gauges("expiry_reaper", expiry_reaper.stats)
+registry.gauges("hot_responses", hot_responses.stats)
+if id_filter is not None:
+    registry.gauges("id_filter", id_filter.stats)
+
+# Updated and deleted links must not be served from a pinned redirect
+resource_cache.on_invalidate(hot_responses.invalidate)
@@ -0,0 +1,133 @@
+# Engine and connection pool settings, driven by environment variables
+#
+# DB_POOL_MODE            "queue" (default) or "null" to open a connection per
+#                         checkout, e.g. behind PgBouncer
+# DB_POOL_SIZE            connections kept open by the pool (default 5)
+# DB_MAX_OVERFLOW         extra connections allowed under load (default 10)
+# DB_POOL_TIMEOUT         seconds to wait for a connection (default 30)
+# DB_POOL_PRE_PING        "true" to test connections on checkout (default false)
+# DB_POOL_RECYCLE         seconds before a connection is replaced, -1 to never
+#                         replace it (default -1)
+# DB_STATEMENT_TIMEOUT_MS Postgres statement_timeout, 0 for none (default 0)
+
+import threading
+import time
+from sqlalchemy import Engine, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool, StaticPool
+from env import getenv
+
+
+class PoolWaitStats:
+    """Time spent waiting for connections to be checked out of a pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float, timed_out: bool) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+
+class _WaitTimingMixin:
+    wait_stats: PoolWaitStats
+
+    def connect(self):
+        if not hasattr(self, "wait_stats"):
+            self.wait_stats = PoolWaitStats()
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self.wait_stats.record(time.perf_counter() - start, timed_out)
+
+
+class InstrumentedQueuePool(_WaitTimingMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncQueuePool(_WaitTimingMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def _getbool(variable: str, default: str) -> bool:
+    return getenv(variable, default).lower() in ("1", "true", "yes")
+
+
+def engine_options(url: str, is_async: bool = False) -> dict:
+    """Keyword arguments for create_engine/create_async_engine for url."""
+    backend = make_url(url).get_backend_name()
+    options: dict = {
+        "pool_pre_ping": _getbool("DB_POOL_PRE_PING", "false"),
+        "pool_recycle": int(getenv("DB_POOL_RECYCLE", "-1")),
+    }
+    connect_args: dict = {}
+
+    if backend == "sqlite":
+        # The test backend: share connections across the app's threads
+        connect_args["check_same_thread"] = False
+        if make_url(url).database in (None, "", ":memory:"):
+            options["poolclass"] = StaticPool
+            options["connect_args"] = connect_args
+            return options
+    elif backend == "postgresql":
+        statement_timeout = int(getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+        if statement_timeout > 0:
+            connect_args["options"] = f"-c statement_timeout={statement_timeout}"
+
+    pool_mode = getenv("DB_POOL_MODE", "queue")
+    if pool_mode == "null":
+        options["poolclass"] = NullPool
+    elif pool_mode == "queue":
+        options["poolclass"] = (
+            InstrumentedAsyncQueuePool if is_async else InstrumentedQueuePool
+        )
+        options["pool_size"] = int(getenv("DB_POOL_SIZE", "5"))
+        options["max_overflow"] = int(getenv("DB_MAX_OVERFLOW", "10"))
+        options["pool_timeout"] = float(getenv("DB_POOL_TIMEOUT", "30"))
+    else:
+        raise ValueError(f"Unsupported DB_POOL_MODE: {pool_mode}")
+    options["connect_args"] = connect_args
+    return options
+
+
+def async_url(url: str) -> str:
+    """The async driver variant of url."""
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite":
+        return parsed.set(drivername="sqlite+aiosqlite").render_as_string(
+            hide_password=False
+        )
+    return url
+
+
+def pool_status(engine: Engine) -> dict[str, float | str]:
+    pool = engine.pool
+    status: dict[str, float | str] = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            checked_in=pool.checkedin(),
+            overflow=pool.overflow(),
+        )
+    wait_stats = getattr(pool, "wait_stats", None)
+    if wait_stats is not None:
+        status.update(
+            checkouts=wait_stats.checkouts,
+            timeouts=wait_stats.timeouts,
+            total_wait_seconds=wait_stats.total_wait,
+            max_wait_seconds=wait_stats.max_wait,
+        )
+    return status
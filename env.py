@@ -4,8 +4,10 @@ import dotenv
 dotenv.load_dotenv(f"{os.path.dirname(__file__)}/.env", verbose=True)
 
 
-def getenv(variable: str) -> str:
+def getenv(variable: str, default: str | None = None) -> str:
     value = os.getenv(variable)
     if value is not None:
         return value
+    if default is not None:
+        return default
     raise ValueError(f"Environment variable '{variable}' not set.")
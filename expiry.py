@@ -0,0 +1,101 @@
+# Background removal of expired resources
+
+import datetime
+import logging
+import threading
+import time
+from typing import Callable
+from sqlalchemy import Connection, Engine, func, select
+from background import PeriodicTask
+from bulk_delete import delete_batch
+from resource_entity import ResourceEntity
+
+logger = logging.getLogger(__name__)
+
+
+def delete_expired_batch(
+    connection: Connection, now: datetime.datetime, batch_size: int
+) -> list[str]:
+    """Deletes up to batch_size resources that expired before now, oldest first.
+
+    Rows locked by another transaction, e.g. an access count flush, are left
+    for the next run rather than waited for."""
+    table = ResourceEntity.__table__
+    return delete_batch(
+        connection,
+        [table.c.expires_at < now],
+        batch_size,
+        order_by=table.c.expires_at,
+        skip_locked=True,
+    )
+
+
+class ExpiryReaper:
+    """Deletes expired resources in bounded batches every interval seconds.
+
+    Each batch is its own short transaction, so reaping a large backlog never
+    holds locks for long. on_reaped is called with the ids of every batch."""
+
+    def __init__(
+        self,
+        engine: Engine,
+        interval: float = 60.0,
+        batch_size: int = 500,
+        on_reaped: Callable[[list[str]], None] = lambda ids: None,
+    ):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.on_reaped = on_reaped
+        self._task = PeriodicTask("expiry-reaper", interval, self.reap)
+        self._lock = threading.Lock()
+        self.rows_reaped = 0
+        self.runs = 0
+        self.last_run_at: datetime.datetime | None = None
+        self.last_run_seconds = 0.0
+        self.lag_seconds = 0.0
+
+    def start(self) -> None:
+        self._task.start()
+
+    def stop(self) -> None:
+        self._task.stop()
+
+    def reap(self, now: datetime.datetime | None = None) -> int:
+        """Deletes every resource expired before now and returns how many."""
+        with self._lock:
+            now = now or datetime.datetime.now()
+            start = time.perf_counter()
+            # How far behind the reaper is: how long the oldest expired row has
+            # waited, measured before this run deletes it
+            with self.engine.connect() as connection:
+                oldest = connection.scalar(
+                    select(func.min(ResourceEntity.expires_at)).where(
+                        ResourceEntity.expires_at < now
+                    )
+                )
+            reaped = 0
+            while True:
+                with self.engine.begin() as connection:
+                    ids = delete_expired_batch(connection, now, self.batch_size)
+                if ids:
+                    reaped += len(ids)
+                    self.on_reaped(ids)
+                if len(ids) < self.batch_size:
+                    break
+            self.rows_reaped += reaped
+            self.runs += 1
+            self.last_run_at = now
+            self.last_run_seconds = time.perf_counter() - start
+            self.lag_seconds = (now - oldest).total_seconds() if oldest else 0.0
+            if reaped:
+                logger.info("Reaped %s expired resources", reaped)
+            return reaped
+
+    def stats(self) -> dict[str, float | str | None]:
+        return {
+            "rows_reaped": self.rows_reaped,
+            "runs": self.runs,
+            "last_run_at": self.last_run_at.isoformat() if self.last_run_at else None,
+            "last_run_seconds": self.last_run_seconds,
+            "lag_seconds": self.lag_seconds,
+        }
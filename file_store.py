@@ -0,0 +1,166 @@
+# Sharded on-disk storage for the content of very large text snippets
+#
+# BLOB_STORE_DIR        directory of the store; unset to keep all content in
+#                       the database (default)
+# BLOB_STORE_THRESHOLD  characters of content from which it is stored as a
+#                       file (default 1048576)
+# BLOB_STORE_GRACE      seconds an unreferenced file is kept before the
+#                       sweeper deletes it (default 3600)
+# BLOB_STORE_SWEEP_INTERVAL  seconds between sweeps (default 600)
+#
+# A file holds the uncompressed JSON body GET /{resource_id} responds with, so
+# it is served with FileResponse (including Range requests) without being read
+# into a str. Files are named by content hash under two levels of shard
+# directories, e.g. ab/cd/abcd1234...
+#
+# Files are never deleted in the transaction that drops their last reference:
+# a concurrent paste of the same content may be about to reuse the file. The
+# sweeper deletes files without a content_blobs row once they have not been
+# written or reused for BLOB_STORE_GRACE seconds.
+#
+# The store is not replicated: a file exists only where it was written. With
+# more than one replica, BLOB_STORE_DIR must be shared storage (e.g. an NFS or
+# EFS mount) at the same path on every replica, or a replica that did not
+# write a file answers 503 for it, as it does when a file has been lost.
+
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import IO, Iterable
+from sqlalchemy import Engine, column, select, table
+from background import PeriodicTask
+from env import getenv
+
+logger = logging.getLogger(__name__)
+
+_SWEEP_BATCH_SIZE = 500
+# Declared here rather than imported from resource_entity, which imports this
+_content_blobs = table("content_blobs", column("hash"))
+
+
+class BlobFileMissingError(Exception):
+    """Exception raised when the file of a blob is not in the store"""
+
+    pass
+
+
+class FileBlobStore:
+    def __init__(
+        self, root: str | os.PathLike, threshold: int = 1 << 20, grace: float = 3600
+    ):
+        self.root = Path(root)
+        self.threshold = threshold
+        self.grace = grace
+
+    def path(self, hash: str) -> Path:
+        return self.root / hash[:2] / hash[2:4] / hash
+
+    def write(self, hash: str, chunks: Iterable[bytes]) -> Path:
+        """Stores chunks as the file of hash, unless it is already stored.
+
+        The file appears atomically, so readers never see a partial body."""
+        path = self.path(hash)
+        if path.exists():
+            # Reused: restart the grace period in case it was just unreferenced
+            os.utime(path)
+            return path
+        file = self.spool()
+        try:
+            for chunk in chunks:
+                file.write(chunk)
+        except BaseException:
+            self.discard(file)
+            raise
+        return self.adopt(hash, file)
+
+    def spool(self) -> IO[bytes]:
+        """A temporary file in the store to write a body to before its hash is
+        known. Store it with adopt(), or remove it with discard()."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=self.root, prefix=".tmp-", delete=False)
+
+    def adopt(self, hash: str, file: IO[bytes]) -> Path:
+        """Stores a complete spool() file as the file of hash."""
+        path = self.path(hash)
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+        if path.exists():
+            os.utime(path)
+            os.unlink(file.name)
+            return path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(file.name, path)
+        return path
+
+    @staticmethod
+    def discard(file: IO[bytes]) -> None:
+        file.close()
+        Path(file.name).unlink(missing_ok=True)
+
+    def files(self) -> Iterable[Path]:
+        for path in self.root.glob("??/??/*"):
+            if not path.name.startswith(".tmp-"):
+                yield path
+
+    def sweep(self, engine: Engine, now: float | None = None) -> int:
+        """Deletes files no blob refers to that are older than the grace period."""
+        now = now or time.time()
+        deleted = 0
+        candidates = [path for path in self.files() if self._expired(path, now)]
+        for start in range(0, len(candidates), _SWEEP_BATCH_SIZE):
+            batch = {
+                path.name: path
+                for path in candidates[start : start + _SWEEP_BATCH_SIZE]
+            }
+            with engine.connect() as connection:
+                referenced = set(
+                    connection.scalars(
+                        select(_content_blobs.c.hash).where(
+                            _content_blobs.c.hash.in_(batch)
+                        )
+                    )
+                )
+            for hash, path in batch.items():
+                # Checked again in case the file was reused meanwhile
+                if hash not in referenced and self._expired(path, now):
+                    path.unlink(missing_ok=True)
+                    deleted += 1
+        if deleted:
+            logger.info("Swept %s unreferenced blob files", deleted)
+        return deleted
+
+    def _expired(self, path: Path, now: float) -> bool:
+        try:
+            return now - path.stat().st_mtime > self.grace
+        except FileNotFoundError:
+            return False
+
+
+class FileBlobSweeper:
+    """Runs FileBlobStore.sweep every interval seconds."""
+
+    def __init__(self, store: FileBlobStore, engine: Engine, interval: float = 600):
+        self.store = store
+        self.engine = engine
+        self._task = PeriodicTask("blob-sweeper", interval, lambda: store.sweep(engine))
+
+    def start(self) -> None:
+        self._task.start()
+
+    def stop(self) -> None:
+        self._task.stop()
+
+
+_root = getenv("BLOB_STORE_DIR", "")
+file_blob_store = (
+    FileBlobStore(
+        _root,
+        threshold=int(getenv("BLOB_STORE_THRESHOLD", str(1 << 20))),
+        grace=float(getenv("BLOB_STORE_GRACE", "3600")),
+    )
+    if _root
+    else None
+)
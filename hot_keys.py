@@ -0,0 +1,289 @@
+# Tracking of the most requested ids, and precomputed redirects for hot links
+#
+# HOT_KEY_CAPACITY     ids in the hot set, 0 to disable (default 64)
+# HOT_KEY_DECAY        requests between halvings of every count, so the hot set
+#                      follows current traffic (default 100000)
+# HOT_RESPONSE_TTL     seconds a precomputed redirect is served before it is
+#                      built again, which bounds how long another worker's
+#                      update can go unseen (default: RESOURCE_CACHE_TTL, 60)
+#
+# Every GET /{resource_id} is recorded in a count-min sketch; the ids with the
+# highest estimates form the hot set. Links in the hot set get their redirect
+# pinned as the ASGI messages to send, and HotResponseMiddleware answers them
+# before routing, dependency injection or the resource cache: a dict lookup
+# and two sends. Hits still count as accesses, still go through rate limiting,
+# and stop as soon as the link expires. A redirect is only pinned if nothing
+# was invalidated since its request read the resource, so a request racing
+# an update cannot pin the old redirect after the update forgot it.
+
+import random
+import threading
+import time
+from dataclasses import dataclass
+from starlette.responses import Response
+from access_counter import AccessCounter
+from env import getenv
+
+# Mersenne prime modulus of the row hash functions
+_PRIME = (1 << 61) - 1
+
+
+class CountMinSketch:
+    """Approximate counts in depth rows of width counters. Estimates are never
+    below the true count and exceed it by little for skewed traffic."""
+
+    def __init__(self, width: int = 2048, depth: int = 4):
+        self.width = width
+        self.rows = [[0] * width for _ in range(depth)]
+        # One (a * h + b) mod p hash per row. Rows must be independent, or a
+        # key sharing one row's counter with a heavy key shares all of them:
+        # hash((seed, key)) % width depends on too few bits of hash(key) for that
+        self._seeds = [
+            (random.randrange(1, _PRIME), random.randrange(_PRIME))
+            for _ in range(depth)
+        ]
+
+    def add(self, key: str) -> int:
+        """Counts key once more and returns its estimate."""
+        estimate = None
+        key_hash = hash(key) % _PRIME
+        for row, (a, b) in zip(self.rows, self._seeds):
+            index = (a * key_hash + b) % _PRIME % self.width
+            row[index] += 1
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        return estimate
+
+    def halve(self) -> None:
+        self.rows = [[count >> 1 for count in row] for row in self.rows]
+
+
+class HotKeyTracker:
+    """The capacity keys with the highest count-min estimates.
+
+    Keys outside the hot set cost one sketch update: the smallest hot estimate
+    is only looked up again when a key's estimate exceeds the last one found,
+    which is a lower bound of it since hot estimates only grow between
+    decays."""
+
+    def __init__(
+        self,
+        capacity: int = 64,
+        decay_interval: int = 100000,
+        sketch: CountMinSketch | None = None,
+    ):
+        self.capacity = capacity
+        self.decay_interval = decay_interval
+        self.sketch = sketch or CountMinSketch()
+        self._hot: dict[str, int] = {}
+        self._floor = 0
+        self._records = 0
+        self._lock = threading.Lock()
+
+    def record(self, key: str) -> bool:
+        """Counts a request for key. Returns whether key is in the hot set."""
+        if self.capacity <= 0:
+            return False
+        with self._lock:
+            self._records += 1
+            if self._records >= self.decay_interval:
+                self._decay()
+            estimate = self.sketch.add(key)
+            if key in self._hot or len(self._hot) < self.capacity:
+                self._hot[key] = estimate
+                return True
+            if estimate <= self._floor:
+                return False
+            coldest = min(self._hot, key=self._hot.__getitem__)
+            if estimate <= self._hot[coldest]:
+                self._floor = self._hot[coldest]
+                return False
+            del self._hot[coldest]
+            self._hot[key] = estimate
+            self._floor = min(self._hot.values())
+            return True
+
+    def is_hot(self, key: str) -> bool:
+        return key in self._hot
+
+    def hot_set(self) -> list[tuple[str, int]]:
+        with self._lock:
+            return sorted(self._hot.items(), key=lambda item: -item[1])
+
+    def _decay(self) -> None:
+        self._records = 0
+        self.sketch.halve()
+        self._hot = {key: count >> 1 for key, count in self._hot.items()}
+        self._floor >>= 1
+
+
+@dataclass(frozen=True)
+class PinnedResponse:
+    status: int
+    headers: tuple[tuple[bytes, bytes], ...]
+    body: bytes
+    # time.monotonic() after which it is built again
+    refresh_at: float
+    # time.time() the link expires at, if it does
+    expires_at: float | None
+    # ResourceRecord.version it was built from
+    version: int
+
+
+class HotResponseCache:
+    """Precomputed redirects of the links in the tracker's hot set."""
+
+    def __init__(self, tracker: HotKeyTracker, ttl: float = 60):
+        self.tracker = tracker
+        self.ttl = ttl
+        self._pinned: dict[str, PinnedResponse] = {}
+        # Counts invalidations, see pin()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    @property
+    def generation(self) -> int:
+        """Read before reading the resource a response is built from, and
+        passed to pin()."""
+        return self._generation
+
+    def record(self, id: str) -> bool:
+        return self.tracker.record(id)
+
+    def pin(
+        self,
+        id: str,
+        response: Response,
+        expires_at: int | None,
+        version: int,
+        generation: int,
+    ) -> None:
+        """Pins response for id while it is hot. expires_at and version are
+        the ResourceRecord's; generation is the generation read before it.
+
+        Nothing is pinned if anything was invalidated since generation was
+        read, as the record may predate it, or if a newer version is pinned."""
+        if not self.tracker.is_hot(id):
+            return
+        if expires_at is not None and "cache-control" in response.headers:
+            # Its max-age counts down to the expiration, it cannot be replayed
+            return
+        pinned = PinnedResponse(
+            status=response.status_code,
+            headers=tuple(response.raw_headers),
+            body=response.body,
+            refresh_at=time.monotonic() + self.ttl,
+            expires_at=expires_at,
+            version=version,
+        )
+        with self._lock:
+            if generation != self._generation:
+                return
+            current = self._pinned.get(id)
+            if current is not None and current.version > version:
+                return
+            if len(self._pinned) >= self.tracker.capacity:
+                # Unpin ids that have left the hot set
+                for key in [
+                    key for key in self._pinned if not self.tracker.is_hot(key)
+                ]:
+                    del self._pinned[key]
+            self._pinned[id] = pinned
+
+    def get(self, id: str) -> PinnedResponse | None:
+        with self._lock:
+            pinned = self._pinned.get(id)
+            if pinned is None:
+                return None
+            if pinned.refresh_at <= time.monotonic() or (
+                pinned.expires_at is not None and pinned.expires_at <= time.time()
+            ):
+                # Served the normal way, which rebuilds it or answers 410
+                del self._pinned[id]
+                return None
+            return pinned
+
+    def invalidate(self, id: str | None) -> None:
+        """Forgets the response of id, or of every id when id is None."""
+        with self._lock:
+            self._generation += 1
+            if id is None:
+                self._pinned.clear()
+            else:
+                self._pinned.pop(id, None)
+
+    def hot_set(self) -> list[dict[str, str | int | bool]]:
+        with self._lock:
+            pinned = set(self._pinned)
+        return [
+            {"id": id, "estimate": estimate, "pinned": id in pinned}
+            for id, estimate in self.tracker.hot_set()
+        ]
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            size = len(self._pinned)
+        return {
+            "capacity": self.tracker.capacity,
+            "pinned": size,
+            "hits": self.hits,
+        }
+
+
+class HotResponseMiddleware:
+    """Answers GET /{resource_id} for pinned links with their precomputed
+    redirect. Everything else, and pinned links that need refreshing, goes
+    through to the app."""
+
+    def __init__(
+        self,
+        app,
+        cache: HotResponseCache,
+        access_counter: AccessCounter,
+        route_path: str = "/{resource_id}",
+    ):
+        self.app = app
+        self.cache = cache
+        self.access_counter = access_counter
+        self.route_path = route_path
+        self._route = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            return await self.app(scope, receive, send)
+        id = scope["path"][1:]
+        pinned = self.cache.get(id) if "/" not in id else None
+        if pinned is None:
+            return await self.app(scope, receive, send)
+        self.cache.hits += 1
+        self.cache.record(id)
+        self.access_counter.increment(id)
+        # Labelled like routed requests in the metrics
+        scope["route"] = self._route or self._find_route(scope)
+        # New messages each time: outer middleware add headers to them
+        await send(
+            {
+                "type": "http.response.start",
+                "status": pinned.status,
+                "headers": list(pinned.headers),
+            }
+        )
+        await send({"type": "http.response.body", "body": pinned.body})
+
+    def _find_route(self, scope):
+        self._route = next(
+            route
+            for route in scope["app"].router.routes
+            if getattr(route, "path", None) == self.route_path
+        )
+        return self._route
+
+
+hot_responses = HotResponseCache(
+    HotKeyTracker(
+        capacity=int(getenv("HOT_KEY_CAPACITY", "64")),
+        decay_interval=int(getenv("HOT_KEY_DECAY", "100000")),
+    ),
+    ttl=float(getenv("HOT_RESPONSE_TTL", getenv("RESOURCE_CACHE_TTL", "60"))),
+)
@@ -0,0 +1,151 @@
+# HTTP caching of GET /{resource_id}, driven by environment variables
+#
+# TEXT_MAX_AGE        seconds browsers and CDNs may reuse a text snippet before
+#                     revalidating it with If-None-Match (default 0: always
+#                     revalidate, which still saves the body on a 304)
+# REDIRECT_MODE       "temporary" (default) answers links with an uncached 307;
+#                     "permanent" with a cacheable 308, "moved" with a 301
+# REDIRECT_MAX_AGE    seconds a permanent redirect may be cached (default 3600)
+#
+# Every max-age is capped at the time left until the resource expires, so no
+# cache serves a resource past its expiration_time.
+#
+# Access counting: only requests that reach the server are counted. A 304
+# revalidation is counted like a full response, so with TEXT_MAX_AGE=0 every
+# view of a snippet is counted. Hits served by a browser or CDN from its cache
+# are not, so with a max-age above 0, or REDIRECT_MODE other than temporary,
+# access_count becomes a lower bound of the real views. Updating a resource
+# bumps its version and so its ETag, but permanent redirects already cached by
+# clients keep pointing at the old target until their max-age runs out.
+
+import os
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, Response
+from env import getenv
+from file_store import BlobFileMissingError
+from models import ResourceRecord
+from resource_entity import ContentBlobEntity
+from storage_codecs import CODECS
+
+REDIRECT_STATUS = {"temporary": 307, "permanent": 308, "moved": 301}
+
+
+def etag(resource: ResourceRecord) -> str:
+    """Strong ETag of the resource's content at its current version."""
+    if resource.stored_body is not None:
+        # Stored content is not loaded, its hash is known
+        digest = resource.stored_body.digest
+    else:
+        digest = ContentBlobEntity.hash_of(resource.content)
+    return f'"{resource.version}-{digest[:16]}"'
+
+
+def etag_matches(if_none_match: str, tag: str) -> bool:
+    # If-None-Match uses weak comparison and may list several tags or be "*"
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        candidate.strip().removeprefix("W/") == tag
+        for candidate in if_none_match.split(",")
+    )
+
+
+def accepted_encodings(accept_encoding: str | None) -> set[str]:
+    """Content codings listed in Accept-Encoding, without those with q=0."""
+    accepted = set()
+    for item in (accept_encoding or "").split(","):
+        coding, _, parameters = item.strip().partition(";")
+        quality = parameters.strip().removeprefix("q=").strip()
+        if coding and quality not in ("0", "0.0", "0.00", "0.000"):
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def max_age(resource: ResourceRecord, now: float, default: int) -> int:
+    """default seconds, or fewer if the resource expires sooner. now is a
+    time.time()."""
+    if resource.expires_at is not None:
+        return max(0, min(default, int(resource.expires_at - now)))
+    return default
+
+
+class HttpCachePolicy:
+    """Builds the responses of GET /{resource_id} with their caching headers."""
+
+    def __init__(
+        self,
+        text_max_age: int = 0,
+        redirect_mode: str = "temporary",
+        redirect_max_age: int = 3600,
+    ):
+        if redirect_mode not in REDIRECT_STATUS:
+            raise ValueError(f"Unsupported REDIRECT_MODE: {redirect_mode}")
+        self.text_max_age = text_max_age
+        self.redirect_mode = redirect_mode
+        self.redirect_max_age = redirect_max_age
+
+    def text_response(
+        self,
+        resource: ResourceRecord,
+        now: float,
+        if_none_match: str | None = None,
+        accept_encoding: str | None = None,
+    ) -> Response:
+        tag = etag(resource)
+        age = max_age(resource, now, self.text_max_age)
+        headers = {
+            "Cache-Control": f"public, max-age={age}" if age else "no-cache",
+            "Vary": "Accept-Encoding",
+        }
+        # Compressed content goes out as stored when the client can decode it
+        body = resource.stored_body
+        encoding = None
+        if body is not None and body.codec is not None:
+            encoding = CODECS[body.codec].http_encoding
+            if encoding not in accepted_encodings(accept_encoding):
+                encoding = None
+        if encoding is not None:
+            # Each encoding of the body is its own representation
+            tag = f'{tag[:-1]}-{encoding}"'
+        headers["ETag"] = tag
+        if if_none_match is not None and etag_matches(if_none_match, tag):
+            return Response(status_code=304, headers=headers)
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+            return Response(body.data, media_type="application/json", headers=headers)
+        if body is not None and body.path is not None:
+            # Checked here: FileResponse would only find out once responding
+            if not os.path.isfile(body.path):
+                raise BlobFileMissingError(body.path)
+            # Streamed from disk in chunks, with Range support
+            return FileResponse(
+                body.path, media_type="application/json", headers=headers
+            )
+        if body is not None:
+            # The stored payload is the JSON body, see storage_codecs.json_payload
+            return Response(
+                CODECS[body.codec].decode(body.data),
+                media_type="application/json",
+                headers=headers,
+            )
+        return JSONResponse(resource.content, headers=headers)
+
+    def redirect_response(
+        self, resource: ResourceRecord, now: float
+    ) -> RedirectResponse:
+        if self.redirect_mode != "temporary":
+            age = max_age(resource, now, self.redirect_max_age)
+            # Links about to expire fall back to an uncached temporary redirect
+            if age > 0:
+                return RedirectResponse(
+                    url=resource.content,
+                    status_code=REDIRECT_STATUS[self.redirect_mode],
+                    headers={"Cache-Control": f"public, max-age={age}"},
+                )
+        return RedirectResponse(url=resource.content)
+
+
+http_cache_policy = HttpCachePolicy(
+    text_max_age=int(getenv("TEXT_MAX_AGE", "0")),
+    redirect_mode=getenv("REDIRECT_MODE", "temporary"),
+    redirect_max_age=int(getenv("REDIRECT_MAX_AGE", "3600")),
+)
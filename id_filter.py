@@ -0,0 +1,268 @@
+# Membership pre-filter answering unknown ids of GET /{resource_id} without a
+# database query
+#
+# ID_FILTER                    "bloom" (default), or "off" to query for every id
+# ID_FILTER_CAPACITY           ids the Bloom filter is sized for at least; it is
+#                              rebuilt for twice the row count when it fills up
+#                              (default 1000000)
+# ID_FILTER_FP_RATE            false positive rate it is sized for (default 0.01;
+#                              about 1.2 MB per million ids, 1.8 MB at 0.001)
+# ID_FILTER_REFRESH_INTERVAL   seconds between scans for ids created by other
+#                              workers (default 1)
+# ID_FILTER_REBUILD_INTERVAL   seconds between full rebuilds, which drop deleted
+#                              ids (default 3600)
+# ID_NEGATIVE_CACHE_TTL        seconds an id found missing is answered 404
+#                              without a query (default 5)
+# ID_NEGATIVE_CACHE_SIZE       ids the negative cache holds (default 10000)
+#
+# The filter is built by a streaming scan of resources.id on a background
+# thread at startup; until then every id is looked up. Ids this worker creates
+# are added at once. Ids other workers or replicas create are added by the
+# refresh, which scans resources.created_at from a watermark, so on another
+# worker a new id can be answered 404 for up to ID_FILTER_REFRESH_INTERVAL
+# seconds (and for a vanity url requested just before it was taken, up to
+# ID_NEGATIVE_CACHE_TTL). Both created_at and the watermark come from the
+# database clock, so the clocks and time zones of the replicas do not matter.
+# The scan starts 5 seconds before the watermark, for rows committed after it
+# with an earlier created_at; DatabaseService stamps created_at in the insert,
+# so that allows 5 seconds between an insert and its commit. A row committed
+# later than that is only found by the next rebuild. Bloom filters cannot forget: deleted ids stay in it and
+# cost a query (unless negatively cached) until the next rebuild.
+
+import datetime
+import hashlib
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable
+from sqlalchemy import Engine, func, select
+from background import PeriodicTask
+from resource_entity import ResourceEntity, db_now
+
+logger = logging.getLogger(__name__)
+
+_SCAN_BATCH_SIZE = 10000
+# Rows committed after a refresh may carry a created_at from before it
+_WATERMARK_SLACK = datetime.timedelta(seconds=5)
+
+
+class BloomFilter:
+    """A Bloom filter of capacity keys with the given false positive rate."""
+
+    def __init__(self, capacity: int, fp_rate: float = 0.01):
+        self.capacity = max(capacity, 1)
+        self.fp_rate = fp_rate
+        self.size = max(
+            8, math.ceil(-self.capacity * math.log(fp_rate) / math.log(2) ** 2)
+        )
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str) -> Iterable[int]:
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        bits = self.bits
+        return all(
+            bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+    def false_positive_rate(self) -> float:
+        """Expected rate at the current number of keys."""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.bits)
+
+
+class IdFilter:
+    """Bloom filter of every resource id plus a short-TTL negative cache.
+
+    might_exist() false means the id certainly does not exist; true means it
+    has to be looked up."""
+
+    def __init__(
+        self,
+        engine: Engine,
+        capacity: int = 1_000_000,
+        fp_rate: float = 0.01,
+        refresh_interval: float = 1.0,
+        rebuild_interval: float = 3600.0,
+        negative_ttl: float = 5.0,
+        negative_size: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.engine = engine
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.rebuild_interval = rebuild_interval
+        self.negative_ttl = negative_ttl
+        self.negative_size = negative_size
+        self._clock = clock
+        self._bloom: BloomFilter | None = None
+        self._built_at = 0.0
+        self._watermark: datetime.datetime | None = None
+        # Ids added while a rebuild scans, replayed into the new filter
+        self._added_during_build: list[str] | None = None
+        self._negative: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+        self._task = PeriodicTask("id-filter", refresh_interval, self.refresh)
+        self.rejections = 0
+        self.negative_hits = 0
+        self.false_positives = 0
+        self.deleted = 0
+
+    def start(self) -> None:
+        self._task.start()
+        # Build now rather than after the first interval
+        self._task.wake()
+
+    def stop(self) -> None:
+        self._task.stop()
+
+    def might_exist(self, id: str) -> bool:
+        bloom = self._bloom
+        if bloom is None:
+            return True
+        if id not in bloom:
+            self.rejections += 1
+            return False
+        with self._lock:
+            expires_at = self._negative.get(id)
+            if expires_at is not None:
+                if expires_at > self._clock():
+                    self.negative_hits += 1
+                    return False
+                del self._negative[id]
+        return True
+
+    def add(self, ids: Iterable[str]) -> None:
+        with self._lock:
+            for id in ids:
+                if self._bloom is not None:
+                    self._bloom.add(id)
+                if self._added_during_build is not None:
+                    self._added_during_build.append(id)
+                self._negative.pop(id, None)
+
+    def missing(self, id: str) -> None:
+        """Records that a lookup the filter let through found nothing."""
+        if self._bloom is None:
+            return
+        self.false_positives += 1
+        self._remember_missing([id])
+
+    def discard(self, ids: Iterable[str]) -> None:
+        """Records deleted ids; they stay in the filter until the next rebuild."""
+        ids = list(ids)
+        self.deleted += len(ids)
+        self._remember_missing(ids)
+
+    def _remember_missing(self, ids: list[str]) -> None:
+        if self.negative_size <= 0:
+            return
+        expires_at = self._clock() + self.negative_ttl
+        with self._lock:
+            for id in ids:
+                self._negative[id] = expires_at
+                self._negative.move_to_end(id)
+            while len(self._negative) > self.negative_size:
+                self._negative.popitem(last=False)
+
+    def refresh(self) -> None:
+        bloom = self._bloom
+        if (
+            bloom is None
+            or bloom.count > bloom.capacity
+            or self._clock() - self._built_at >= self.rebuild_interval
+        ):
+            self.rebuild()
+        else:
+            self.catch_up()
+
+    def rebuild(self) -> None:
+        """Builds a new filter from a streaming scan of every id and swaps it in."""
+        start = time.perf_counter()
+        with self._lock:
+            self._added_during_build = []
+        try:
+            with self.engine.connect() as connection:
+                # created_at is stamped by the database clock, so is the watermark
+                scan_started = connection.scalar(select(db_now()))
+                rows = connection.scalar(
+                    select(func.count()).select_from(ResourceEntity)
+                )
+                bloom = BloomFilter(max(self.capacity, 2 * rows), self.fp_rate)
+                result = connection.execution_options(
+                    yield_per=_SCAN_BATCH_SIZE
+                ).execute(select(ResourceEntity.id))
+                for (id,) in result:
+                    bloom.add(id)
+            with self._lock:
+                for id in self._added_during_build:
+                    bloom.add(id)
+                self._bloom = bloom
+                self._watermark = scan_started
+                self._built_at = self._clock()
+                self.deleted = 0
+        finally:
+            with self._lock:
+                self._added_during_build = None
+        logger.info(
+            "Built id filter of %s ids, %s bytes, in %.2fs",
+            bloom.count,
+            bloom.nbytes,
+            time.perf_counter() - start,
+        )
+
+    def catch_up(self) -> int:
+        """Adds the ids created since the last scan, by any worker."""
+        since = self._watermark - _WATERMARK_SLACK
+        with self.engine.connect() as connection:
+            started = connection.scalar(select(db_now()))
+            ids = list(
+                connection.scalars(
+                    select(ResourceEntity.id).where(ResourceEntity.created_at >= since)
+                )
+            )
+        with self._lock:
+            for id in ids:
+                if id not in self._bloom:
+                    self._bloom.add(id)
+            self._watermark = started
+        return len(ids)
+
+    def stats(self) -> dict[str, float | int]:
+        bloom = self._bloom
+        stats: dict[str, float | int] = {
+            "ready": int(bloom is not None),
+            "rejections": self.rejections,
+            "negative_hits": self.negative_hits,
+            "negative_size": len(self._negative),
+            "false_positives": self.false_positives,
+            "deleted_since_build": self.deleted,
+        }
+        if bloom is not None:
+            stats.update(
+                ids=bloom.count,
+                capacity=bloom.capacity,
+                bytes=bloom.nbytes,
+                hashes=bloom.hashes,
+                target_fp_rate=bloom.fp_rate,
+                expected_fp_rate=bloom.false_positive_rate(),
+            )
+        return stats
@@ -0,0 +1,283 @@
+# Pluggable generation of short resource ids
+#
+# ID_GENERATOR        "pool" (default), "snowflake" or "random"
+# ID_POOL_SIZE        ids the pool is topped up to (default 1000)
+# ID_POOL_LOW_WATER   pool size below which it is refilled (default 250)
+# ID_POOL_ID_LENGTH   characters of a pooled id (default 7)
+# ID_POOL_RESERVATION_TTL  seconds after which a reservation is reclaimed, so
+#                     the ids of workers that died without releasing their
+#                     pool become free again (default 86400); workers stop
+#                     handing out a pooled id at half of it
+# ID_WORKER_ID        worker id of the snowflake generator, 0-1023; required
+#                     with it, and distinct for every worker of every replica
+
+import random
+import string
+import threading
+import datetime
+import time
+from collections import deque
+from typing import Callable
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import Engine, delete, select, or_
+from sqlalchemy.dialects import postgresql, sqlite
+from background import PeriodicTask
+from env import getenv
+from resource_entity import ResourceEntity, ReservedIdEntity, db_now
+
+BASE62_ALPHABET = string.digits + string.ascii_letters
+# Refills a request may wait for before the pool is given up on
+_REFILL_ATTEMPTS = 3
+
+
+class IdPoolExhaustedError(Exception):
+    """Exception raised when no id could be reserved for the pool"""
+
+    pass
+
+
+def base62_encode(value: int) -> str:
+    if value < 0:
+        raise ValueError("Only non-negative integers can be encoded")
+    if value == 0:
+        return BASE62_ALPHABET[0]
+    digits = []
+    while value:
+        value, remainder = divmod(value, 62)
+        digits.append(BASE62_ALPHABET[remainder])
+    return "".join(reversed(digits))
+
+
+class IdGenerator:
+    """Base class for resource id generators.
+
+    Generators with unique set to True never hand out an id that is already in
+    use, so callers can skip the database uniqueness probe."""
+
+    unique: bool = False
+
+    def next_id(self) -> str:
+        raise NotImplementedError
+
+    async def next_id_async(self) -> str:
+        """next_id for the event loop; generators whose next_id can wait on the
+        database run it in the threadpool."""
+        return self.next_id()
+
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+
+class RandomIdGenerator(IdGenerator):
+    """5-9 random alphanumeric characters. Callers must check for collisions."""
+
+    def next_id(self) -> str:
+        return "".join(
+            random.choices(string.ascii_letters + string.digits, k=random.randint(5, 9))
+        )
+
+
+class SnowflakeIdGenerator(IdGenerator):
+    """Base62 encoded Snowflake ids: 41 bits of milliseconds, 10 bits of worker id
+    and a 12 bit per-millisecond sequence.
+
+    Ids cannot collide as long as every worker uses a distinct worker_id."""
+
+    unique = True
+    EPOCH_MS = 1735689600000  # 2025-01-01T00:00:00Z
+    WORKER_BITS = 10
+    SEQUENCE_BITS = 12
+
+    def __init__(self, worker_id: int):
+        if not 0 <= worker_id < 1 << self.WORKER_BITS:
+            raise ValueError(
+                f"Worker id must be between 0 and {(1 << self.WORKER_BITS) - 1}"
+            )
+        self.worker_id = worker_id
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self) -> str:
+        with self._lock:
+            now_ms = max(int(time.time() * 1000) - self.EPOCH_MS, self._last_ms)
+            if now_ms == self._last_ms:
+                self._sequence = (self._sequence + 1) & ((1 << self.SEQUENCE_BITS) - 1)
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond, move on to the next one
+                    now_ms += 1
+            else:
+                self._sequence = 0
+            self._last_ms = now_ms
+            value = (
+                now_ms << (self.WORKER_BITS + self.SEQUENCE_BITS)
+                | self.worker_id << self.SEQUENCE_BITS
+                | self._sequence
+            )
+        return base62_encode(value)
+
+
+class PooledIdGenerator(IdGenerator):
+    """Hands out random ids from a pool that is reserved ahead of time.
+
+    Ids are reserved by inserting them into the id_reservations table, whose
+    primary key makes the reservation safe across workers. A background task
+    tops the pool back up to pool_size once it drops below low_water, so the
+    create path only has to pop an id.
+
+    Reservations older than reservation_ttl, by the database clock, are
+    deleted by refills: they belong to workers that died without releasing
+    them. A worker drops its own pooled ids once half of that has passed, so
+    an id it hands out is used long before it can be reserved again."""
+
+    unique = True
+
+    def __init__(
+        self,
+        engine: Engine,
+        pool_size: int = 1000,
+        low_water: int = 250,
+        length: int = 7,
+        refill_interval: float = 5.0,
+        reservation_ttl: float = 86400.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.engine = engine
+        self.pool_size = pool_size
+        self.low_water = low_water
+        self.length = length
+        self.reservation_ttl = reservation_ttl
+        self._clock = clock
+        # Pooled ids with the clock() time they were reserved at
+        self._pool: deque[tuple[str, float]] = deque()
+        self._refill_lock = threading.Lock()
+        self._task = PeriodicTask("id-pool-refill", refill_interval, self.refill)
+
+    def start(self) -> None:
+        self.refill()
+        self._task.start()
+
+    def stop(self) -> None:
+        self._task.stop()
+        self.release()
+
+    def available(self) -> int:
+        return len(self._pool)
+
+    def next_id(self) -> str:
+        """Pops a pooled id, refilling the pool first when it is empty.
+
+        Raises IdPoolExhaustedError when refills keep reserving nothing, as
+        they do once nearly every id of the configured length is taken."""
+        attempts = 0
+        while True:
+            try:
+                return self._pop()
+            except IndexError:
+                if attempts == _REFILL_ATTEMPTS:
+                    raise IdPoolExhaustedError
+                attempts += 1
+                self.refill()
+
+    async def next_id_async(self) -> str:
+        try:
+            return self._pop()
+        except IndexError:
+            # Only an empty pool waits on the database
+            return await run_in_threadpool(self.next_id)
+
+    def _pop(self) -> str:
+        # Oldest first, so stale ids are all at the front; their reservations
+        # are left to be reclaimed
+        stale = self._clock() - self.reservation_ttl / 2
+        generated_id, reserved_at = self._pool.popleft()
+        while reserved_at < stale:
+            generated_id, reserved_at = self._pool.popleft()
+        if len(self._pool) < self.low_water:
+            self._task.wake()
+        return generated_id
+
+    def refill(self) -> int:
+        with self._refill_lock:
+            missing = self.pool_size - len(self._pool)
+            if missing <= 0:
+                return 0
+            candidates = {
+                "".join(random.choices(BASE62_ALPHABET, k=self.length))
+                for _ in range(missing)
+            }
+            # Before the reservations are made, so the pool drops them first
+            reserved_at = self._clock()
+            with self.engine.begin() as connection:
+                now = connection.scalar(select(db_now()))
+                connection.execute(
+                    delete(ReservedIdEntity).where(
+                        ReservedIdEntity.reserved_at
+                        < now - datetime.timedelta(seconds=self.reservation_ttl)
+                    )
+                )
+                taken = connection.execute(
+                    select(ResourceEntity.id, ResourceEntity.vanity_url).where(
+                        or_(
+                            ResourceEntity.id.in_(candidates),
+                            ResourceEntity.vanity_url.in_(candidates),
+                        )
+                    )
+                ).all()
+                for id, vanity_url in taken:
+                    candidates.discard(id)
+                    candidates.discard(vanity_url)
+                if not candidates:
+                    return 0
+                reserved = connection.scalars(
+                    self._insert_reservations(),
+                    [{"id": id} for id in candidates],
+                ).all()
+            self._pool.extend((id, reserved_at) for id in reserved)
+            return len(reserved)
+
+    def release(self) -> None:
+        """Returns unused ids so they can be reserved again."""
+        with self._refill_lock:
+            unused = [id for id, _ in self._pool]
+            self._pool.clear()
+        if not unused:
+            return
+        with self.engine.begin() as connection:
+            connection.execute(
+                ReservedIdEntity.__table__.delete().where(
+                    ReservedIdEntity.id.in_(unused)
+                )
+            )
+
+    def _insert_reservations(self):
+        # Ids reserved concurrently by another worker are skipped, not errors
+        dialect = postgresql if self.engine.dialect.name == "postgresql" else sqlite
+        return (
+            dialect.insert(ReservedIdEntity)
+            # By the same clock the reclaim compares against
+            .values(reserved_at=db_now())
+            .on_conflict_do_nothing(index_elements=["id"])
+            .returning(ReservedIdEntity.id)
+        )
+
+
+def create_id_generator(kind: str, engine: Engine) -> IdGenerator:
+    if kind == "random":
+        return RandomIdGenerator()
+    if kind == "snowflake":
+        # No default: a worker id derived from the pid collides across
+        # replicas, and ids of colliding workers collide too
+        return SnowflakeIdGenerator(int(getenv("ID_WORKER_ID")))
+    if kind == "pool":
+        return PooledIdGenerator(
+            engine,
+            pool_size=int(getenv("ID_POOL_SIZE", "1000")),
+            low_water=int(getenv("ID_POOL_LOW_WATER", "250")),
+            length=int(getenv("ID_POOL_ID_LENGTH", "7")),
+            reservation_ttl=float(getenv("ID_POOL_RESERVATION_TTL", "86400")),
+        )
+    raise ValueError(f"Unsupported id generator: {kind}")
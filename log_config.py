@@ -0,0 +1,169 @@
+# Structured, leveled logging that never blocks the request path
+#
+# LOG_LEVEL           level of the application loggers (default INFO)
+# LOG_FORMAT          "json" (default) for one JSON document per line, or "text"
+# LOG_DB_SAMPLE_RATE  fraction of debug-level database traces kept (default 0.01)
+#
+# Records are put on an in-memory queue by a QueueHandler and written to stderr
+# by a QueueListener thread, so slow stdout/stderr never stalls a request.
+
+import contextvars
+import datetime
+import json
+import logging
+import queue
+import random
+import re
+import sys
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+from typing import Callable
+from env import getenv
+
+REQUEST_ID_HEADER = "X-Request-ID"
+# Loggers whose debug records are sampled
+DB_LOGGERS = ("database",)
+
+# Correlation id of the request being handled, "-" outside of a request
+request_id: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "request_id", default="-"
+)
+
+# Client supplied ids are echoed into logs and headers, so only accept tame ones
+_VALID_REQUEST_ID = re.compile(r"[A-Za-z0-9._-]{1,128}")
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamps records with the correlation id of the current request.
+
+    Runs on the QueueHandler, in the thread and context that logged the record."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only rate of the debug records, and every record above debug."""
+
+    def __init__(self, rate: float, random: Callable[[], float] = random.random):
+        super().__init__()
+        self.rate = rate
+        self._random = random
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or self._random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        document = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            document["exception"] = self.formatException(record.exc_info)
+        return json.dumps(document, default=str)
+
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"
+
+
+class LogPipeline:
+    """Routes the application's log records through a queue to stderr.
+
+    start() attaches a QueueHandler to the root logger and starts the listener
+    thread; stop() drains the queue and detaches the handler again."""
+
+    def __init__(
+        self,
+        level: str = "INFO",
+        format: str = "json",
+        db_sample_rate: float = 0.01,
+        handler: logging.Handler | None = None,
+    ):
+        if format not in ("json", "text"):
+            raise ValueError(f"Unsupported LOG_FORMAT: {format}")
+        self.level = logging.getLevelName(level.upper())
+        if not isinstance(self.level, int):
+            raise ValueError(f"Unsupported LOG_LEVEL: {level}")
+        self.db_sample_rate = db_sample_rate
+        self.handler = handler or logging.StreamHandler(sys.stderr)
+        if self.handler.formatter is None:
+            self.handler.setFormatter(
+                JsonFormatter() if format == "json" else logging.Formatter(TEXT_FORMAT)
+            )
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._queue_handler = QueueHandler(self._queue)
+        self._queue_handler.addFilter(RequestIdFilter())
+        self._sampling_filter = SamplingFilter(db_sample_rate)
+        self._listener: QueueListener | None = None
+        self._previous_level = logging.WARNING
+
+    def start(self) -> None:
+        if self._listener is not None:
+            return
+        self._listener = QueueListener(self._queue, self.handler)
+        self._listener.start()
+        root = logging.getLogger()
+        root.addHandler(self._queue_handler)
+        self._previous_level = root.level
+        root.setLevel(self.level)
+        for name in DB_LOGGERS:
+            logging.getLogger(name).addFilter(self._sampling_filter)
+
+    def stop(self) -> None:
+        if self._listener is None:
+            return
+        root = logging.getLogger()
+        root.removeHandler(self._queue_handler)
+        root.setLevel(self._previous_level)
+        for name in DB_LOGGERS:
+            logging.getLogger(name).removeFilter(self._sampling_filter)
+        self._listener.stop()
+        self._listener = None
+
+
+class RequestIdMiddleware:
+    """Gives every request a correlation id and echoes it in X-Request-ID.
+
+    A well-formed X-Request-ID from the client (e.g. a load balancer) is kept,
+    so one id follows the request across services."""
+
+    def __init__(self, app):
+        self.app = app
+        self._header = REQUEST_ID_HEADER.lower().encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        supplied = next(
+            (value for name, value in scope["headers"] if name == self._header), b""
+        ).decode("latin-1")
+        current = (
+            supplied if _VALID_REQUEST_ID.fullmatch(supplied) else uuid.uuid4().hex
+        )
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (self._header, current.encode("latin-1")),
+                ]
+            await send(message)
+
+        token = request_id.set(current)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id.reset(token)
+
+
+log_pipeline = LogPipeline(
+    level=getenv("LOG_LEVEL", "INFO"),
+    format=getenv("LOG_FORMAT", "json"),
+    db_sample_rate=float(getenv("LOG_DB_SAMPLE_RATE", "0.01")),
+)
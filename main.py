@@ -1,16 +1,83 @@
 """FastAPI main entrypoint file."""
 
 from pydantic import BaseModel, Field
-from fastapi import FastAPI, HTTPException, status, Query, Body, Depends
-from fastapi.responses import RedirectResponse
-from typing import Annotated, Union
+from fastapi import (
+    FastAPI,
+    HTTPException,
+    status,
+    Query,
+    Body,
+    Depends,
+    Header,
+    Request,
+)
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    StreamingResponse,
+)
+from typing import Annotated, Literal, Union
 from datetime import datetime
-from models import Resource, Type
-from services import ResourceServices, ResourceAlreadyExistsError, ResourceNotFoundError
+from models import BulkCreateResult, Resource, Type
+from query_builder import ExpiryState, InvalidFilterError, OrderColumn, ResourceQuery
+from services import (
+    ResourceServices,
+    ResourceAlreadyExistsError,
+    ResourceNotFoundError,
+    ResourceExpiredError,
+    InvalidCursorError,
+    ndjson_lines,
+)
+from content_store import ContentTooLargeError
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
+from database_startup import (
+    access_counter,
+    blob_sweeper,
+    bulk_deleter,
+    expiry_reaper,
+    id_filter,
+    id_generator,
+    pool_metrics,
+)
+from log_config import RequestIdMiddleware, log_pipeline
+from rate_limit import RateLimitMiddleware, rate_limiter
+from metrics import MetricsMiddleware, registry
+from hot_keys import HotResponseMiddleware, hot_responses
+from id_generator import IdPoolExhaustedError
+from file_store import BlobFileMissingError
+import json
+import logging
 import sqlite3
 
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    log_pipeline.start()
+    access_counter.start()
+    id_generator.start()
+    expiry_reaper.start()
+    if id_filter is not None:
+        id_filter.start()
+    if blob_sweeper is not None:
+        blob_sweeper.start()
+    yield
+    if blob_sweeper is not None:
+        blob_sweeper.stop()
+    if id_filter is not None:
+        id_filter.stop()
+    expiry_reaper.stop()
+    # Persist any buffered access counts before the worker exits
+    access_counter.stop()
+    id_generator.stop()
+    log_pipeline.stop()
+
+
 app = FastAPI(
+    lifespan=lifespan,
     title="EX01 API Design",
     contact={
         "name": "Daniel Zhang",
@@ -38,6 +105,14 @@ Auth
         },
     ],
 )
+# Serve the redirects of the hottest links without routing them; innermost,
+# so they are still rate limited, counted and tagged
+app.add_middleware(
+    HotResponseMiddleware, cache=hot_responses, access_counter=access_counter
+)
+# Refuse clients over their rate limit before any route or database work;
+# inside CORS so browsers can read the 429
+app.add_middleware(RateLimitMiddleware, limiter=rate_limiter)
 # Add CORS middleware to allow requests from any origin
 origins = ["*"]
 app.add_middleware(
@@ -45,7 +120,32 @@ app.add_middleware(
     allow_origins=["*"],  # Allows all origins
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Next-Cursor", "X-Request-ID", "Retry-After"],
 )
+# Tag every request and its log records with a correlation id
+app.add_middleware(RequestIdMiddleware)
+# Outermost, so the latency includes every other middleware and 429s count
+app.add_middleware(MetricsMiddleware)
+
+
+@app.exception_handler(IdPoolExhaustedError)
+async def id_pool_exhausted(request: Request, error: IdPoolExhaustedError):
+    # Raised by any create that generates an id
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "No resource id available, try again later"},
+    )
+
+
+@app.exception_handler(BlobFileMissingError)
+async def blob_file_missing(request: Request, error: BlobFileMissingError):
+    # The resource exists but this replica cannot read its content, see
+    # file_store: not a client error, and likely to need an operator
+    logger.error("Content file missing for %s: %s", request.url.path, error)
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Resource content is unavailable"},
+    )
 
 
 # Sue Share
@@ -61,7 +161,7 @@ app.add_middleware(
     },
     tags=["Sue"],
 )
-def create_resource_text(
+async def create_resource_text(
     resource: Annotated[
         Resource,
         Body(
@@ -113,9 +213,59 @@ def create_resource_text(
     resource_service: ResourceServices = Depends(),
 ) -> Resource:
     try:
-        return resource_service.create_resource_text(resource)
+        return await resource_service.create_resource_text(resource)
+    except ResourceAlreadyExistsError:
+        raise HTTPException(status_code=400, detail="Resource already exists")
+
+
+# Post for text sharer, with the text streamed as the raw request body
+@app.post(
+    "/create-text/raw",
+    summary="Uploading a Large Text Snippet",
+    description="This endpoint will receive a text snippet as the raw UTF-8 request body, stream it to storage without buffering it in memory, and return the resource like /create-text, with its content left empty. Bodies larger than UPLOAD_MAX_BYTES are refused with 413, before any of the body is read when Content-Length gives the size.",
+    status_code=status.HTTP_201_CREATED,
+    responses={
+        201: {"description": "Resource created successfully."},
+        400: {"description": "Resource already exists or body is not UTF-8."},
+        413: {"description": "Body is larger than the maximum size."},
+    },
+    openapi_extra={
+        "requestBody": {
+            "content": {"text/plain": {"schema": {"type": "string"}}},
+            "required": True,
+        }
+    },
+    tags=["Sue"],
+)
+async def create_resource_text_raw(
+    request: Request,
+    vanity_url: Annotated[
+        str | None, Query(description="The vanity path URL for the text snippet")
+    ] = None,
+    expiration_time: Annotated[
+        Union[int, datetime],
+        Query(description="Expiration date and time, or hours until expiration"),
+    ] = -1,
+    content_length: Annotated[int | None, Header()] = None,
+    resource_service: ResourceServices = Depends(),
+) -> Resource:
+    resource = Resource(
+        id="",
+        content="",
+        vanity_url=vanity_url,
+        type=Type.text,
+        expiration_time=expiration_time,
+    )
+    try:
+        return await resource_service.create_resource_text_stream(
+            resource, request.stream(), content_length
+        )
     except ResourceAlreadyExistsError:
         raise HTTPException(status_code=400, detail="Resource already exists")
+    except ContentTooLargeError:
+        raise HTTPException(status_code=413, detail="Content too large")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Body is not valid UTF-8")
 
 
 # Post for link shortner
@@ -126,7 +276,7 @@ def create_resource_text(
     status_code=status.HTTP_201_CREATED,
     tags=["Sue"],
 )
-def create_resource_link(
+async def create_resource_link(
     resource: Annotated[
         Resource,
         Body(
@@ -158,11 +308,51 @@ def create_resource_link(
     resource_service: ResourceServices = Depends(),
 ):
     try:
-        return resource_service.create_resource_url(resource)
+        return await resource_service.create_resource_url(resource)
     except ResourceAlreadyExistsError:
         raise HTTPException(status_code=400, detail="Resource already exists")
 
 
+# Post for importing many text snippets and links at once
+@app.post(
+    "/bulk/create",
+    summary="Posting Resources in Bulk",
+    description="This endpoint will receive a JSON array, or an NDJSON stream (Content-Type: application/x-ndjson) of resources, create every valid one and return a result per item in submission order. Items are typed by their own type field; vanity URLs and ids follow the same rules as the single-item endpoints.",
+    responses={
+        200: {"description": "Per-item results: created, conflict or invalid."},
+        400: {"description": "Body is not a JSON array."},
+    },
+    openapi_extra={
+        "requestBody": {
+            "content": {
+                "application/json": {
+                    "schema": {
+                        "type": "array",
+                        "items": {"$ref": "#/components/schemas/Resource"},
+                    }
+                },
+                "application/x-ndjson": {"schema": {"type": "string"}},
+            },
+            "required": True,
+        }
+    },
+    tags=["Sue"],
+)
+async def create_resources_bulk(
+    request: Request, resource_service: ResourceServices = Depends()
+) -> list[BulkCreateResult]:
+    # NDJSON is parsed line by line as it arrives, a JSON array all at once
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        return await resource_service.create_resources(ndjson_lines(request.stream()))
+    try:
+        items = json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body is not valid JSON")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Body is not a JSON array")
+    return await resource_service.create_resources(items)
+
+
 # Cai Clicker
 
 
@@ -170,18 +360,31 @@ def create_resource_link(
 @app.get(
     "/{resource_id}",
     summary="Identifies and return resource content.",
-    description="This endpoint will identify which resource this resource identifier points to (link or text), then returns the resource content.",
+    description="This endpoint will identify which resource this resource identifier points to (link or text), then returns the resource content. Text snippets carry an ETag and answer a matching If-None-Match with 304; large snippets stored gzip-compressed are sent with Content-Encoding: gzip as stored when the client accepts it. Links redirect with 307, or with a cacheable 308/301 when REDIRECT_MODE is permanent/moved. Requests answered from a browser or CDN cache are not counted as accesses.",
     responses={
+        301: {"description": "Resource is a link, cacheable permanent redirect."},
+        304: {"description": "Text snippet is unchanged since the given ETag."},
         307: {"description": "Resource is a link, redirecting to target."},
+        308: {"description": "Resource is a link, cacheable permanent redirect."},
         404: {"description": "Resource not found"},
+        410: {"description": "Resource has expired"},
     },
     tags=["Cai"],
 )
-def get_resource(resource_id: str, resource_service: ResourceServices = Depends()):
+async def get_resource(
+    resource_id: str,
+    if_none_match: Annotated[str | None, Header()] = None,
+    accept_encoding: Annotated[str | None, Header()] = None,
+    resource_service: ResourceServices = Depends(),
+):
     try:
-        return resource_service.get_resource(resource_id)
+        return await resource_service.get_resource(
+            resource_id, if_none_match, accept_encoding
+        )
     except ResourceNotFoundError:
         raise HTTPException(status_code=404, detail="Resource not found")
+    except ResourceExpiredError:
+        raise HTTPException(status_code=410, detail="Resource has expired")
 
 
 # Amy Admin
@@ -192,10 +395,17 @@ def get_resource(resource_id: str, resource_service: ResourceServices = Depends(
     "/admin/resources",
     tags=["Amy"],
     summary="Get all active resources",
-    description="This endpoint will return all active resources, both shortened-links and text-snippets.",
-    responses={404: {"description": "Resources not found"}},
+    description="This endpoint will return all active resources, both shortened-links and text-snippets. All filters are combined into a single query. Pass limit and the X-Next-Cursor header of the previous page as after to page through large tables, or format=ndjson or format=csv to stream every matching resource, e.g. for backups.",
+    responses={
+        200: {
+            "content": {"application/x-ndjson": {}, "text/csv": {}},
+            "description": "Resources, one JSON document per line when format is ndjson, one row per resource when format is csv.",
+        },
+        400: {"description": "Unsupported filter or invalid pagination cursor"},
+        404: {"description": "Resources not found"},
+    },
 )
-def get_resources(
+async def get_resources(
     type: Annotated[
         Type | None,
         Query(description="Filter by type", examples=["text-snippet", "short-link"]),
@@ -207,9 +417,92 @@ def get_resources(
         int | None,
         Query(description="Value to sort by with sort operator", examples=[0, 1, 50]),
     ] = None,
+    content_length_operator: Annotated[
+        str | None,
+        Query(description="Content length comparison operator", examples=["<", ">="]),
+    ] = None,
+    content_length_value: Annotated[
+        int | None,
+        Query(description="Content length to compare against", examples=[1000]),
+    ] = None,
+    expiry: Annotated[
+        ExpiryState | None,
+        Query(description="Only active, expired or never-expiring resources"),
+    ] = None,
+    id_prefix: Annotated[
+        str | None, Query(description="Only resources whose id starts with this")
+    ] = None,
+    created_after: Annotated[
+        datetime | None,
+        Query(description="Only resources created at or after this time"),
+    ] = None,
+    created_before: Annotated[
+        datetime | None,
+        Query(description="Only resources created before this time"),
+    ] = None,
+    order_by: Annotated[
+        OrderColumn, Query(description="Column to order the resources by")
+    ] = "id",
+    descending: Annotated[
+        bool, Query(description="Order from highest to lowest")
+    ] = False,
+    limit: Annotated[
+        int | None,
+        Query(description="Maximum number of resources per page", ge=1, le=1000),
+    ] = None,
+    after: Annotated[
+        str | None,
+        Query(description="Cursor from the X-Next-Cursor header of the previous page"),
+    ] = None,
+    format: Annotated[
+        Literal["json", "ndjson", "csv"],
+        Query(
+            description="Response format, ndjson and csv stream every matching resource"
+        ),
+    ] = "json",
     resource_service: ResourceServices = Depends(),
 ) -> list[Resource]:
-    return resource_service.get_all_resources(type, sort_operator, sort_value)
+    try:
+        query = ResourceQuery(
+            resource_type=type,
+            access_count=(
+                (sort_operator, sort_value)
+                if sort_operator is not None and sort_value is not None
+                else None
+            ),
+            content_length=(
+                (content_length_operator, content_length_value)
+                if content_length_operator is not None
+                and content_length_value is not None
+                else None
+            ),
+            expiry=expiry,
+            id_prefix=id_prefix,
+            created_after=created_after,
+            created_before=created_before,
+            order_by=order_by,
+            descending=descending,
+            limit=limit,
+        )
+        if format == "ndjson":
+            return StreamingResponse(
+                resource_service.stream_resources(query, after),
+                media_type="application/x-ndjson",
+            )
+        if format == "csv":
+            return StreamingResponse(
+                resource_service.stream_resources(query, after, format="csv"),
+                media_type="text/csv",
+                headers={"Content-Disposition": "attachment; filename=resources.csv"},
+            )
+        # Encoded from rows by the service; the return type documents them
+        if limit is None and after is None:
+            return await resource_service.get_all_resources(query)
+        return await resource_service.get_resources_page(query, after)
+    except InvalidFilterError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    except InvalidCursorError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 
 # Get for how often a resource has been accessed
@@ -222,11 +515,11 @@ def get_resources(
         404: {"description": "Resource not found"},
     },
 )
-def get_resource_access_count(
+async def get_resource_access_count(
     resource_id: str, resource_service: ResourceServices = Depends()
 ) -> int:
     try:
-        return resource_service.get_resource_access_count(resource_id)
+        return await resource_service.get_resource_access_count(resource_id)
     except ResourceNotFoundError:
         raise HTTPException(status_code=404, detail="Resource not found")
 
@@ -243,7 +536,7 @@ def get_resource_access_count(
         404: {"description": "Resource not found"},
     },
 )
-def update_resource(
+async def update_resource(
     resource_id: str,
     new_content: Annotated[
         str,
@@ -264,11 +557,76 @@ def update_resource(
     resource_service: ResourceServices = Depends(),
 ):
     try:
-        return resource_service.update_resource(resource_id, new_content)
+        return await resource_service.update_resource(resource_id, new_content)
     except ResourceNotFoundError:
         raise HTTPException(status_code=404, detail="Resource not found")
 
 
+# Post for deleting every resource matching a filter
+@app.post(
+    "/admin/resources/delete",
+    tags=["Amy"],
+    summary="Delete resources matching a filter",
+    description="This endpoint will start deleting every resource matching all of the given filters in small batches in the background, and return the job to poll for progress. At least one filter is required.",
+    status_code=status.HTTP_202_ACCEPTED,
+    responses={
+        202: {"description": "Delete started."},
+        400: {"description": "No or unsupported filter"},
+    },
+)
+async def delete_resources_matching(
+    type: Annotated[Type | None, Query(description="Only this type")] = None,
+    expiry: Annotated[
+        ExpiryState | None,
+        Query(description="Only active, expired or never-expiring resources"),
+    ] = None,
+    id_prefix: Annotated[
+        str | None, Query(description="Only resources whose id starts with this")
+    ] = None,
+    min_access_count: Annotated[
+        int | None, Query(description="Only resources accessed at least this often")
+    ] = None,
+    max_access_count: Annotated[
+        int | None, Query(description="Only resources accessed at most this often")
+    ] = None,
+    created_before: Annotated[
+        datetime | None,
+        Query(description="Only resources created before this time"),
+    ] = None,
+) -> dict[str, int | str | None]:
+    try:
+        job = bulk_deleter.submit(
+            ResourceQuery(
+                resource_type=type,
+                expiry=expiry,
+                id_prefix=id_prefix,
+                min_access_count=min_access_count,
+                max_access_count=max_access_count,
+                created_before=created_before,
+            )
+        )
+    except InvalidFilterError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    return job.stats()
+
+
+# Get progress of a delete started by filter
+@app.get(
+    "/admin/resources/delete/{job_id}",
+    tags=["Amy"],
+    summary="Get progress of a filtered delete",
+    description="This endpoint will return how many resources a filtered delete has removed so far, and whether it is done.",
+    responses={
+        404: {"description": "Delete job not found"},
+    },
+)
+async def get_delete_progress(job_id: str) -> dict[str, int | str | None]:
+    job = bulk_deleter.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Delete job not found")
+    return job.stats()
+
+
 # Delete for removing all resources
 @app.delete(
     "/admin/resources/all",
@@ -279,8 +637,8 @@ def update_resource(
         204: {"description": "All resources deleted successfully."},
     },
 )
-def delete_all_resources(resource_service: ResourceServices = Depends()) -> bool:
-    return resource_service.delete_all_resources()
+async def delete_all_resources(resource_service: ResourceServices = Depends()) -> bool:
+    return await resource_service.delete_all_resources()
 
 
 # Delete for removing a resource
@@ -294,10 +652,83 @@ def delete_all_resources(resource_service: ResourceServices = Depends()) -> bool
         404: {"description": "Resource not found."},
     },
 )
-def delete_resource(
+async def delete_resource(
     resource_id: str, resource_service: ResourceServices = Depends()
 ) -> Resource:
     try:
-        return resource_service.delete_resource(resource_id)
+        return await resource_service.delete_resource(resource_id)
     except ResourceNotFoundError:
         raise HTTPException(status_code=404, detail="Resource not found")
+
+
+# Get resource cache statistics
+@app.get(
+    "/admin/cache",
+    tags=["Amy"],
+    summary="Get resource cache statistics",
+    description="This endpoint will return the size and hit/miss/eviction counters of the in-process resource cache.",
+)
+async def get_cache_stats(
+    resource_service: ResourceServices = Depends(),
+) -> dict[str, int]:
+    return resource_service.get_cache_stats()
+
+
+# Get database connection pool statistics
+@app.get(
+    "/admin/metrics/pool",
+    tags=["Amy"],
+    summary="Get database connection pool statistics",
+    description="This endpoint will return the checked-out, overflow and checkout wait statistics of the database connection pools.",
+)
+async def get_pool_metrics() -> dict[str, dict[str, float | str]]:
+    return pool_metrics()
+
+
+# Get the most requested resources
+@app.get(
+    "/admin/hot-keys",
+    tags=["Amy"],
+    summary="Get the most requested resources",
+    description="This endpoint will return the ids currently in the hot set with their estimated request counts (halved periodically, so recent traffic weighs most), whether a precomputed redirect is pinned for them, and how many requests pinned redirects have answered.",
+)
+async def get_hot_keys() -> (
+    dict[str, list[dict[str, str | int | bool]] | dict[str, int]]
+):
+    return {"hot": hot_responses.hot_set(), "stats": hot_responses.stats()}
+
+
+# Get expiry reaper statistics
+@app.get(
+    "/admin/metrics/expiry",
+    tags=["Amy"],
+    summary="Get expiry reaper statistics",
+    description="This endpoint will return how many expired resources have been deleted and how far behind the reaper is.",
+)
+async def get_expiry_metrics() -> dict[str, float | str | None]:
+    return expiry_reaper.stats()
+
+
+# Get id filter statistics
+@app.get(
+    "/admin/metrics/id-filter",
+    tags=["Amy"],
+    summary="Get id filter statistics",
+    description="This endpoint will return the size, memory footprint and expected false positive rate of the filter answering unknown ids without a database query, and how many lookups it and the negative cache answered. Empty when the filter is off.",
+)
+async def get_id_filter_metrics() -> dict[str, float | int]:
+    return id_filter.stats() if id_filter is not None else {}
+
+
+# Get Prometheus metrics
+@app.get(
+    "/admin/metrics/prometheus",
+    tags=["Amy"],
+    summary="Get Prometheus metrics",
+    description="This endpoint will return request latency, status and database statement metrics per route, service call timings and cache, pool and expiry statistics in the Prometheus text format.",
+    response_class=PlainTextResponse,
+)
+async def get_metrics() -> PlainTextResponse:
+    return PlainTextResponse(
+        registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
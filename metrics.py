@@ -0,0 +1,274 @@
+# Prometheus metrics of requests, database statements and service calls
+#
+# GET /admin/metrics/prometheus renders everything in registry in the Prometheus text format:
+#   http_requests_total                   requests by route template, method
+#                                         and status code
+#   http_request_duration_seconds         request latency histogram by route
+#   http_request_db_statements            statements a request issued
+#   http_request_db_seconds               time a request spent in statements
+#   db_statements_total                   every statement, background work
+#   db_statement_duration_seconds         included
+#   service_call_duration_seconds         ResourceServices methods, see timed
+# plus the gauges of collectors registered by the components that keep stats
+# (resource cache, connection pools, expiry reaper).
+#
+# Statements are attributed to the request whose context they run in, so
+# queries from the access counter, reaper and other background threads only
+# show up in the db_statements totals.
+
+import bisect
+import functools
+import inspect
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Callable, Iterator
+from sqlalchemy import Engine, event
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50)
+
+
+def _labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{_labels(self.labels, labels)} {_number(value)}"
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> (count per bucket plus one above every bound, [sum])
+        self._values: dict[tuple, tuple[list[int], list[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                labels, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    def count(self, *labels) -> int:
+        entry = self._values.get(labels)
+        return sum(entry[0]) if entry else 0
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = [
+                (labels, list(counts), total[0])
+                for labels, (counts, total) in self._values.items()
+            ]
+        names = (*self.labels, "le")
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else _number(bound)
+                yield f"{self.name}_bucket{_labels(names, (*labels, le))} {cumulative}"
+            plain = _labels(self.labels, labels)
+            yield f"{self.name}_sum{plain} {_number(total)}"
+            yield f"{self.name}_count{plain} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Counter | Histogram] = []
+        self.collectors: list[tuple[str, Callable[[], dict], dict[str, str]]] = []
+
+    def counter(self, *args, **kwargs) -> Counter:
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def gauges(self, prefix: str, stats: Callable[[], dict], **labels: str) -> None:
+        """Exposes the numeric values of a stats() dict as prefix_<key> gauges,
+        read at every scrape."""
+        self.collectors.append((prefix, stats, labels))
+
+    def render(self) -> str:
+        lines = [line for metric in self.metrics for line in metric.render()]
+        gauges: dict[str, list[str]] = {}
+        for prefix, stats, labels in self.collectors:
+            for key, value in stats().items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{prefix}_{key}"
+                label = _labels(tuple(labels), tuple(labels.values()))
+                gauges.setdefault(name, []).append(f"{name}{label} {_number(value)}")
+        for name, samples in gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "http_requests_total", "HTTP requests", ("route", "method", "status")
+)
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("route", "method")
+)
+http_request_db_statements = registry.histogram(
+    "http_request_db_statements",
+    "Database statements per HTTP request",
+    ("route", "method"),
+    buckets=STATEMENT_BUCKETS,
+)
+http_request_db_seconds = registry.histogram(
+    "http_request_db_seconds",
+    "Time per HTTP request spent executing database statements",
+    ("route", "method"),
+)
+db_statements = registry.counter("db_statements_total", "Database statements")
+db_statement_duration = registry.histogram(
+    "db_statement_duration_seconds", "Database statement latency"
+)
+service_call_duration = registry.histogram(
+    "service_call_duration_seconds", "ResourceServices method latency", ("method",)
+)
+
+
+@dataclass
+class QueryStats:
+    statements: int = 0
+    seconds: float = 0.0
+
+
+# Statements of the current request, None outside requests
+request_queries: ContextVar[QueryStats | None] = ContextVar(
+    "request_queries", default=None
+)
+
+
+def instrument_engine(engine: Engine) -> None:
+    """Counts and times every statement engine executes."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        if context is not None:
+            context._metrics_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        start = getattr(context, "_metrics_start", None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        db_statements.inc()
+        db_statement_duration.observe(elapsed)
+        stats = request_queries.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.seconds += elapsed
+
+
+def timed(cls: type) -> type:
+    """Class decorator recording the duration of every public coroutine method
+    in service_call_duration."""
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.iscoroutinefunction(method):
+            continue
+        setattr(cls, name, _timed_method(method))
+    return cls
+
+
+def _timed_method(method):
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            service_call_duration.observe(time.perf_counter() - start, method.__name__)
+
+    return wrapper
+
+
+class MetricsMiddleware:
+    """Records every request's latency, status and database statements under
+    its route template, e.g. /{resource_id}, so ids do not become labels."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = 500
+        stats = QueryStats()
+        token = request_queries.set(stats)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            request_queries.reset(token)
+            route = scope.get("route")
+            labels = (route.path if route is not None else "unmatched", scope["method"])
+            http_requests.inc(*labels, status)
+            http_request_duration.observe(elapsed, *labels)
+            http_request_db_statements.observe(stats.statements, *labels)
+            http_request_db_seconds.observe(stats.seconds, *labels)
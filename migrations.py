@@ -0,0 +1,414 @@
+# Versioned schema migrations, applied on startup in place of create_all
+#
+# Every migration declares the schema it creates itself instead of reading the
+# current ORM models, so replaying old migrations against a new database always
+# produces the same schema as upgrading an existing one.
+
+import datetime
+import hashlib
+import logging
+from dataclasses import dataclass
+from typing import Callable
+from sqlalchemy import (
+    Column,
+    Connection,
+    DateTime,
+    Engine,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    inspect,
+    select,
+    text,
+)
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for the Postgres advisory lock held while migrating
+_ADVISORY_LOCK_KEY = 71_260_531
+_BACKFILL_BATCH_SIZE = 1000
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+
+
+_version_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    _version_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+def _create_initial_tables(connection: Connection) -> None:
+    # Matches the schema previously created by Base.metadata.create_all, so
+    # existing databases are adopted as version 1 without changes
+    metadata = MetaData()
+    Table(
+        "resources",
+        metadata,
+        Column("id", String, primary_key=True, unique=True),
+        Column("content", String, nullable=False),
+        Column("vanity_url", String, nullable=True),
+        Column("type", String, nullable=False),
+        Column("expiration_time", String, nullable=True),
+        Column("access_count", Integer),
+    )
+    Table(
+        "id_reservations",
+        metadata,
+        Column("id", String, primary_key=True),
+        Column("reserved_at", DateTime, nullable=False),
+    )
+    metadata.create_all(connection, checkfirst=True)
+
+
+def _parse_expiration_time(value: str | None) -> datetime.datetime | None:
+    # expiration_time holds either a datetime string or an hour count such as -1
+    if value is None:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def _index_resources(connection: Connection) -> None:
+    if "expires_at" not in {
+        column["name"] for column in inspect(connection).get_columns("resources")
+    }:
+        connection.execute(
+            text("ALTER TABLE resources ADD COLUMN expires_at TIMESTAMP")
+        )
+
+    # Data migration: "no vanity url" was stored as an empty or blank string,
+    # which would collide under a unique index
+    connection.execute(
+        text("UPDATE resources SET vanity_url = NULL WHERE TRIM(vanity_url) = ''")
+    )
+    # Keep a duplicated vanity url only on the resource it was used as id for
+    connection.execute(
+        text(
+            "UPDATE resources SET vanity_url = NULL WHERE id <> vanity_url AND "
+            "vanity_url IN (SELECT vanity_url FROM resources "
+            "GROUP BY vanity_url HAVING COUNT(*) > 1)"
+        )
+    )
+
+    # Data migration: backfill expires_at from the string column in batches
+    last_id = ""
+    while True:
+        rows = connection.execute(
+            text(
+                "SELECT id, expiration_time FROM resources "
+                "WHERE id > :last_id AND expiration_time IS NOT NULL "
+                "ORDER BY id LIMIT :limit"
+            ),
+            {"last_id": last_id, "limit": _BACKFILL_BATCH_SIZE},
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        updates = [
+            {"id": row.id, "expires_at": expires_at}
+            for row in rows
+            if (expires_at := _parse_expiration_time(row.expiration_time)) is not None
+        ]
+        if updates:
+            connection.execute(
+                text("UPDATE resources SET expires_at = :expires_at WHERE id = :id"),
+                updates,
+            )
+
+    connection.execute(
+        text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_resources_vanity_url "
+            "ON resources (vanity_url)"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_resources_type_access_count "
+            "ON resources (type, access_count)"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_resources_expires_at "
+            "ON resources (expires_at)"
+        )
+    )
+
+
+def _add_listing_columns(connection: Connection) -> None:
+    columns = {
+        column["name"] for column in inspect(connection).get_columns("resources")
+    }
+    if "created_at" not in columns:
+        connection.execute(
+            text("ALTER TABLE resources ADD COLUMN created_at TIMESTAMP")
+        )
+    if "content_length" not in columns:
+        connection.execute(
+            text("ALTER TABLE resources ADD COLUMN content_length INTEGER")
+        )
+
+    # Data migration: creation times were never recorded, so existing rows are
+    # stamped with the migration time
+    connection.execute(
+        text("UPDATE resources SET created_at = :now WHERE created_at IS NULL"),
+        {"now": datetime.datetime.now()},
+    )
+    connection.execute(
+        text(
+            "UPDATE resources SET content_length = LENGTH(content) "
+            "WHERE content_length IS NULL"
+        )
+    )
+    connection.execute(
+        text("UPDATE resources SET access_count = 0 WHERE access_count IS NULL")
+    )
+    connection.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_resources_created_at "
+            "ON resources (created_at)"
+        )
+    )
+
+
+def _add_version(connection: Connection) -> None:
+    if "version" not in {
+        column["name"] for column in inspect(connection).get_columns("resources")
+    }:
+        # The default backfills existing rows as version 1
+        connection.execute(
+            text("ALTER TABLE resources ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+        )
+
+
+def _deduplicate_content(connection: Connection) -> None:
+    metadata = MetaData()
+    content_blobs = Table(
+        "content_blobs",
+        metadata,
+        Column("hash", String, primary_key=True),
+        Column("content", String, nullable=False),
+        Column("size", Integer, nullable=False),
+        Column("refcount", Integer, nullable=False),
+    )
+    metadata.create_all(connection, checkfirst=True)
+
+    # Text snippets no longer store content inline, so it becomes nullable
+    if connection.dialect.name == "sqlite":
+        # SQLite cannot alter a column, so the table is rebuilt
+        columns = (
+            "id, content, vanity_url, type, expiration_time, access_count, "
+            "expires_at, created_at, content_length, version"
+        )
+        connection.execute(
+            text(
+                "CREATE TABLE resources_new (id VARCHAR NOT NULL PRIMARY KEY, "
+                "content VARCHAR, vanity_url VARCHAR, type VARCHAR NOT NULL, "
+                "expiration_time VARCHAR, access_count INTEGER, "
+                "expires_at TIMESTAMP, created_at TIMESTAMP, "
+                "content_length INTEGER, version INTEGER NOT NULL DEFAULT 1, "
+                "content_hash VARCHAR)"
+            )
+        )
+        connection.execute(
+            text(
+                f"INSERT INTO resources_new ({columns}) "
+                f"SELECT {columns} FROM resources"
+            )
+        )
+        connection.execute(text("DROP TABLE resources"))
+        connection.execute(text("ALTER TABLE resources_new RENAME TO resources"))
+        for statement in (
+            "CREATE UNIQUE INDEX ix_resources_vanity_url ON resources (vanity_url)",
+            "CREATE INDEX ix_resources_type_access_count "
+            "ON resources (type, access_count)",
+            "CREATE INDEX ix_resources_expires_at ON resources (expires_at)",
+            "CREATE INDEX ix_resources_created_at ON resources (created_at)",
+        ):
+            connection.execute(text(statement))
+    else:
+        connection.execute(
+            text("ALTER TABLE resources ALTER COLUMN content DROP NOT NULL")
+        )
+        connection.execute(
+            text("ALTER TABLE resources ADD COLUMN IF NOT EXISTS content_hash VARCHAR")
+        )
+    connection.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_resources_content_hash "
+            "ON resources (content_hash)"
+        )
+    )
+
+    # Data migration: move text snippet content into blobs in batches
+    last_id = ""
+    while True:
+        rows = connection.execute(
+            text(
+                "SELECT id, content FROM resources "
+                "WHERE id > :last_id AND type = 'text' AND content_hash IS NULL "
+                "ORDER BY id LIMIT :limit"
+            ),
+            {"last_id": last_id, "limit": _BACKFILL_BATCH_SIZE},
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        blobs: dict[str, dict] = {}
+        updates = []
+        for row in rows:
+            hash = hashlib.blake2b(row.content.encode(), digest_size=32).hexdigest()
+            blob = blobs.setdefault(
+                hash,
+                {"hash": hash, "content": row.content, "size": len(row.content)},
+            )
+            blob["refcount"] = blob.get("refcount", 0) + 1
+            updates.append({"id": row.id, "content_hash": hash})
+        existing = set(
+            connection.scalars(
+                select(content_blobs.c.hash).where(content_blobs.c.hash.in_(blobs))
+            )
+        )
+        new_blobs = [blob for hash, blob in blobs.items() if hash not in existing]
+        if new_blobs:
+            connection.execute(content_blobs.insert(), new_blobs)
+        if existing:
+            connection.execute(
+                text(
+                    "UPDATE content_blobs SET refcount = refcount + :refcount "
+                    "WHERE hash = :hash"
+                ),
+                [blobs[hash] for hash in existing],
+            )
+        connection.execute(
+            text(
+                "UPDATE resources SET content_hash = :content_hash, content = NULL "
+                "WHERE id = :id"
+            ),
+            updates,
+        )
+
+
+def _add_blob_compression(connection: Connection) -> None:
+    # Compressed blobs keep data and codec instead of content
+    if connection.dialect.name == "sqlite":
+        # SQLite cannot alter a column, so the table is rebuilt
+        connection.execute(
+            text(
+                "CREATE TABLE content_blobs_new (hash VARCHAR NOT NULL PRIMARY KEY, "
+                "content VARCHAR, data BLOB, codec VARCHAR, size INTEGER NOT NULL, "
+                "refcount INTEGER NOT NULL)"
+            )
+        )
+        connection.execute(
+            text(
+                "INSERT INTO content_blobs_new (hash, content, size, refcount) "
+                "SELECT hash, content, size, refcount FROM content_blobs"
+            )
+        )
+        connection.execute(text("DROP TABLE content_blobs"))
+        connection.execute(
+            text("ALTER TABLE content_blobs_new RENAME TO content_blobs")
+        )
+    else:
+        connection.execute(
+            text("ALTER TABLE content_blobs ALTER COLUMN content DROP NOT NULL")
+        )
+        connection.execute(
+            text("ALTER TABLE content_blobs ADD COLUMN IF NOT EXISTS data BYTEA")
+        )
+        connection.execute(
+            text("ALTER TABLE content_blobs ADD COLUMN IF NOT EXISTS codec VARCHAR")
+        )
+    # Existing blobs stay uncompressed; both forms are read transparently
+
+
+def _add_blob_backend(connection: Connection) -> None:
+    if "backend" not in {
+        column["name"] for column in inspect(connection).get_columns("content_blobs")
+    }:
+        connection.execute(text("ALTER TABLE content_blobs ADD COLUMN backend VARCHAR"))
+
+
+MIGRATIONS = [
+    Migration(1, "Create resources and id_reservations tables", _create_initial_tables),
+    Migration(
+        2,
+        "Index vanity_url and (type, access_count), add indexed expires_at",
+        _index_resources,
+    ),
+    Migration(3, "Add created_at and content_length", _add_listing_columns),
+    Migration(4, "Add version for ETags", _add_version),
+    Migration(5, "Store text snippet content in content_blobs", _deduplicate_content),
+    Migration(
+        6, "Add compressed data and codec to content_blobs", _add_blob_compression
+    ),
+    Migration(7, "Add backend to content_blobs for file storage", _add_blob_backend),
+]
+
+HEAD = MIGRATIONS[-1].version
+
+
+def current_version(connection: Connection) -> int:
+    if not inspect(connection).has_table("schema_migrations"):
+        return 0
+    version = connection.execute(
+        text("SELECT MAX(version) FROM schema_migrations")
+    ).scalar()
+    return version or 0
+
+
+def migrate(engine: Engine, target: int = HEAD) -> list[int]:
+    """Applies every pending migration up to target, each in its own transaction.
+
+    Returns the versions that were applied. On Postgres an advisory lock
+    serializes workers that start at the same time."""
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version > target:
+            break
+        with engine.begin() as connection:
+            if connection.dialect.name == "postgresql":
+                connection.execute(
+                    text("SELECT pg_advisory_xact_lock(:key)"),
+                    {"key": _ADVISORY_LOCK_KEY},
+                )
+            _version_metadata.create_all(connection, checkfirst=True)
+            if current_version(connection) >= migration.version:
+                continue
+            migration.upgrade(connection)
+            connection.execute(
+                schema_migrations.insert().values(
+                    version=migration.version,
+                    description=migration.description,
+                    applied_at=datetime.datetime.now(),
+                )
+            )
+        logger.info(
+            "Applied migration %s: %s", migration.version, migration.description
+        )
+        applied.append(migration.version)
+    return applied
+
+
+if __name__ == "__main__":
+    # Importing database_startup applies pending migrations to the configured database
+    from database_startup import engine
+
+    with engine.connect() as connection:
+        version = current_version(connection)
+    for migration in MIGRATIONS:
+        state = "applied" if migration.version <= version else "pending"
+        print(f"{migration.version:>4}  {state:<8} {migration.description}")
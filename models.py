@@ -1,5 +1,7 @@
+import math
+from dataclasses import dataclass
 from enum import Enum
-from typing import Annotated, TypeAlias, Union
+from typing import Annotated, Literal, NamedTuple, TypeAlias, Union
 from datetime import datetime
 from pydantic import BaseModel, Field
 
@@ -12,6 +14,19 @@ class Type(str, Enum):
 TypeField: TypeAlias = Annotated[Type, Field(description="The type of resource")]
 
 
+@dataclass(frozen=True, slots=True)
+class StoredBody:
+    """The JSON response body of a text snippet as stored, so it can be sent
+    without rendering the content again."""
+
+    digest: str
+    # Compressed body and the storage codec it is compressed with
+    codec: str | None = None
+    data: bytes | None = None
+    # File holding the uncompressed body
+    path: str | None = None
+
+
 class Resource(BaseModel):
     id: Annotated[
         str,
@@ -53,3 +68,51 @@ class Resource(BaseModel):
     access_count: Annotated[
         int, Field(description="The number of times the resource has been accessed")
     ] = 0
+    created_at: Annotated[
+        datetime | None,
+        Field(description="When the resource was created, set by the server"),
+    ] = None
+    version: Annotated[
+        int,
+        Field(
+            description="Incremented by the server whenever the content is updated, part of the ETag"
+        ),
+    ] = 1
+
+
+class ResourceRecord(NamedTuple):
+    """What GET /{resource_id} needs of a resource, as the resource cache and
+    the service layer hold it: a tuple of 6 slots, with the Type member rather
+    than its string and the expiry as epoch seconds. Resource is only built for
+    API responses."""
+
+    id: str
+    # Empty when stored_body holds the body
+    content: str
+    type: Type
+    # time.time() the resource expires at, rounded up, or None if it never does
+    expires_at: int | None
+    version: int
+    # Set for compressed and file-backed content
+    stored_body: StoredBody | None = None
+
+
+def epoch_seconds(time: datetime | None) -> int | None:
+    """time as epoch seconds, rounded up so nothing expires early."""
+    return math.ceil(time.timestamp()) if time is not None else None
+
+
+class BulkCreateResult(BaseModel):
+    index: Annotated[
+        int, Field(description="Position of the item in the submitted array or stream")
+    ]
+    status: Annotated[
+        Literal["created", "conflict", "invalid"],
+        Field(description="Whether the item was created, and if not, why"),
+    ]
+    id: Annotated[
+        str | None, Field(description="The id of the created or conflicting resource")
+    ] = None
+    detail: Annotated[str | None, Field(description="Why the item was not created")] = (
+        None
+    )
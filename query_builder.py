@@ -0,0 +1,154 @@
+# Compiles admin listing filters into a single parametrized SELECT
+
+import datetime
+from dataclasses import dataclass, field
+from typing import Literal
+from sqlalchemy import ColumnElement, Select, or_, select, tuple_
+from models import Type
+from resource_entity import ResourceEntity
+
+COMPARISON_OPERATORS = {
+    "=": "__eq__",
+    "<": "__lt__",
+    ">": "__gt__",
+    "<=": "__le__",
+    ">=": "__ge__",
+}
+
+ExpiryState = Literal["active", "expired", "never"]
+OrderColumn = Literal["id", "access_count", "created_at"]
+
+_ORDER_COLUMNS = {
+    "id": ResourceEntity.id,
+    "access_count": ResourceEntity.access_count,
+    "created_at": ResourceEntity.created_at,
+}
+
+
+class InvalidFilterError(Exception):
+    """Exception raised when a listing filter is not supported"""
+
+    pass
+
+
+def _compare(column, operator: str, value) -> ColumnElement[bool]:
+    if operator not in COMPARISON_OPERATORS:
+        raise InvalidFilterError(f"Unsupported operator: {operator}")
+    return getattr(column, COMPARISON_OPERATORS[operator])(value)
+
+
+@dataclass
+class ResourceQuery:
+    """Filters, ordering and keyset position for listing resources.
+
+    after is the order_key of the last row of the previous page. Rows are
+    ordered by the order column and then by id, so the position is unambiguous."""
+
+    resource_type: Type | None = None
+    access_count: tuple[str, int] | None = None
+    content_length: tuple[str, int] | None = None
+    min_access_count: int | None = None
+    max_access_count: int | None = None
+    id_prefix: str | None = None
+    expiry: ExpiryState | None = None
+    created_after: datetime.datetime | None = None
+    created_before: datetime.datetime | None = None
+    order_by: OrderColumn = "id"
+    descending: bool = False
+    limit: int | None = None
+    after: tuple = field(default=())
+
+    def __post_init__(self):
+        if self.order_by not in _ORDER_COLUMNS:
+            raise InvalidFilterError(f"Unsupported order column: {self.order_by}")
+        for predicate in (self.access_count, self.content_length):
+            if predicate is not None and predicate[0] not in COMPARISON_OPERATORS:
+                raise InvalidFilterError(f"Unsupported operator: {predicate[0]}")
+        if self.expiry not in (None, "active", "expired", "never"):
+            raise InvalidFilterError(f"Unsupported expiry state: {self.expiry}")
+
+    def where(self, now: datetime.datetime | None = None) -> list[ColumnElement[bool]]:
+        now = now or datetime.datetime.now()
+        clauses = []
+        if self.resource_type is not None:
+            clauses.append(ResourceEntity.type == self.resource_type)
+        if self.access_count is not None:
+            clauses.append(_compare(ResourceEntity.access_count, *self.access_count))
+        if self.content_length is not None:
+            clauses.append(
+                _compare(ResourceEntity.content_length, *self.content_length)
+            )
+        if self.min_access_count is not None:
+            clauses.append(ResourceEntity.access_count >= self.min_access_count)
+        if self.max_access_count is not None:
+            clauses.append(ResourceEntity.access_count <= self.max_access_count)
+        if self.id_prefix:
+            # Escaped, so % and _ in the prefix match literally
+            clauses.append(
+                ResourceEntity.id.startswith(self.id_prefix, autoescape=True)
+            )
+        if self.expiry == "active":
+            clauses.append(
+                or_(
+                    ResourceEntity.expires_at.is_(None), ResourceEntity.expires_at > now
+                )
+            )
+        elif self.expiry == "expired":
+            clauses.append(ResourceEntity.expires_at <= now)
+        elif self.expiry == "never":
+            clauses.append(ResourceEntity.expires_at.is_(None))
+        if self.created_after is not None:
+            clauses.append(ResourceEntity.created_at >= self.created_after)
+        if self.created_before is not None:
+            clauses.append(ResourceEntity.created_at < self.created_before)
+        return clauses
+
+    def order_key(self, resource) -> list:
+        """The keyset position of resource, for building the next page's cursor."""
+        value = getattr(resource, self.order_by)
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        return [value, resource.id] if self.order_by != "id" else [resource.id]
+
+    def statement(
+        self, now: datetime.datetime | None = None, base: Select | None = None
+    ) -> Select:
+        """The SELECT of matching entities, or of base with the filters, order
+        and limit added, e.g. to select columns rather than entities."""
+        order_column = _ORDER_COLUMNS[self.order_by]
+        if base is None:
+            base = select(ResourceEntity)
+        statement = base.where(*self.where(now))
+        if self.order_by == "id":
+            order = [order_column]
+        else:
+            order = [order_column, ResourceEntity.id]
+        if self.after:
+            statement = statement.where(self._after_clause(order))
+        statement = statement.order_by(
+            *(column.desc() if self.descending else column for column in order)
+        )
+        if self.limit is not None:
+            statement = statement.limit(self.limit)
+        return statement
+
+    def _after_clause(self, order: list) -> ColumnElement[bool]:
+        after = list(self.after)
+        # Decoded from a client supplied cursor: anything but the position an
+        # order_key gives would fail in the database, not as a bad request
+        value_type = int if self.order_by == "access_count" else str
+        if (
+            len(after) != len(order)
+            or not isinstance(after[0], value_type)
+            or isinstance(after[0], bool)
+            or not all(isinstance(id, str) for id in after[1:])
+        ):
+            raise InvalidFilterError("Cursor does not match the order column")
+        if self.order_by == "created_at":
+            try:
+                after[0] = datetime.datetime.fromisoformat(after[0])
+            except (TypeError, ValueError):
+                raise InvalidFilterError("Cursor does not match the order column")
+        position = order[0] if len(order) == 1 else tuple_(*order)
+        bound = after[0] if len(after) == 1 else tuple_(*after)
+        return position < bound if self.descending else position > bound
@@ -0,0 +1,192 @@
+# Per-client rate limiting of the API by route group
+#
+# RATE_LIMIT_SUE      "RATE,BURST" for the create endpoints (tag Sue): tokens a
+#                     client gets per second, and how many it can save up for a
+#                     burst (default "10,50"); empty for no limit
+# RATE_LIMIT_CAI      the same for GET /{resource_id} (tag Cai, default
+#                     "100,200")
+# RATE_LIMIT_AMY      the same for the admin endpoints (tag Amy, default
+#                     "20,50")
+# RATE_LIMIT_KEY      "ip" (default) identifies clients by address, "api-key"
+#                     by their X-API-Key header, falling back to the address.
+#                     Only use api-key behind a gateway that validates keys,
+#                     since anyone can make up a new one per request
+# RATE_LIMIT_TRUST_FORWARDED  "1" to take the address from the last
+#                     X-Forwarded-For entry, i.e. the one our proxy added
+# RATE_LIMIT_BACKEND  "memory" (default) keeps the buckets in the worker
+# RATE_LIMIT_MAX_KEYS buckets the memory backend keeps, least recently used
+#                     first out (default 100000)
+#
+# The memory backend limits each worker on its own: with N workers or replicas
+# a client gets up to N times the configured rate. A shared backend (see
+# RateLimitBackend) enforces one limit across all of them; if it fails,
+# requests are let through rather than refused.
+
+import logging
+import math
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from starlette.responses import JSONResponse
+from env import getenv
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Limit:
+    rate: float
+    burst: int
+
+
+def parse_limit(value: str) -> Limit | None:
+    """Limit of a "RATE,BURST" setting, or None for an empty one."""
+    if not value.strip():
+        return None
+    rate, burst = value.split(",")
+    limit = Limit(float(rate), int(burst))
+    if limit.rate <= 0 or limit.burst < 1:
+        raise ValueError(f"Unsupported rate limit: {value}")
+    return limit
+
+
+class RateLimitBackend:
+    """Base class for token bucket storage.
+
+    take() must refill and take from a bucket atomically. Shared backends
+    (e.g. a Redis script) may use their own clock instead of now."""
+
+    async def take(self, key: str, limit: Limit, now: float) -> float:
+        """Takes a token from key's bucket. Returns 0 if there was one,
+        otherwise the seconds until there is."""
+        raise NotImplementedError
+
+
+class MemoryBackend(RateLimitBackend):
+    """Token buckets in a dict, O(1) per request. Buckets beyond max_keys are
+    dropped least recently used first, which only ever refills them."""
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        # key -> (tokens, time of last refill)
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    async def take(self, key: str, limit: Limit, now: float) -> float:
+        return self.take_now(key, limit, now)
+
+    def take_now(self, key: str, limit: Limit, now: float) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens = float(limit.burst)
+            if len(self._buckets) >= self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            tokens, last = bucket
+            tokens = min(limit.burst, tokens + (now - last) * limit.rate)
+            self._buckets.move_to_end(key)
+        if tokens >= 1:
+            self._buckets[key] = (tokens - 1, now)
+            return 0.0
+        self._buckets[key] = (tokens, now)
+        return (1 - tokens) / limit.rate
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+def create_rate_limit_backend(kind: str) -> RateLimitBackend:
+    if kind == "memory":
+        return MemoryBackend(int(getenv("RATE_LIMIT_MAX_KEYS", "100000")))
+    raise ValueError(f"Unsupported rate limit backend: {kind}")
+
+
+class RateLimiter:
+    """Decides whether a request is admitted, by its route's group (the
+    route's tag) and the client it comes from."""
+
+    def __init__(
+        self,
+        limits: dict[str, Limit | None],
+        backend: RateLimitBackend,
+        key: str = "ip",
+        trust_forwarded: bool = False,
+        clock=time.monotonic,
+    ):
+        if key not in ("ip", "api-key"):
+            raise ValueError(f"Unsupported RATE_LIMIT_KEY: {key}")
+        self.limits = limits
+        self.backend = backend
+        self.key = key
+        self.trust_forwarded = trust_forwarded
+        self.clock = clock
+
+    def group(self, scope) -> str | None:
+        # The route the router will pick: the first whose path and method match.
+        # Cheaper than route.matches(), which also converts path parameters
+        path, method = scope["path"], scope["method"]
+        for route in scope["app"].router.routes:
+            methods = getattr(route, "methods", None)
+            if (methods is None or method in methods) and route.path_regex.match(path):
+                tags = getattr(route, "tags", None)
+                return tags[0].lower() if tags else None
+        return None
+
+    def client(self, scope) -> str:
+        headers = dict(scope["headers"])
+        if self.key == "api-key" and b"x-api-key" in headers:
+            return "key:" + headers[b"x-api-key"].decode("latin-1")
+        if self.trust_forwarded and b"x-forwarded-for" in headers:
+            forwarded = headers[b"x-forwarded-for"].decode("latin-1")
+            return forwarded.rsplit(",", 1)[-1].strip()
+        client = scope.get("client")
+        return client[0] if client else "-"
+
+    async def check(self, scope) -> float:
+        """0 if the request is admitted, otherwise the seconds to wait."""
+        if not any(self.limits.values()):
+            return 0.0
+        group = self.group(scope)
+        limit = self.limits.get(group) if group is not None else None
+        if limit is None:
+            return 0.0
+        key = f"{group}:{self.client(scope)}"
+        try:
+            return await self.backend.take(key, limit, self.clock())
+        except Exception:
+            # An unavailable shared backend must not take the API down with it
+            logger.warning("Rate limit backend failed, admitting", exc_info=True)
+            return 0.0
+
+
+class RateLimitMiddleware:
+    """Answers requests over their client's rate limit with 429 and a
+    Retry-After header, before they reach a route or the database."""
+
+    def __init__(self, app, limiter: RateLimiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        wait = await self.limiter.check(scope)
+        if wait > 0:
+            response = JSONResponse(
+                {"detail": "Too many requests"},
+                status_code=429,
+                headers={"Retry-After": str(math.ceil(wait))},
+            )
+            return await response(scope, receive, send)
+        await self.app(scope, receive, send)
+
+
+rate_limiter = RateLimiter(
+    limits={
+        "sue": parse_limit(getenv("RATE_LIMIT_SUE", "10,50")),
+        "cai": parse_limit(getenv("RATE_LIMIT_CAI", "100,200")),
+        "amy": parse_limit(getenv("RATE_LIMIT_AMY", "20,50")),
+    },
+    backend=create_rate_limit_backend(getenv("RATE_LIMIT_BACKEND", "memory")),
+    key=getenv("RATE_LIMIT_KEY", "ip"),
+    trust_forwarded=getenv("RATE_LIMIT_TRUST_FORWARDED", "0") == "1",
+)
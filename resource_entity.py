@@ -1,43 +1,187 @@
-from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import String, Integer
+from sqlalchemy import String, Integer, DateTime, Index, LargeBinary
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
 from typing import Self
 import datetime
-from models import TypeField, Resource
+import hashlib
+import json
+from models import StoredBody, TypeField, Resource, Type
+import file_store
+from storage_codecs import decode_payload
 
 
 Base = declarative_base()
 
 
+class db_now(FunctionElement):
+    """The database server's current local time, as a naive timestamp: the
+    clock every replica shares, unlike their own (see id_filter)."""
+
+    type = DateTime()
+    inherit_cache = True
+
+
+@compiles(db_now)
+def _db_now(element, compiler, **kw) -> str:
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(db_now, "postgresql")
+def _db_now_postgresql(element, compiler, **kw) -> str:
+    # The wall clock, not the start of the transaction as now() gives
+    return "CAST(clock_timestamp() AS TIMESTAMP)"
+
+
+@compiles(db_now, "sqlite")
+def _db_now_sqlite(element, compiler, **kw) -> str:
+    # CURRENT_TIMESTAMP is UTC and whole seconds
+    return "strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')"
+
+
+class ContentBlobEntity(Base):
+    """Text snippet content stored once per distinct content, see content_store."""
+
+    __tablename__ = "content_blobs"
+
+    hash: Mapped[str] = mapped_column(String, primary_key=True)
+    # Either content, data compressed by codec (see storage_codecs), or a
+    # file when backend is "file" (see file_store)
+    content: Mapped[str | None] = mapped_column(String, nullable=True)
+    data: Mapped[bytes | None] = mapped_column(LargeBinary, nullable=True)
+    codec: Mapped[str | None] = mapped_column(String, nullable=True)
+    backend: Mapped[str | None] = mapped_column(String, nullable=True)
+    size: Mapped[int] = mapped_column(Integer, nullable=False)
+    refcount: Mapped[int] = mapped_column(Integer, nullable=False)
+
+    @property
+    def text(self) -> str:
+        return self.decode(self.hash, self.content, self.data, self.codec, self.backend)
+
+    @staticmethod
+    def decode(
+        hash: str,
+        content: str | None,
+        data: bytes | None,
+        codec: str | None,
+        backend: str | None,
+    ) -> str:
+        """The text of a blob from its columns, for rows selected without the ORM."""
+        if backend == "file":
+            try:
+                return json.loads(ContentBlobEntity.path_of(hash).read_bytes())
+            except FileNotFoundError:
+                raise file_store.BlobFileMissingError(hash)
+        if codec is None:
+            return content
+        return decode_payload(codec, data)
+
+    @staticmethod
+    def path_of(hash: str):
+        if file_store.file_blob_store is None:
+            raise file_store.BlobFileMissingError(
+                f"Blob {hash} is a file but BLOB_STORE_DIR is unset"
+            )
+        return file_store.file_blob_store.path(hash)
+
+    @staticmethod
+    def stored_body(
+        hash: str, data: bytes | None, codec: str | None, backend: str | None
+    ) -> StoredBody | None:
+        """The body of a blob as stored, from its columns, if it is not plain."""
+        if backend == "file":
+            return StoredBody(hash, path=str(ContentBlobEntity.path_of(hash)))
+        if codec is not None:
+            return StoredBody(hash, codec=codec, data=data)
+        return None
+
+    @staticmethod
+    def hash_of(content: str) -> str:
+        return hashlib.blake2b(content.encode(), digest_size=32).hexdigest()
+
+
 class ResourceEntity(Base):
     __tablename__ = "resources"
+    # Created by migrations.py, declared here so the metadata matches the schema
+    __table_args__ = (
+        Index("ix_resources_vanity_url", "vanity_url", unique=True),
+        Index("ix_resources_type_access_count", "type", "access_count"),
+    )
 
     id: Mapped[str] = mapped_column(String, primary_key=True, unique=True)
-    content: Mapped[str] = mapped_column(String, nullable=False)
+    # Links keep their target inline; text snippets point at a content blob
+    content: Mapped[str | None] = mapped_column(String, nullable=True)
     vanity_url: Mapped[str | None] = mapped_column(String, nullable=True)
     type: Mapped[TypeField] = mapped_column(String, nullable=False)
     expiration_time: Mapped[datetime.datetime | int | None] = mapped_column(
         String, nullable=True, default=-1
     )
     access_count: Mapped[int] = mapped_column(Integer, default=0)
+    expires_at: Mapped[datetime.datetime | None] = mapped_column(
+        DateTime, nullable=True, index=True
+    )
+    created_at: Mapped[datetime.datetime | None] = mapped_column(
+        DateTime, nullable=True, index=True
+    )
+    content_length: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=1)
+    content_hash: Mapped[str | None] = mapped_column(String, nullable=True, index=True)
+    # Loaded in the same SELECT; reference counts are kept by content_store
+    blob: Mapped[ContentBlobEntity | None] = relationship(
+        primaryjoin="foreign(ResourceEntity.content_hash) == ContentBlobEntity.hash",
+        viewonly=True,
+        lazy="joined",
+    )
+
+    @property
+    def stored_content(self) -> str:
+        return self.blob.text if self.content_hash is not None else self.content
 
     def to_model(self) -> Resource:
         return Resource(
             id=self.id,
-            content=self.content,
+            content=self.stored_content,
             vanity_url=self.vanity_url,
             type=self.type,
             expiration_time=self.expiration_time,
             access_count=self.access_count,
+            created_at=self.created_at,
+            version=self.version,
         )
 
     @classmethod
     def from_model(cls, resource: Resource) -> Self:
+        # The caller stores the blob of a text snippet, see content_store.acquire
+        deduplicated = resource.type == Type.text
         return cls(
             id=resource.id,
-            content=resource.content,
-            vanity_url=resource.vanity_url,
+            content=None if deduplicated else resource.content,
+            content_hash=(
+                ContentBlobEntity.hash_of(resource.content) if deduplicated else None
+            ),
+            # Stored as NULL rather than "" or blank so the unique index allows many
+            vanity_url=(resource.vanity_url or "").strip() or None,
             type=resource.type,
             expiration_time=resource.expiration_time,
             access_count=resource.access_count,
+            expires_at=(
+                resource.expiration_time
+                if isinstance(resource.expiration_time, datetime.datetime)
+                else None
+            ),
+            created_at=resource.created_at or datetime.datetime.now(),
+            content_length=len(resource.content),
+            version=resource.version,
         )
+
+
+class ReservedIdEntity(Base):
+    """An id handed out to a worker's id pool but not yet used by a resource."""
+
+    __tablename__ = "id_reservations"
+
+    id: Mapped[str] = mapped_column(String, primary_key=True)
+    reserved_at: Mapped[datetime.datetime] = mapped_column(
+        DateTime, nullable=False, default=datetime.datetime.now
+    )
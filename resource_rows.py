@@ -0,0 +1,163 @@
+# Read paths that skip the ORM and the Resource model
+#
+# Listings select the columns they show as plain rows, with the content blob
+# outer joined, and encode them straight to JSON with orjson. Building a
+# Resource per row and then having FastAPI validate and serialize it again
+# through the endpoint's response model costs more than the query; Resource
+# stays the documented response model only. The JSON is the same as
+# Resource.model_dump_json() gives.
+#
+# GET /{resource_id} selects RECORD_COLUMNS into a ResourceRecord, the compact
+# form the resource cache holds.
+
+import datetime
+from typing import Iterable
+import orjson
+from fastapi.responses import Response
+from sqlalchemy import Row, Select, select
+from models import ResourceRecord, Type, epoch_seconds
+from resource_entity import ContentBlobEntity, ResourceEntity
+
+ROW_COLUMNS = (
+    ResourceEntity.id,
+    ResourceEntity.content,
+    ResourceEntity.vanity_url,
+    ResourceEntity.type,
+    ResourceEntity.expiration_time,
+    ResourceEntity.access_count,
+    ResourceEntity.created_at,
+    ResourceEntity.version,
+    ResourceEntity.content_hash,
+    ContentBlobEntity.content.label("blob_content"),
+    ContentBlobEntity.data.label("blob_data"),
+    ContentBlobEntity.codec.label("blob_codec"),
+    ContentBlobEntity.backend.label("blob_backend"),
+)
+
+RECORD_COLUMNS = (
+    ResourceEntity.id,
+    ResourceEntity.content,
+    ResourceEntity.type,
+    ResourceEntity.expires_at,
+    ResourceEntity.version,
+    ResourceEntity.content_hash,
+    ContentBlobEntity.content,
+    ContentBlobEntity.data,
+    ContentBlobEntity.codec,
+    ContentBlobEntity.backend,
+)
+
+# Datetimes with a UTC offset end in Z, like pydantic's
+_ORJSON_OPTIONS = orjson.OPT_UTC_Z
+
+
+def select_rows() -> Select:
+    """SELECT of ROW_COLUMNS, for ResourceQuery.statement to add filters to."""
+    return select(*ROW_COLUMNS).outerjoin(
+        ContentBlobEntity, ResourceEntity.content_hash == ContentBlobEntity.hash
+    )
+
+
+def select_records() -> Select:
+    """SELECT of the RECORD_COLUMNS of every resource."""
+    return select(*RECORD_COLUMNS).outerjoin(
+        ContentBlobEntity, ResourceEntity.content_hash == ContentBlobEntity.hash
+    )
+
+
+def select_record(id: str) -> Select:
+    return select_records().where(ResourceEntity.id == id)
+
+
+def row_record(row: Row) -> ResourceRecord:
+    """The ResourceRecord of a row of RECORD_COLUMNS. The content of a
+    compressed or file-backed snippet is left empty; its body is sent as
+    stored."""
+    (
+        id,
+        content,
+        type,
+        expires_at,
+        version,
+        content_hash,
+        blob_content,
+        blob_data,
+        blob_codec,
+        blob_backend,
+    ) = row
+    stored_body = None
+    if content_hash is not None:
+        stored_body = ContentBlobEntity.stored_body(
+            content_hash, blob_data, blob_codec, blob_backend
+        )
+        content = blob_content if stored_body is None else ""
+    return ResourceRecord(
+        id=id,
+        content=content,
+        type=Type(type),
+        expires_at=epoch_seconds(expires_at),
+        version=version,
+        stored_body=stored_body,
+    )
+
+
+def _expiration_time(value: str | None) -> int | datetime.datetime | None:
+    # Stored as text; parsed like the int | datetime field of Resource
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value)
+
+
+def row_dict(row: Row) -> dict:
+    """The fields of Resource for a row of ROW_COLUMNS."""
+    (
+        id,
+        content,
+        vanity_url,
+        type,
+        expiration_time,
+        access_count,
+        created_at,
+        version,
+        content_hash,
+        blob_content,
+        blob_data,
+        blob_codec,
+        blob_backend,
+    ) = row
+    if content_hash is not None:
+        content = ContentBlobEntity.decode(
+            content_hash, blob_content, blob_data, blob_codec, blob_backend
+        )
+    return {
+        "id": id,
+        "content": content,
+        "vanity_url": vanity_url,
+        "type": type,
+        "expiration_time": _expiration_time(expiration_time),
+        "access_count": access_count,
+        "created_at": created_at,
+        "version": version,
+    }
+
+
+def dumps(value) -> bytes:
+    return orjson.dumps(value, option=_ORJSON_OPTIONS)
+
+
+def ndjson(rows: Iterable[Row]) -> bytes:
+    """One JSON document per row, each on its own line."""
+    option = _ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE
+    return b"".join(orjson.dumps(row_dict(row), option=option) for row in rows)
+
+
+class ResourceListResponse(Response):
+    """A JSON array of the resources of rows of ROW_COLUMNS."""
+
+    media_type = "application/json"
+
+    def render(self, content: Iterable[Row]) -> bytes:
+        return dumps([row_dict(row) for row in content])
@@ -1,20 +1,50 @@
-import string
-from models import Resource, Type
+from models import BulkCreateResult, Resource, Type
 from datetime import datetime, timedelta
-from fastapi.responses import RedirectResponse
+from fastapi.responses import Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import Field, BaseModel
 from enum import Enum
-from typing import Annotated, TypeAlias
+from typing import Annotated, AsyncIterable, AsyncIterator, Iterable, TypeAlias
+import base64
+import binascii
+import csv
+import io
+import json
+import time
+from dataclasses import replace
 import sqlite3
-from database import DatabaseService
+import content_store
+import file_store
+from content_store import ContentSpool, ContentTooLargeError
+from database import DatabaseService, DuplicateKeyError
+from database_startup import get_id_generator
+from http_cache import http_cache_policy
+from hot_keys import hot_responses
+from id_generator import IdGenerator
+from metrics import timed
+from query_builder import ResourceQuery
+import resource_rows
+from resource_rows import ResourceListResponse
 from sqlalchemy.orm import Session
 from fastapi import Depends
+from pydantic import ValidationError
 
 
-import random
-
 # This is where actual functionality of the service is implemented
 
+DEFAULT_PAGE_SIZE = 100
+CSV_COLUMNS = [
+    "id",
+    "content",
+    "vanity_url",
+    "type",
+    "expiration_time",
+    "access_count",
+    "created_at",
+]
+# Items validated, probed and inserted together by create_resources
+BULK_CREATE_BATCH_SIZE = 1000
+
 
 class ResourceAlreadyExistsError(Exception):
     """Exception raised when resource already exists"""
@@ -28,161 +58,404 @@ class ResourceNotFoundError(Exception):
     pass
 
 
+class ResourceExpiredError(Exception):
+    """Exception raised when resource has expired"""
+
+    pass
+
+
+class InvalidCursorError(Exception):
+    """Exception raised when a pagination cursor cannot be decoded"""
+
+    pass
+
+
+def _csv_value(value) -> object:
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return "" if value is None else value
+
+
+def encode_cursor(position: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        position = json.loads(
+            base64.b64decode(
+                cursor + "=" * (-len(cursor) % 4), altchars=b"-_", validate=True
+            )
+        )
+    except (binascii.Error, ValueError):
+        raise InvalidCursorError
+    if not isinstance(position, list):
+        raise InvalidCursorError
+    return tuple(position)
+
+
+async def ndjson_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """The non-empty lines of a chunked NDJSON body, without buffering all of it."""
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+async def _batches(
+    items: Iterable[object] | AsyncIterable[object], size: int
+) -> AsyncIterator[list[tuple[int, object]]]:
+    if not isinstance(items, AsyncIterable):
+        items = _aiter(items)
+    batch: list[tuple[int, object]] = []
+    index = 0
+    async for item in items:
+        batch.append((index, item))
+        index += 1
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def _aiter(items: Iterable[object]) -> AsyncIterator[object]:
+    for item in items:
+        yield item
+
+
+def _validate_bulk_item(item: object) -> Resource:
+    # NDJSON lines arrive unparsed; a missing id means "generate one"
+    if isinstance(item, bytes):
+        item = json.loads(item)
+    if isinstance(item, dict):
+        item = {"id": "", **item}
+    return Resource.model_validate(item)
+
+
+@timed
 class ResourceServices:
     db_service: DatabaseService
+    id_generator: IdGenerator
 
-    def __init__(self, db_service: Annotated[DatabaseService, Depends()]):
+    def __init__(
+        self,
+        db_service: Annotated[DatabaseService, Depends()],
+        id_generator: Annotated[IdGenerator, Depends(get_id_generator)],
+    ):
         self.db_service = db_service
+        self.id_generator = id_generator
 
-    def generate_random_id(self):
-        return "".join(
-            random.choices(string.ascii_letters + string.digits, k=random.randint(5, 9))
-        )
-
-    # Fix vanity URL
-    # If no vanity-url, generate random id
-    def create_resource_text(self, resource: Resource) -> Resource:
-        # Check for existing id
-        if self.db_service.get_entry(resource.id):
-            raise ResourceAlreadyExistsError
+    async def assign_id(self, resource: Resource) -> None:
+        """Sets resource.id to the vanity url, the requested id or a generated id.
 
+        Every candidate costs a single probe against both ids and vanity urls,
+        except ids from generators that guarantee uniqueness."""
         # Vanity url present, set as id
         if resource.vanity_url and resource.vanity_url.strip() != "":
-            if self.db_service.resource_exists(
-                vanity_url=resource.vanity_url
-            ) or self.db_service.resource_exists(id=resource.vanity_url):
+            if await self.db_service.id_taken(resource.vanity_url):
                 raise ResourceAlreadyExistsError
             resource.id = resource.vanity_url
+        # Check for existing id
+        elif resource.id:
+            if await self.db_service.id_taken(resource.id):
+                raise ResourceAlreadyExistsError
         # No vanity url/id, generate a unique id for the resource
-        # While resource id is empty or vanity_url is resource id, or id is resource id
-        # Intially, no resource id or vanity_url
-        # Now, we have a generated_id. Check if it already exists
         else:
-            while (
-                not resource.id
-                or self.db_service.resource_exists(vanity_url=resource.id)
-                or self.db_service.resource_exists(id=resource.id)
+            generated_id = await self.id_generator.next_id_async()
+            # Only generators that can collide need the uniqueness probe
+            while not self.id_generator.unique and await self.db_service.id_taken(
+                generated_id
             ):
-                generated_id = self.generate_random_id()
-                print(
-                    f"{self.db_service.resource_exists(
-                    vanity_url=generated_id
-                )} and {self.db_service.resource_exists(id=generated_id)}"
-                )
-                if self.db_service.resource_exists(
-                    vanity_url=generated_id
-                ) == False and not self.db_service.resource_exists(id=generated_id):
-                    resource.id = generated_id
-                    print("Entered break")
-                    break
-        resource.type = Type.text
+                generated_id = await self.id_generator.next_id_async()
+            resource.id = generated_id
+
+    def stamp_times(self, resource: Resource) -> None:
+        resource.created_at = datetime.now()
         # Expiration date handling
         if resource.expiration_time:
             if isinstance(resource.expiration_time, int):
                 if resource.expiration_time >= 0:
-                    resource.expiration_time = datetime.now() + timedelta(
+                    resource.expiration_time = resource.created_at + timedelta(
                         hours=resource.expiration_time
                     )
-        self.db_service.add_entry(resource)
+
+    # If no vanity-url, generate random id
+    async def create_resource_text(self, resource: Resource) -> Resource:
+        await self.assign_id(resource)
+        resource.type = Type.text
+        self.stamp_times(resource)
+        try:
+            await self.db_service.add_entry(resource)
+        except DuplicateKeyError:
+            raise ResourceAlreadyExistsError
         return resource
 
-    def create_resource_url(self, resource: Resource) -> Resource:
-        # Check for existing id
-        if self.db_service.get_entry(resource.id):
+    async def create_resource_text_stream(
+        self,
+        resource: Resource,
+        chunks: AsyncIterable[bytes],
+        declared_size: int | None = None,
+        max_bytes: int | None = None,
+    ) -> Resource:
+        """Creates a text snippet from content received in chunks, never held
+        in memory as a whole. The returned resource's content is left empty."""
+        max_bytes = max_bytes or content_store.UPLOAD_MAX_BYTES
+        # Refused before a byte is read when Content-Length gives it away
+        if declared_size is not None and declared_size > max_bytes:
+            raise ContentTooLargeError
+        await self.assign_id(resource)
+        resource.type = Type.text
+        resource.content = ""
+        self.stamp_times(resource)
+        spool = ContentSpool(max_bytes, file_store.file_blob_store)
+        try:
+            async for chunk in chunks:
+                spool.feed(chunk)
+            spool.finish()
+            # Compressing or fsyncing a large body would block the event loop
+            blob = await run_in_threadpool(content_store.spooled_blob_row, spool)
+        finally:
+            spool.close()
+        try:
+            await self.db_service.add_blob_entry(resource, blob)
+        except DuplicateKeyError:
             raise ResourceAlreadyExistsError
+        return resource
 
-        # Vanity url present, set as id
-        if resource.vanity_url and resource.vanity_url.strip() != "":
-            if self.db_service.resource_exists(
-                vanity_url=resource.vanity_url
-            ) or self.db_service.resource_exists(id=resource.vanity_url):
-                raise ResourceAlreadyExistsError
-            resource.id = resource.vanity_url
-        # No vanity url/id, generate a unique id for the resource
-        else:
-            while (
-                not resource.id
-                or self.db_service.resource_exists
-                or self.db_service.resource_exists(id=resource.id)(
-                    vanity_url=resource.id
-                )
-            ):
-                generated_id = self.generate_random_id()
-                if self.db_service.resource_exists(
-                    vanity_url=generated_id
-                ) == False and not self.db_service.resource_exists(id=generated_id):
-                    resource.id = generated_id
-                    break
+    async def create_resource_url(self, resource: Resource) -> Resource:
+        await self.assign_id(resource)
         resource.type = Type.url
-        # Expiration date handling
-        if resource.expiration_time:
-            if isinstance(resource.expiration_time, int):
-                if resource.expiration_time >= 0:
-                    resource.expiration_time = datetime.now() + timedelta(
-                        hours=resource.expiration_time
-                    )
-        self.db_service.add_entry(resource)
+        self.stamp_times(resource)
+        try:
+            await self.db_service.add_entry(resource)
+        except DuplicateKeyError:
+            raise ResourceAlreadyExistsError
         return resource
 
-    def get_resource(self, id: str):
-        if not self.db_service.resource_exists(id=id):
-            raise ResourceNotFoundError
-        self.db_service.update_access_count(id)  # Increment access count
-        resource = self.db_service.get_entry(id)
+    async def create_resources(
+        self,
+        items: Iterable[object] | AsyncIterable[object],
+        batch_size: int = BULK_CREATE_BATCH_SIZE,
+    ) -> list[BulkCreateResult]:
+        """Creates every valid item, batch_size items per transaction.
+
+        Each batch costs one query to find taken ids and vanity urls and one
+        executemany insert, instead of a probe and a commit per item."""
+        results: list[BulkCreateResult] = []
+        async for batch in _batches(items, batch_size):
+            results.extend(await self.create_batch(batch))
+        return results
+
+    async def create_batch(
+        self, batch: list[tuple[int, object]]
+    ) -> list[BulkCreateResult]:
+        results: dict[int, BulkCreateResult] = {}
+        requested: dict[int, Resource] = {}
+        generated: dict[int, Resource] = {}
+        keys: set[str] = set()
+        for index, item in batch:
+            try:
+                resource = _validate_bulk_item(item)
+            except ValidationError as error:
+                detail = "; ".join(e["msg"] for e in error.errors())
+                results[index] = BulkCreateResult(
+                    index=index, status="invalid", detail=detail
+                )
+                continue
+            except ValueError:
+                results[index] = BulkCreateResult(
+                    index=index, status="invalid", detail="Invalid JSON"
+                )
+                continue
+            self.stamp_times(resource)
+            # Same precedence as assign_id: vanity url, then requested id
+            key = (resource.vanity_url or "").strip() or resource.id
+            if not key:
+                generated[index] = resource
+            elif key in keys:
+                results[index] = BulkCreateResult(
+                    index=index,
+                    id=key,
+                    status="conflict",
+                    detail="Duplicate in request",
+                )
+            else:
+                resource.id = key
+                keys.add(key)
+                requested[index] = resource
+
+        for resource in generated.values():
+            resource.id = await self.id_generator.next_id_async()
+        probe = keys | (
+            set() if self.id_generator.unique else {r.id for r in generated.values()}
+        )
+        taken = await self.db_service.taken_keys(probe)
+        # Generated ids that collide, with a taken or requested key or with
+        # each other, are replaced until every one is free and distinct
+        claimed = set(keys)
+
+        def claim(resources: Iterable[Resource]) -> list[Resource]:
+            colliding = []
+            for resource in resources:
+                if resource.id in taken or resource.id in claimed:
+                    colliding.append(resource)
+                else:
+                    claimed.add(resource.id)
+            return colliding
+
+        colliding = claim(generated.values())
+        while colliding:
+            for resource in colliding:
+                resource.id = await self.id_generator.next_id_async()
+            taken |= await self.db_service.taken_keys({r.id for r in colliding})
+            colliding = claim(colliding)
+
+        insert: dict[int, Resource] = {}
+        for index, resource in requested.items():
+            if resource.id in taken:
+                results[index] = BulkCreateResult(
+                    index=index,
+                    id=resource.id,
+                    status="conflict",
+                    detail="Resource already exists",
+                )
+            else:
+                insert[index] = resource
+        insert.update(generated)
+        inserted = await self.db_service.add_entries(list(insert.values()))
+        for index, resource in insert.items():
+            if resource.id in inserted:
+                results[index] = BulkCreateResult(
+                    index=index, id=resource.id, status="created"
+                )
+            else:
+                results[index] = BulkCreateResult(
+                    index=index,
+                    id=resource.id,
+                    status="conflict",
+                    detail="Resource already exists",
+                )
+        return [results[index] for index, _ in batch]
+
+    async def get_resource(
+        self,
+        id: str,
+        if_none_match: str | None = None,
+        accept_encoding: str | None = None,
+    ) -> Response:
+        # Read first: a redirect is not pinned if the resource was invalidated
+        # while it was read
+        generation = hot_responses.generation
+        # Served from the resource cache when possible
+        resource = await self.db_service.get_cached_entry(id)
         if resource is None:
-            raise ValueError("Resource doesn't exist")
+            raise ResourceNotFoundError
+        now = time.time()
+        # Expired rows are served as gone until the reaper deletes them
+        if resource.expires_at is not None and resource.expires_at <= now:
+            raise ResourceExpiredError
+        # Increment access count, 304 revalidations included (see http_cache)
+        self.db_service.update_access_count(id)
+        hot = hot_responses.record(id)
 
         if resource.type == Type.url:
-            return RedirectResponse(url=resource.content)
+            response = http_cache_policy.redirect_response(resource, now)
+            if hot:
+                # Answered by HotResponseMiddleware from now on
+                hot_responses.pin(
+                    id, response, resource.expires_at, resource.version, generation
+                )
+            return response
         else:
-            return resource.content
-
-    def get_all_resources(
-        self,
-        resource_type: Type | None,
-        sort_operator: str | None,
-        sort_value: int | None,
-    ) -> list[Resource]:  # Issue? not sure...
-        if (
-            resource_type == None and sort_operator == None and sort_value == None
-        ):  # Return all resources
-            return self.db_service.get_all_entries()
-        out = list()
-        if resource_type is None:
-            selected_link = self.db_service.filter_by(
-                type=Type.url, sort=(sort_operator, sort_value)
+            return http_cache_policy.text_response(
+                resource, now, if_none_match, accept_encoding
             )
-            selected_text = self.db_service.filter_by(
-                type=Type.text, sort=(sort_operator, sort_value)
-            )
-            out = selected_link + selected_text
-            print("out type: ", type(out))
-        else:
-            selected = self.db_service.filter_by(
-                type=resource_type, sort=(sort_operator, sort_value)
+
+    async def get_all_resources(self, query: ResourceQuery) -> ResourceListResponse:
+        return ResourceListResponse(await self.db_service.query_rows(query))
+
+    async def get_resources_page(
+        self, query: ResourceQuery, after: str | None
+    ) -> ResourceListResponse:
+        """One page of resources, with the cursor for the next page, if any, in
+        the X-Next-Cursor header."""
+        limit = query.limit or DEFAULT_PAGE_SIZE
+        # One extra row tells whether there is a next page
+        page = await self.db_service.query_rows(
+            replace(query, limit=limit + 1, after=decode_cursor(after) if after else ())
+        )
+        if len(page) > limit:
+            return ResourceListResponse(
+                page[:limit],
+                headers={
+                    "X-Next-Cursor": encode_cursor(query.order_key(page[limit - 1]))
+                },
             )
-            print("selected type: ", type(selected))
-            for resource_tuple in selected:
-                out.append(resource_tuple)
-            print("type: ", type(out))
-        return out
-
-    def get_resource_access_count(self, resource_id: str) -> int:
-        if not self.db_service.resource_exists(id=resource_id):
+        return ResourceListResponse(page)
+
+    def stream_resources(
+        self, query: ResourceQuery, after: str | None, format: str = "ndjson"
+    ) -> AsyncIterator[bytes]:
+        """NDJSON or CSV lines for every matching resource, read in constant memory."""
+        if after:
+            query = replace(query, after=decode_cursor(after))
+        # Raises InvalidFilterError now rather than after the response has started
+        query.statement()
+        # A chunk per batch of rows rather than per row
+        batches = self.db_service.stream_rows(query)
+
+        async def ndjson() -> AsyncIterator[bytes]:
+            async for rows in batches:
+                yield resource_rows.ndjson(rows)
+
+        async def csv_rows() -> AsyncIterator[bytes]:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(CSV_COLUMNS)
+            async for rows in batches:
+                for row in rows:
+                    resource = resource_rows.row_dict(row)
+                    writer.writerow(
+                        [_csv_value(resource[column]) for column in CSV_COLUMNS]
+                    )
+                yield buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+            if buffer.tell():
+                yield buffer.getvalue().encode()
+
+        return csv_rows() if format == "csv" else ndjson()
+
+    async def get_resource_access_count(self, resource_id: str) -> int:
+        # Persisted count plus increments still waiting to be flushed
+        access_count = await self.db_service.get_access_count(resource_id)
+        if access_count is None:
             raise ResourceNotFoundError
-        return self.db_service.get_entry(resource_id).access_count
+        return access_count
 
-    def update_resource(self, resource_id: str, new_content: str):
-        if not self.db_service.resource_exists(id=resource_id):
+    async def update_resource(self, resource_id: str, new_content: str):
+        if not await self.db_service.resource_exists(id=resource_id):
             raise ResourceNotFoundError
-        self.db_service.update_entry(resource_id, new_content)
-        return self.db_service.get_entry(resource_id)
+        await self.db_service.update_entry(resource_id, new_content)
+        return await self.db_service.get_entry(resource_id)
 
-    def delete_resource(self, resource_id: str) -> Resource:
-        if not self.db_service.resource_exists(id=resource_id):
+    async def delete_resource(self, resource_id: str) -> Resource:
+        resource = await self.db_service.delete_entry(resource_id)
+        if resource is None:
             raise ResourceNotFoundError
-        return self.db_service.delete_entry(resource_id)
+        return resource
 
-    def delete_all_resources(self):
-        self.db_service.delete_all_entries()
+    async def delete_all_resources(self):
+        await self.db_service.delete_all_entries()
         return True
+
+    def get_cache_stats(self) -> dict[str, int]:
+        return self.db_service.cache_stats()
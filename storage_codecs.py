@@ -0,0 +1,116 @@
+# Transparent compression of stored text snippet content
+#
+# CONTENT_CODEC                codec for content above the threshold: "gzip"
+#                              (default), "zlib", "lzma" or "identity" to store
+#                              everything uncompressed
+# CONTENT_COMPRESS_THRESHOLD   characters of content below which it is stored
+#                              as plain text (default 1024)
+#
+# Compressed blobs hold the JSON document GET /{resource_id} responds with,
+# not the bare text, so a codec that is also an HTTP content coding (gzip, and
+# zlib as "deflate") can be sent as the response body as stored, without
+# decompressing and recompressing it.
+
+import gzip
+import json
+import lzma
+import zlib
+from dataclasses import dataclass
+from typing import Callable, Iterable, Protocol
+from env import getenv
+
+
+class Compressor(Protocol):
+    def compress(self, data: bytes) -> bytes: ...
+
+    def flush(self) -> bytes: ...
+
+
+@dataclass(frozen=True)
+class Codec:
+    name: str
+    encode: Callable[[bytes], bytes]
+    decode: Callable[[bytes], bytes]
+    # Content-Encoding a client can decode the stored bytes with, if any
+    http_encoding: str | None = None
+    # Encodes a payload chunk by chunk, for content that arrives streamed
+    compressor: Callable[[], Compressor] | None = None
+
+
+CODECS: dict[str, Codec] = {}
+
+
+def register_codec(codec: Codec) -> None:
+    CODECS[codec.name] = codec
+
+
+register_codec(
+    Codec(
+        "gzip",
+        lambda data: gzip.compress(data, mtime=0),
+        gzip.decompress,
+        "gzip",
+        lambda: zlib.compressobj(wbits=31),
+    )
+)
+register_codec(
+    Codec("zlib", zlib.compress, zlib.decompress, "deflate", zlib.compressobj)
+)
+register_codec(Codec("lzma", lzma.compress, lzma.decompress, None, lzma.LZMACompressor))
+
+
+def json_payload(content: str) -> bytes:
+    # Same bytes as JSONResponse renders for content
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode()
+
+
+def decode_payload(codec: str, data: bytes) -> str:
+    return json.loads(CODECS[codec].decode(data))
+
+
+class StorageCodec:
+    """Decides how a blob's content is stored: as text, or as compressed bytes."""
+
+    def __init__(self, codec: str = "gzip", threshold: int = 1024):
+        if codec != "identity" and codec not in CODECS:
+            raise ValueError(f"Unsupported CONTENT_CODEC: {codec}")
+        self.codec = codec
+        self.threshold = threshold
+
+    def encode(self, content: str) -> tuple[str | None, bytes | None]:
+        """The codec and compressed payload for content, or (None, None) to
+        store it as plain text."""
+        if self.codec == "identity" or len(content) < self.threshold:
+            return None, None
+        payload = json_payload(content)
+        data = CODECS[self.codec].encode(payload)
+        # Incompressible content is not worth decoding on every read
+        if len(data) >= len(payload):
+            return None, None
+        return self.codec, data
+
+    def encode_chunks(
+        self, length: int, size: int, payload: Iterable[bytes]
+    ) -> tuple[str | None, bytes | None]:
+        """Like encode(), for content of length characters given as the chunks
+        of its size byte JSON payload. Only the compressed bytes are held."""
+        if self.codec == "identity" or length < self.threshold:
+            return None, None
+        codec = CODECS[self.codec]
+        if codec.compressor is None:
+            return self.encode(json.loads(b"".join(payload)))
+        compressor = codec.compressor()
+        parts = [compressor.compress(chunk) for chunk in payload]
+        parts.append(compressor.flush())
+        data = b"".join(parts)
+        if len(data) >= size:
+            return None, None
+        return self.codec, data
+
+
+storage_codec = StorageCodec(
+    codec=getenv("CONTENT_CODEC", "gzip"),
+    threshold=int(getenv("CONTENT_COMPRESS_THRESHOLD", "1024")),
+)
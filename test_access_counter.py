@@ -0,0 +1,58 @@
+import sqlalchemy
+from sqlalchemy.orm import Session
+from access_counter import AccessCounter
+from resource_entity import Base, ResourceEntity
+
+
+def make_engine():
+    engine = sqlalchemy.create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(ResourceEntity(id="a", content="A", type="text", access_count=2))
+        session.add(ResourceEntity(id="b", content="B", type="link", access_count=0))
+        session.commit()
+    return engine
+
+
+def access_counts(engine) -> dict[str, int]:
+    with Session(engine) as session:
+        return {e.id: e.access_count for e in session.query(ResourceEntity).all()}
+
+
+def test_increments_are_buffered_until_flush():
+    engine = make_engine()
+    counter = AccessCounter(engine, flush_interval=60)
+    counter.increment("a")
+    counter.increment("a")
+    counter.increment("b")
+    assert counter.pending("a") == 2
+    assert access_counts(engine) == {"a": 2, "b": 0}
+
+    assert counter.flush() == 2
+    assert counter.pending("a") == 0
+    assert access_counts(engine) == {"a": 4, "b": 1}
+
+
+def test_stop_flushes_pending_increments():
+    engine = make_engine()
+    counter = AccessCounter(engine, flush_interval=60)
+    counter.start()
+    counter.increment("b")
+    counter.stop()
+    assert access_counts(engine)["b"] == 1
+
+
+def test_zero_interval_writes_through():
+    engine = make_engine()
+    counter = AccessCounter(engine, flush_interval=0)
+    counter.increment("a")
+    assert access_counts(engine)["a"] == 3
+
+
+def test_discarded_ids_are_not_flushed():
+    engine = make_engine()
+    counter = AccessCounter(engine, flush_interval=60)
+    counter.increment("a")
+    counter.discard("a")
+    assert counter.flush() == 0
+    assert access_counts(engine)["a"] == 2
@@ -0,0 +1,89 @@
+import threading
+import time
+import pytest
+import sqlalchemy
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+import bulk_delete
+from bulk_delete import BulkDeleter, DeleteJob
+from models import Type
+from query_builder import InvalidFilterError, ResourceQuery
+from resource_entity import Base, ResourceEntity
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'bulk.db'}")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        for i in range(7):
+            session.add(
+                ResourceEntity(id=f"imp-{i}", content="x", type="link", access_count=i)
+            )
+        session.add(ResourceEntity(id="keep", content="x", type="link"))
+        session.add(ResourceEntity(id="imp_text", content="x", type="text"))
+        session.commit()
+    return engine
+
+
+def remaining(engine) -> set[str]:
+    with Session(engine) as session:
+        return {entity.id for entity in session.query(ResourceEntity)}
+
+
+def test_run_deletes_matching_rows_in_batches(engine):
+    batches = []
+    deleter = BulkDeleter(engine, batch_size=2, on_deleted=batches.append)
+    query = ResourceQuery(resource_type=Type.url, id_prefix="imp-", min_access_count=1)
+    job = DeleteJob(query)
+    deleter.run(job, query.where())
+
+    assert job.stats()["status"] == "done"
+    assert job.deleted == 6
+    assert [len(batch) for batch in batches] == [2, 2, 2]
+    assert remaining(engine) == {"imp-0", "keep", "imp_text"}
+
+
+def test_submit_requires_a_filter(engine):
+    deleter = BulkDeleter(engine)
+    with pytest.raises(InvalidFilterError):
+        deleter.submit(ResourceQuery())
+    assert remaining(engine) >= {"keep"}
+
+
+def test_run_waits_for_locked_rows_and_deletes_them(engine, monkeypatch):
+    # Another transaction, e.g. an access count flush, holds a row
+    locked = threading.Event()
+
+    def hold_lock():
+        with engine.begin() as connection:
+            connection.execute(
+                update(ResourceEntity)
+                .where(ResourceEntity.id == "imp-3")
+                .values(access_count=ResourceEntity.access_count + 1)
+            )
+            locked.set()
+            time.sleep(0.3)
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    assert locked.wait(5)
+    # A batch that leaves a row out, as SKIP LOCKED would, is not the last one
+    delete_batch = bulk_delete.delete_batch
+    calls = []
+
+    def short_first_batch(connection, where, batch_size, **kwargs):
+        calls.append(batch_size)
+        size = batch_size - 1 if len(calls) == 1 else batch_size
+        return delete_batch(connection, where, size, **kwargs)
+
+    monkeypatch.setattr(bulk_delete, "delete_batch", short_first_batch)
+    deleter = BulkDeleter(engine, batch_size=3)
+    query = ResourceQuery(id_prefix="imp-")
+    job = DeleteJob(query)
+    deleter.run(job, query.where())
+    holder.join()
+
+    assert job.stats()["status"] == "done"
+    assert job.deleted == 7
+    assert remaining(engine) == {"keep", "imp_text"}
@@ -0,0 +1,58 @@
+from cache import ResourceCache
+from models import ResourceRecord, Type
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_resource(id: str) -> ResourceRecord:
+    return ResourceRecord(
+        id=id, content=f"content {id}", type=Type.text, expires_at=None, version=1
+    )
+
+
+def test_cache_hit_and_miss():
+    cache = ResourceCache(max_size=2, ttl=10)
+    assert cache.get("a") is None
+    cache.put("a", make_resource("a"))
+    assert cache.get("a").content == "content a"
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+
+
+def test_cache_evicts_least_recently_used():
+    cache = ResourceCache(max_size=2, ttl=10)
+    cache.put("a", make_resource("a"))
+    cache.put("b", make_resource("b"))
+    cache.get("a")
+    cache.put("c", make_resource("c"))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_cache_entries_expire():
+    clock = FakeClock()
+    cache = ResourceCache(max_size=2, ttl=5, clock=clock)
+    cache.put("a", make_resource("a"))
+    clock.now = 4.9
+    assert cache.get("a") is not None
+    clock.now = 5.0
+    assert cache.get("a") is None
+
+
+def test_cache_invalidation():
+    cache = ResourceCache(max_size=2, ttl=10)
+    cache.put("a", make_resource("a"))
+    cache.put("b", make_resource("b"))
+    cache.invalidate("a")
+    assert cache.get("a") is None
+    cache.clear()
+    assert cache.stats()["size"] == 0
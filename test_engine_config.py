@@ -0,0 +1,44 @@
+import sqlalchemy
+from sqlalchemy.pool import NullPool, StaticPool
+from engine_config import (
+    InstrumentedQueuePool,
+    async_url,
+    engine_options,
+    pool_status,
+)
+
+
+def test_queue_pool_options(monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE", "3")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "1")
+    monkeypatch.setenv("DB_POOL_PRE_PING", "true")
+    monkeypatch.setenv("DB_STATEMENT_TIMEOUT_MS", "1500")
+    options = engine_options("postgresql+psycopg://user:pw@localhost/db")
+    assert options["poolclass"] is InstrumentedQueuePool
+    assert options["pool_size"] == 3
+    assert options["max_overflow"] == 1
+    assert options["pool_pre_ping"] is True
+    assert options["connect_args"] == {"options": "-c statement_timeout=1500"}
+
+
+def test_null_pool_mode(monkeypatch):
+    monkeypatch.setenv("DB_POOL_MODE", "null")
+    options = engine_options("postgresql+psycopg://user:pw@localhost/db")
+    assert options["poolclass"] is NullPool
+    assert "pool_size" not in options
+
+
+def test_sqlite_memory_uses_static_pool():
+    assert engine_options("sqlite://")["poolclass"] is StaticPool
+    assert async_url("sqlite:///test.db") == "sqlite+aiosqlite:///test.db"
+
+
+def test_pool_status_tracks_checkouts(tmp_path):
+    url = f"sqlite:///{tmp_path / 'pool.db'}"
+    engine = sqlalchemy.create_engine(url, **engine_options(url))
+    with engine.connect():
+        status = pool_status(engine)
+        assert status["checked_out"] == 1
+    status = pool_status(engine)
+    assert status["checked_out"] == 0
+    assert status["checkouts"] == 1
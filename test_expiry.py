@@ -0,0 +1,58 @@
+import datetime
+import sqlalchemy
+from sqlalchemy.orm import Session
+from expiry import ExpiryReaper
+from resource_entity import Base, ResourceEntity
+
+NOW = datetime.datetime(2025, 6, 1)
+
+
+def make_engine(tmp_path):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'expiry.db'}")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        for i in range(5):
+            session.add(
+                ResourceEntity(
+                    id=f"expired-{i}",
+                    content="x",
+                    type="text",
+                    expires_at=NOW - datetime.timedelta(hours=i + 1),
+                )
+            )
+        session.add(
+            ResourceEntity(
+                id="active",
+                content="x",
+                type="text",
+                expires_at=NOW + datetime.timedelta(hours=1),
+            )
+        )
+        session.add(ResourceEntity(id="forever", content="x", type="text"))
+        session.commit()
+    return engine
+
+
+def test_reaper_deletes_expired_rows_in_batches(tmp_path):
+    engine = make_engine(tmp_path)
+    batches = []
+    reaper = ExpiryReaper(engine, batch_size=2, on_reaped=batches.append)
+
+    assert reaper.reap(now=NOW) == 5
+    # Oldest first, never more than batch_size per transaction
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert set(batches[0]) == {"expired-4", "expired-3"}
+    with Session(engine) as session:
+        remaining = {entity.id for entity in session.query(ResourceEntity)}
+    assert remaining == {"active", "forever"}
+
+    stats = reaper.stats()
+    assert stats["rows_reaped"] == 5
+    assert stats["runs"] == 1
+    # expired-4 had waited five hours
+    assert stats["lag_seconds"] == 5 * 3600
+
+    assert reaper.reap(now=NOW + datetime.timedelta(minutes=90)) == 1
+    assert reaper.stats()["lag_seconds"] == 30 * 60
+    assert reaper.reap(now=NOW + datetime.timedelta(minutes=90)) == 0
+    assert reaper.stats()["lag_seconds"] == 0.0
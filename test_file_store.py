@@ -0,0 +1,33 @@
+import time
+import sqlalchemy
+from sqlalchemy.orm import Session
+from file_store import FileBlobStore
+from resource_entity import Base, ContentBlobEntity
+
+
+def test_write_is_sharded_and_reused(tmp_path):
+    store = FileBlobStore(tmp_path)
+    path = store.write("abcdef", [b"one", b"two"])
+    assert path == tmp_path / "ab" / "cd" / "abcdef"
+    assert path.read_bytes() == b"onetwo"
+    # Content-addressed: an existing file is kept as it is
+    assert store.write("abcdef", [b"other"]).read_bytes() == b"onetwo"
+    assert list(store.files()) == [path]
+
+
+def test_sweep_deletes_old_unreferenced_files(tmp_path):
+    engine = sqlalchemy.create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(
+            ContentBlobEntity(hash="kept00", size=1, refcount=1, backend="file")
+        )
+        session.commit()
+    store = FileBlobStore(tmp_path / "blobs", grace=60)
+    kept = store.write("kept00", [b"x"])
+    orphan = store.write("orphan", [b"x"])
+
+    assert store.sweep(engine) == 0
+    assert store.sweep(engine, now=time.time() + 120) == 1
+    assert kept.exists()
+    assert not orphan.exists()
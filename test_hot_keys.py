@@ -0,0 +1,126 @@
+import random
+import threading
+from fastapi.responses import RedirectResponse
+from fastapi.testclient import TestClient
+from hot_keys import (
+    CountMinSketch,
+    HotKeyTracker,
+    HotResponseCache,
+    hot_responses,
+)
+from main import app
+
+
+def test_count_min_sketch_never_underestimates():
+    sketch = CountMinSketch(width=64, depth=4)
+    counts = {f"key{i}": i % 7 + 1 for i in range(200)}
+    for key, count in counts.items():
+        for _ in range(count):
+            sketch.add(key)
+    assert all(sketch.add(key) > count for key, count in counts.items())
+
+
+def test_tracker_finds_heavy_hitters_in_skewed_traffic():
+    tracker = HotKeyTracker(capacity=5, decay_interval=10**9)
+    rng = random.Random(7)
+    viral = [f"viral{i}" for i in range(5)]
+    for _ in range(20000):
+        tracker.record(
+            rng.choice(viral) if rng.random() < 0.5 else f"tail{rng.randrange(10**5)}"
+        )
+    assert {key for key, _ in tracker.hot_set()} == set(viral)
+    assert not tracker.record("tail-new")
+
+
+def test_tracker_decays_counts():
+    tracker = HotKeyTracker(capacity=1, decay_interval=4)
+    for _ in range(3):
+        tracker.record("old")
+    tracker.record("old")
+    assert tracker.hot_set() == [("old", 2)]
+
+
+def test_hot_links_are_served_from_pinned_responses(monkeypatch):
+    monkeypatch.setattr(hot_responses, "tracker", HotKeyTracker(capacity=4))
+    with TestClient(app) as client:
+        client.post(
+            "/shorten-url",
+            json={
+                "id": "",
+                "content": "https://example.com/viral",
+                "vanity_url": "viral",
+                "type": "link",
+            },
+        )
+        hits = hot_responses.hits
+        for _ in range(3):
+            response = client.get("/viral", follow_redirects=False)
+            assert response.status_code == 307
+            assert response.headers["location"] == "https://example.com/viral"
+            assert "X-Request-ID" in response.headers
+        assert hot_responses.hits == hits + 2
+        assert client.get("/admin/resources/viral").json() == 3
+        assert {"id": "viral", "estimate": 3, "pinned": True} in client.get(
+            "/admin/hot-keys"
+        ).json()["hot"]
+
+        # Updates and deletes are seen at once
+        client.patch("/admin/resources/viral", json="https://example.com/moved")
+        response = client.get("/viral", follow_redirects=False)
+        assert response.headers["location"] == "https://example.com/moved"
+        client.delete("/admin/resources/viral")
+        assert client.get("/viral", follow_redirects=False).status_code == 404
+        client.delete("/admin/resources/all")
+
+
+def test_responses_read_before_an_invalidation_are_not_pinned():
+    cache = HotResponseCache(HotKeyTracker(capacity=4))
+    cache.record("link")
+    generation = cache.generation
+    # Updated while the request read version 1
+    cache.invalidate("link")
+    cache.pin("link", RedirectResponse("https://example.com/old"), None, 1, generation)
+    assert cache.get("link") is None
+
+    cache.pin(
+        "link", RedirectResponse("https://example.com/new"), None, 2, cache.generation
+    )
+    # A request that read the old version later still cannot replace it
+    cache.pin(
+        "link", RedirectResponse("https://example.com/old"), None, 1, cache.generation
+    )
+    assert cache.get("link").version == 2
+
+
+def test_invalidate_waits_for_a_pin_in_progress():
+    pruning = threading.Event()
+    resume = threading.Event()
+
+    class SlowTracker(HotKeyTracker):
+        calls = 0
+
+        def is_hot(self, key):
+            if threading.current_thread().name == "pin":
+                self.calls += 1
+                # The first call checks the id, the second prunes under the lock
+                if self.calls == 2:
+                    pruning.set()
+                    resume.wait(5)
+            return super().is_hot(key)
+
+    cache = HotResponseCache(SlowTracker(capacity=1))
+    cache.record("link")
+    cache.pin("link", RedirectResponse("https://example.com/1"), None, 1, 0)
+    pin = threading.Thread(
+        target=cache.pin,
+        args=("link", RedirectResponse("https://example.com/2"), None, 2, 0),
+        name="pin",
+    )
+    pin.start()
+    assert pruning.wait(5)
+    invalidate = threading.Thread(target=cache.invalidate, args=("link",))
+    invalidate.start()
+    resume.set()
+    pin.join(5)
+    invalidate.join(5)
+    assert cache.get("link") is None
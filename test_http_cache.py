@@ -0,0 +1,93 @@
+import datetime
+import pytest
+from http_cache import (
+    HttpCachePolicy,
+    accepted_encodings,
+    etag,
+    etag_matches,
+    max_age,
+)
+from models import ResourceRecord, StoredBody, Type
+from resource_entity import ContentBlobEntity
+from storage_codecs import CODECS, json_payload
+
+NOW = datetime.datetime(2025, 6, 1).timestamp()
+
+
+def record(content: str = "hello", type: Type = Type.text) -> ResourceRecord:
+    return ResourceRecord(
+        id="a", content=content, type=type, expires_at=None, version=1
+    )
+
+
+def test_etag_changes_with_version_and_content():
+    resource = record()
+    tag = etag(resource)
+    assert etag(resource._replace(version=2)) != tag
+    assert etag(resource._replace(content="bye")) != tag
+    assert etag_matches(tag, tag)
+    assert etag_matches(f'"other", W/{tag}', tag)
+    assert etag_matches("*", tag)
+    assert not etag_matches('"other"', tag)
+
+
+def test_etag_is_the_same_for_stored_and_loaded_content():
+    resource = record("hello")
+    stored = record("")._replace(
+        stored_body=StoredBody(ContentBlobEntity.hash_of("hello"), path="unused")
+    )
+    assert etag(stored) == etag(resource)
+
+
+def test_max_age_is_capped_by_expiry():
+    forever = record("x")
+    soon = forever._replace(expires_at=int(NOW) + 90)
+    assert max_age(forever, NOW, 3600) == 3600
+    assert max_age(soon, NOW, 3600) == 90
+    assert max_age(soon, NOW + 3600, 3600) == 0
+
+
+def test_text_response_answers_304_on_match():
+    policy = HttpCachePolicy(text_max_age=60)
+    resource = record()
+    response = policy.text_response(resource, NOW)
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "public, max-age=60"
+
+    response = policy.text_response(resource, NOW, response.headers["ETag"])
+    assert response.status_code == 304
+    assert response.body == b""
+
+
+def test_stored_bodies_are_sent_as_stored_or_decoded():
+    payload = json_payload("compressed é")
+    body = StoredBody("f" * 64, codec="gzip", data=CODECS["gzip"].encode(payload))
+    resource = record("")._replace(stored_body=body)
+    policy = HttpCachePolicy()
+
+    response = policy.text_response(resource, NOW, accept_encoding="gzip")
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.body == body.data
+    response = policy.text_response(resource, NOW)
+    assert "Content-Encoding" not in response.headers
+    assert response.body == payload
+
+
+def test_permanent_redirects_only_while_cacheable():
+    policy = HttpCachePolicy(redirect_mode="permanent", redirect_max_age=600)
+    link = record("https://example.com/", Type.url)
+    response = policy.redirect_response(link, NOW)
+    assert response.status_code == 308
+    assert response.headers["Cache-Control"] == "public, max-age=600"
+
+    expiring = link._replace(expires_at=int(NOW))
+    assert policy.redirect_response(expiring, NOW).status_code == 307
+    assert HttpCachePolicy().redirect_response(link, NOW).status_code == 307
+
+    with pytest.raises(ValueError):
+        HttpCachePolicy(redirect_mode="forever")
+
+
+def test_accepted_encodings_skip_refused_codings():
+    assert accepted_encodings("gzip, deflate;q=0.5, br;q=0") == {"gzip", "deflate"}
+    assert accepted_encodings(None) == set()
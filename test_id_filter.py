@@ -0,0 +1,128 @@
+import asyncio
+import datetime
+import time
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+from access_counter import AccessCounter
+from cache import ResourceCache
+from database import DatabaseService
+from database_startup import engine, id_filter
+from id_filter import BloomFilter, IdFilter
+from main import app
+from models import Resource, Type
+from resource_entity import ResourceEntity
+
+
+def test_bloom_filter_has_no_false_negatives_and_the_configured_fp_rate():
+    bloom = BloomFilter(capacity=10000, fp_rate=0.01)
+    for i in range(10000):
+        bloom.add(f"id{i}")
+    assert all(f"id{i}" in bloom for i in range(10000))
+    false_positives = sum(f"other{i}" in bloom for i in range(10000))
+    assert false_positives < 200
+    assert abs(bloom.false_positive_rate() - 0.01) < 0.002
+    # About 9.6 bits per id at 1%
+    assert 11000 < bloom.nbytes < 13000
+
+
+def test_filter_is_built_from_a_scan_and_catches_up_with_other_workers():
+    with Session(engine) as session:
+        session.add(
+            ResourceEntity.from_model(
+                Resource(id="scanned", content="x", type=Type.url)
+            )
+        )
+        session.commit()
+    clock = [0.0]
+    filter = IdFilter(engine, capacity=100, negative_ttl=5, clock=lambda: clock[0])
+    assert filter.might_exist("anything")  # Not built yet
+
+    filter.rebuild()
+    assert filter.might_exist("scanned")
+    assert not filter.might_exist("never-created")
+
+    # Inserted by another worker
+    with Session(engine) as session:
+        session.add(
+            ResourceEntity.from_model(
+                Resource(id="elsewhere", content="x", type=Type.url)
+            )
+        )
+        session.commit()
+    assert filter.catch_up() >= 1
+    assert filter.might_exist("elsewhere")
+
+    # Deleted ids are answered by the negative cache until it expires
+    filter.discard(["scanned"])
+    assert not filter.might_exist("scanned")
+    clock[0] = 6
+    assert filter.might_exist("scanned")
+    # Added again locally
+    filter.discard(["elsewhere"])
+    filter.add(["elsewhere"])
+    assert filter.might_exist("elsewhere")
+
+    with Session(engine) as session:
+        session.query(ResourceEntity).filter(
+            ResourceEntity.id.in_(["scanned", "elsewhere"])
+        ).delete()
+        session.commit()
+
+
+def test_catch_up_finds_rows_committed_after_the_watermark_with_an_earlier_created_at():
+    filter = IdFilter(engine, capacity=100)
+    filter.rebuild()
+    watermark = filter._watermark
+    # Inserted, with its created_at, just before the scan, committed after it
+    with Session(engine) as session:
+        entity = ResourceEntity.from_model(
+            Resource(id="slow-commit", content="x", type=Type.url)
+        )
+        entity.created_at = watermark - datetime.timedelta(seconds=2)
+        session.add(entity)
+        session.commit()
+    assert not filter.might_exist("slow-commit")
+    filter.catch_up()
+    assert filter.might_exist("slow-commit")
+
+    # A request that spent long before the insert is stamped at the insert
+    arrived = datetime.datetime.now() - datetime.timedelta(minutes=1)
+    service = DatabaseService(
+        Session(engine), ResourceCache(), AccessCounter(engine, flush_interval=0)
+    )
+    resource = Resource(id="slow-request", content="x", type=Type.url)
+    resource.created_at = arrived
+    asyncio.run(service.add_entry(resource))
+    assert resource.created_at > arrived
+    filter.catch_up()
+    assert filter.might_exist("slow-request")
+
+    with Session(engine) as session:
+        session.query(ResourceEntity).filter(
+            ResourceEntity.id.in_(["slow-commit", "slow-request"])
+        ).delete()
+        session.commit()
+
+
+def test_unknown_ids_are_rejected_without_a_query():
+    with TestClient(app) as client:
+        deadline = time.monotonic() + 5
+        while not id_filter.stats()["ready"] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        before = client.get("/admin/metrics/id-filter").json()
+        assert before["ready"] == 1
+        assert before["bytes"] > 0
+
+        assert client.get("/no-such-resource").status_code == 404
+        client.post(
+            "/create-text",
+            json={"id": "", "content": "new", "vanity_url": "fresh", "type": "text"},
+        )
+        assert client.get("/fresh").status_code == 200
+        client.delete("/admin/resources/fresh")
+        assert client.get("/fresh").status_code == 404
+
+        after = client.get("/admin/metrics/id-filter").json()
+        assert after["rejections"] == before["rejections"] + 1
+        assert after["negative_hits"] == before["negative_hits"] + 1
+        client.delete("/admin/resources/all")
@@ -0,0 +1,127 @@
+import asyncio
+import datetime
+import pytest
+import sqlalchemy
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from id_generator import (
+    IdPoolExhaustedError,
+    PooledIdGenerator,
+    SnowflakeIdGenerator,
+    BASE62_ALPHABET,
+    base62_encode,
+    create_id_generator,
+)
+from resource_entity import Base, ResourceEntity, ReservedIdEntity
+
+
+def test_base62_encode():
+    assert base62_encode(0) == "0"
+    assert base62_encode(61) == "Z"
+    assert base62_encode(62) == "10"
+
+
+def test_snowflake_ids_are_unique_per_worker():
+    first = SnowflakeIdGenerator(worker_id=1)
+    second = SnowflakeIdGenerator(worker_id=2)
+    ids = [first.next_id() for _ in range(5000)]
+    ids += [second.next_id() for _ in range(5000)]
+    assert len(set(ids)) == len(ids)
+
+
+def test_snowflake_requires_an_explicit_worker_id(monkeypatch):
+    monkeypatch.delenv("ID_WORKER_ID", raising=False)
+    with pytest.raises(ValueError, match="ID_WORKER_ID"):
+        create_id_generator("snowflake", None)
+    monkeypatch.setenv("ID_WORKER_ID", "7")
+    assert create_id_generator("snowflake", None).worker_id == 7
+
+
+def test_pool_skips_taken_and_reserved_ids():
+    engine = sqlalchemy.create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    first = PooledIdGenerator(engine, pool_size=50, low_water=10, length=1)
+    second = PooledIdGenerator(engine, pool_size=50, low_water=10, length=1)
+    first.refill()
+    second.refill()
+    pooled = [first.next_id() for _ in range(first.available())]
+    pooled += [second.next_id() for _ in range(second.available())]
+    # Only 62 single character ids exist, and no id may be handed out twice
+    assert len(pooled) == len(set(pooled)) <= 62
+
+    with Session(engine) as session:
+        reservations = session.scalar(
+            select(func.count()).select_from(ReservedIdEntity)
+        )
+    assert reservations == len(pooled)
+
+
+def test_pool_release_returns_unused_ids():
+    engine = sqlalchemy.create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(ResourceEntity(id="a", content="A", type="text", vanity_url="b"))
+        session.commit()
+    pool = PooledIdGenerator(engine, pool_size=62, length=1)
+    pool.refill()
+    pooled = [id for id, _ in pool._pool]
+    assert 0 < len(pooled) <= 60
+    assert "a" not in pooled and "b" not in pooled
+    pool.release()
+    assert pool.available() == 0
+    with Session(engine) as session:
+        assert session.scalar(select(func.count()).select_from(ReservedIdEntity)) == 0
+
+
+def test_exhausted_pool_gives_up_after_bounded_refills(tmp_path):
+    # A file, so the refill in the threadpool sees the same database
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path}/ids.db")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all(ReservedIdEntity(id=id) for id in BASE62_ALPHABET)
+        session.commit()
+    pool = PooledIdGenerator(engine, pool_size=10, length=1)
+    refills = 0
+    refill = pool.refill
+
+    def counted_refill():
+        nonlocal refills
+        refills += 1
+        return refill()
+
+    pool.refill = counted_refill
+    with pytest.raises(IdPoolExhaustedError):
+        pool.next_id()
+    assert refills == 3
+    with pytest.raises(IdPoolExhaustedError):
+        asyncio.run(pool.next_id_async())
+
+
+def test_stale_reservations_are_reclaimed_and_never_handed_out():
+    engine = sqlalchemy.create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    # Left behind by a worker that was killed a week ago
+    with Session(engine) as session:
+        session.add_all(
+            ReservedIdEntity(
+                id=id, reserved_at=datetime.datetime.now() - datetime.timedelta(days=7)
+            )
+            for id in BASE62_ALPHABET
+        )
+        session.commit()
+    clock = [0.0]
+    pool = PooledIdGenerator(
+        engine, pool_size=10, length=1, reservation_ttl=3600, clock=lambda: clock[0]
+    )
+    # Reclaimed first, or no single character id would be free
+    assert pool.refill() > 0
+    first = [id for id, _ in pool._pool]
+    with Session(engine) as session:
+        reservations = set(session.scalars(select(ReservedIdEntity.id)))
+    assert reservations == set(first)
+
+    # Past half the TTL the pooled ids are dropped, not handed out
+    clock[0] = 1801
+    # They stay reserved until reclaimed, so the refill picks other ids
+    assert pool.next_id() not in first
+    assert all(reserved_at == 1801 for _, reserved_at in pool._pool)
@@ -0,0 +1,75 @@
+import json
+import logging
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from log_config import (
+    JsonFormatter,
+    LogPipeline,
+    RequestIdFilter,
+    RequestIdMiddleware,
+    SamplingFilter,
+    request_id,
+)
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records: list[logging.LogRecord] = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def _record(level: int) -> logging.LogRecord:
+    return logging.LogRecord("database", level, __file__, 1, "message", (), None)
+
+
+def test_sampling_filter_keeps_records_above_debug():
+    never = SamplingFilter(0.5, random=lambda: 0.9)
+    assert not never.filter(_record(logging.DEBUG))
+    assert never.filter(_record(logging.INFO))
+    assert SamplingFilter(0.5, random=lambda: 0.1).filter(_record(logging.DEBUG))
+
+
+def test_request_id_filter_reads_context():
+    token = request_id.set("abc")
+    try:
+        record = _record(logging.INFO)
+        RequestIdFilter().filter(record)
+    finally:
+        request_id.reset(token)
+    assert record.request_id == "abc"
+    assert json.loads(JsonFormatter().format(record))["request_id"] == "abc"
+
+
+def test_pipeline_delivers_records_off_thread():
+    handler = ListHandler()
+    pipeline = LogPipeline(level="DEBUG", db_sample_rate=0.0, handler=handler)
+    pipeline.start()
+    try:
+        logging.getLogger("services").info("kept")
+        logging.getLogger("database").debug("sampled out")
+        logging.getLogger("database").warning("kept")
+    finally:
+        pipeline.stop()
+    assert [record.name for record in handler.records] == ["services", "database"]
+    assert all(record.request_id == "-" for record in handler.records)
+
+
+def test_middleware_sets_and_echoes_request_id():
+    app = FastAPI()
+    app.add_middleware(RequestIdMiddleware)
+
+    @app.get("/")
+    async def index() -> str:
+        return request_id.get()
+
+    client = TestClient(app)
+    response = client.get("/", headers={"X-Request-ID": "upstream-1"})
+    assert response.json() == "upstream-1"
+    assert response.headers["X-Request-ID"] == "upstream-1"
+
+    response = client.get("/", headers={"X-Request-ID": "not valid\n"})
+    assert response.json() == response.headers["X-Request-ID"]
+    assert response.json() != "not valid\n"
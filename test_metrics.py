@@ -0,0 +1,72 @@
+import re
+import sqlalchemy
+from fastapi.testclient import TestClient
+from main import app
+from metrics import Histogram, QueryStats, instrument_engine, request_queries
+
+
+def sample(text: str, name: str, **labels: str) -> float:
+    label = ",".join(f'{key}="{value}"' for key, value in labels.items())
+    pattern = "^" + re.escape(f"{name}{{{label}}}" if labels else name) + r" (\S+)"
+    match = re.search(pattern, text, re.MULTILINE)
+    return float(match.group(1)) if match else 0
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("latency_seconds", "Latency", ("route",), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, "/a")
+    lines = list(histogram.render())
+    assert 'latency_seconds_bucket{route="/a",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="/a",le="1"} 2' in lines
+    assert 'latency_seconds_bucket{route="/a",le="+Inf"} 3' in lines
+    assert 'latency_seconds_sum{route="/a"} 5.55' in lines
+    assert 'latency_seconds_count{route="/a"} 3' in lines
+
+
+def test_statements_are_counted_per_request_context():
+    engine = sqlalchemy.create_engine("sqlite://")
+    instrument_engine(engine)
+    stats = QueryStats()
+    token = request_queries.set(stats)
+    with engine.connect() as connection:
+        connection.execute(sqlalchemy.text("SELECT 1"))
+        connection.execute(sqlalchemy.text("SELECT 2"))
+    request_queries.reset(token)
+    assert stats.statements == 2
+    assert stats.seconds > 0
+
+
+def test_metrics_endpoint():
+    labels = {"route": "/create-text", "method": "POST"}
+    with TestClient(app) as client:
+        before = sample(
+            client.get("/admin/metrics/prometheus").text,
+            "http_request_db_statements_count",
+            **labels,
+        )
+        client.post(
+            "/create-text",
+            json={"id": "", "content": "measured", "type": "text"},
+        )
+        client.get("/some-unknown-id")
+        text = client.get("/admin/metrics/prometheus").text
+        client.delete("/admin/resources/all")
+
+    assert text.startswith("# HELP")
+    assert sample(text, "http_request_db_statements_count", **labels) == before + 1
+    assert sample(text, "http_request_db_statements_sum", **labels) >= 1
+    assert (
+        sample(
+            text,
+            "http_requests_total",
+            route="/{resource_id}",
+            method="GET",
+            status="404",
+        )
+        >= 1
+    )
+    assert sample(text, "service_call_duration_seconds_count", method="get_resource")
+    assert sample(text, "db_statements_total") > 0
+    assert sample(text, "resource_cache_max_size") > 0
+    assert sample(text, "db_pool_checkouts", engine="sync") > 0
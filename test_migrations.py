@@ -0,0 +1,103 @@
+import datetime
+import sqlalchemy
+from sqlalchemy import inspect, text
+from migrations import HEAD, current_version, migrate
+
+
+def test_migrate_fresh_database():
+    engine = sqlalchemy.create_engine("sqlite://")
+    assert migrate(engine) == list(range(1, HEAD + 1))
+    assert migrate(engine) == []
+
+    with engine.connect() as connection:
+        assert current_version(connection) == HEAD
+        indexes = {
+            index["name"]: index
+            for index in inspect(connection).get_indexes("resources")
+        }
+    assert indexes["ix_resources_vanity_url"]["unique"]
+    assert indexes["ix_resources_type_access_count"]["column_names"] == [
+        "type",
+        "access_count",
+    ]
+    assert "ix_resources_expires_at" in indexes
+
+
+def test_migrate_existing_rows():
+    engine = sqlalchemy.create_engine("sqlite://")
+    migrate(engine, target=1)
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "INSERT INTO resources (id, content, vanity_url, type, expiration_time, access_count) "
+                "VALUES (:id, 'x', :vanity_url, 'text', :expiration_time, 0)"
+            ),
+            [
+                {
+                    "id": "a",
+                    "vanity_url": "",
+                    "expiration_time": "2025-10-01 12:30:00.000001",
+                },
+                {"id": "b", "vanity_url": "  ", "expiration_time": "-1"},
+                {"id": "c", "vanity_url": "c", "expiration_time": None},
+            ],
+        )
+
+    assert migrate(engine) == list(range(2, HEAD + 1))
+
+    with engine.connect() as connection:
+        rows = {
+            row.id: row
+            for row in connection.execute(
+                text("SELECT id, vanity_url, expires_at FROM resources")
+            )
+        }
+    assert rows["a"].vanity_url is None
+    assert rows["b"].vanity_url is None
+    assert rows["c"].vanity_url == "c"
+    assert datetime.datetime.fromisoformat(
+        str(rows["a"].expires_at)
+    ) == datetime.datetime(2025, 10, 1, 12, 30, 0, 1)
+    assert rows["b"].expires_at is None
+
+
+def test_migrate_moves_text_content_into_blobs():
+    engine = sqlalchemy.create_engine("sqlite://")
+    migrate(engine, target=4)
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "INSERT INTO resources (id, content, type, access_count) "
+                "VALUES (:id, :content, :type, 0)"
+            ),
+            [
+                {"id": "a", "content": "same", "type": "text"},
+                {"id": "b", "content": "same", "type": "text"},
+                {"id": "c", "content": "other", "type": "text"},
+                {"id": "d", "content": "https://example.com/", "type": "link"},
+            ],
+        )
+
+    assert migrate(engine) == list(range(5, HEAD + 1))
+
+    with engine.connect() as connection:
+        blobs = dict(
+            connection.execute(
+                text("SELECT content, refcount FROM content_blobs")
+            ).all()
+        )
+        rows = {
+            row.id: row
+            for row in connection.execute(
+                text("SELECT id, content, content_hash FROM resources")
+            )
+        }
+        indexes = {
+            index["name"] for index in inspect(connection).get_indexes("resources")
+        }
+    assert blobs == {"same": 2, "other": 1}
+    assert rows["a"].content is None
+    assert rows["a"].content_hash == rows["b"].content_hash
+    assert rows["d"].content == "https://example.com/"
+    assert rows["d"].content_hash is None
+    assert {"ix_resources_vanity_url", "ix_resources_content_hash"} <= indexes
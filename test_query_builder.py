@@ -0,0 +1,119 @@
+import datetime
+import pytest
+import sqlalchemy
+from sqlalchemy.orm import Session
+from models import Type
+from query_builder import InvalidFilterError, ResourceQuery
+from resource_entity import Base, ResourceEntity
+
+NOW = datetime.datetime(2025, 6, 1)
+
+
+@pytest.fixture
+def session():
+    engine = sqlalchemy.create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all(
+            [
+                ResourceEntity(
+                    id="a",
+                    content="x" * 10,
+                    type="text",
+                    access_count=5,
+                    content_length=10,
+                    created_at=datetime.datetime(2025, 1, 1),
+                ),
+                ResourceEntity(
+                    id="b",
+                    content="https://b",
+                    type="link",
+                    access_count=1,
+                    content_length=9,
+                    created_at=datetime.datetime(2025, 2, 1),
+                    expires_at=datetime.datetime(2025, 5, 1),
+                ),
+                ResourceEntity(
+                    id="c",
+                    content="x" * 100,
+                    type="text",
+                    access_count=5,
+                    content_length=100,
+                    created_at=datetime.datetime(2025, 3, 1),
+                    expires_at=datetime.datetime(2025, 7, 1),
+                ),
+            ]
+        )
+        session.commit()
+        yield session
+
+
+def ids(session: Session, query: ResourceQuery) -> list[str]:
+    return [entity.id for entity in session.scalars(query.statement(now=NOW))]
+
+
+def test_filters_are_combined(session: Session):
+    assert ids(session, ResourceQuery()) == ["a", "b", "c"]
+    assert ids(session, ResourceQuery(resource_type=Type.text)) == ["a", "c"]
+    assert ids(session, ResourceQuery(access_count=(">=", 5))) == ["a", "c"]
+    assert ids(session, ResourceQuery(content_length=(">", 10))) == ["c"]
+    assert ids(session, ResourceQuery(expiry="expired")) == ["b"]
+    assert ids(session, ResourceQuery(expiry="active")) == ["a", "c"]
+    assert ids(session, ResourceQuery(expiry="never")) == ["a"]
+    assert ids(
+        session, ResourceQuery(created_after=datetime.datetime(2025, 1, 15))
+    ) == ["b", "c"]
+    assert ids(
+        session,
+        ResourceQuery(resource_type=Type.text, access_count=("=", 5), expiry="active"),
+    ) == ["a", "c"]
+    assert ids(session, ResourceQuery(min_access_count=1, max_access_count=4)) == ["b"]
+    assert ids(session, ResourceQuery(id_prefix="b")) == ["b"]
+    # Wildcards in the prefix match literally
+    assert ids(session, ResourceQuery(id_prefix="%")) == []
+
+
+def test_order_limit_and_keyset(session: Session):
+    query = ResourceQuery(order_by="access_count", descending=True, limit=2)
+    assert ids(session, query) == ["c", "a"]
+    last = session.get(ResourceEntity, "a")
+    next_page = ResourceQuery(
+        order_by="access_count", descending=True, after=tuple(query.order_key(last))
+    )
+    assert ids(session, next_page) == ["b"]
+
+    after = ResourceQuery(order_by="created_at").order_key(
+        session.get(ResourceEntity, "a")
+    )
+    assert ids(session, ResourceQuery(order_by="created_at", after=tuple(after))) == [
+        "b",
+        "c",
+    ]
+
+
+def test_unsupported_operators_are_rejected():
+    with pytest.raises(InvalidFilterError):
+        ResourceQuery(access_count=("!=", 1))
+    with pytest.raises(InvalidFilterError):
+        ResourceQuery(content_length=("~", 1))
+    with pytest.raises(InvalidFilterError):
+        ResourceQuery(after=("a", "b")).statement()
+
+
+@pytest.mark.parametrize(
+    "order_by, after",
+    [
+        ("id", (1,)),
+        ("id", (None,)),
+        ("access_count", ("1", "a")),
+        ("access_count", (True, "a")),
+        ("access_count", (1, 2)),
+        ("access_count", (1, ["a"])),
+        ("created_at", (1, "a")),
+        ("created_at", ("yesterday", "a")),
+        ("created_at", ("2025-01-01T00:00:00", None)),
+    ],
+)
+def test_malformed_cursor_positions_are_rejected(order_by, after):
+    with pytest.raises(InvalidFilterError):
+        ResourceQuery(order_by=order_by, after=after).statement()
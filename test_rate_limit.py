@@ -0,0 +1,100 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+from main import app
+from rate_limit import (
+    Limit,
+    MemoryBackend,
+    RateLimitBackend,
+    RateLimiter,
+    parse_limit,
+    rate_limiter,
+)
+
+
+class SharedBackend(RateLimitBackend):
+    """In-process stand-in for a backend shared by several replicas."""
+
+    def __init__(self):
+        self.store = MemoryBackend()
+        self.calls = 0
+
+    async def take(self, key: str, limit: Limit, now: float) -> float:
+        self.calls += 1
+        return self.store.take_now(key, limit, now)
+
+
+class FailingBackend(RateLimitBackend):
+    async def take(self, key: str, limit: Limit, now: float) -> float:
+        raise ConnectionError("backend unavailable")
+
+
+def test_token_bucket_bursts_then_refills():
+    backend = MemoryBackend()
+    limit = Limit(rate=2, burst=3)
+    assert [backend.take_now("a", limit, 0) for _ in range(3)] == [0, 0, 0]
+    assert backend.take_now("a", limit, 0) == pytest.approx(0.5)
+    assert backend.take_now("b", limit, 0) == 0
+    assert backend.take_now("a", limit, 0.5) == 0
+    assert backend.take_now("a", limit, 0.5) == pytest.approx(0.5)
+
+
+def test_memory_backend_drops_least_recently_used_buckets():
+    backend = MemoryBackend(max_keys=2)
+    limit = Limit(rate=1, burst=1)
+    backend.take_now("a", limit, 0)
+    backend.take_now("b", limit, 0)
+    backend.take_now("c", limit, 0)
+    assert len(backend) == 2
+    # "a" was dropped, so it starts again with a full bucket
+    assert backend.take_now("a", limit, 0) == 0
+
+
+def test_parse_limit():
+    assert parse_limit("5,10") == Limit(5.0, 10)
+    assert parse_limit("") is None
+    with pytest.raises(ValueError):
+        parse_limit("0,10")
+
+
+def test_replicas_share_a_backend():
+    backend = SharedBackend()
+    replicas = [
+        RateLimiter({"cai": Limit(1, 2)}, backend, clock=lambda: 0) for _ in range(2)
+    ]
+    scope = {
+        "type": "http",
+        "app": app,
+        "method": "GET",
+        "path": "/abc",
+        "headers": [],
+        "client": ("10.0.0.1", 1234),
+    }
+    waits = [asyncio.run(replica.check(scope)) for replica in replicas * 2]
+    assert waits[:2] == [0, 0]
+    assert all(wait > 0 for wait in waits[2:])
+    assert backend.calls == 4
+
+
+def test_requests_over_the_limit_get_429(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "backend", MemoryBackend())
+    monkeypatch.setitem(rate_limiter.limits, "cai", Limit(rate=0.5, burst=2))
+    with TestClient(app) as client:
+        assert [client.get("/missing").status_code for _ in range(3)] == [
+            404,
+            404,
+            429,
+        ]
+        response = client.get("/missing")
+        assert response.headers["Retry-After"] == "2"
+        assert "X-Request-ID" in response.headers
+        # Other groups have their own buckets, API keys only with api-key
+        assert client.get("/admin/cache").status_code == 200
+        assert client.get("/missing", headers={"X-API-Key": "other"}).status_code == 429
+        monkeypatch.setattr(rate_limiter, "key", "api-key")
+        assert client.get("/missing", headers={"X-API-Key": "other"}).status_code == 404
+        # Docs and schema are never limited
+        assert client.get("/openapi.json").status_code == 200
+
+        monkeypatch.setattr(rate_limiter, "backend", FailingBackend())
+        assert client.get("/missing").status_code == 404
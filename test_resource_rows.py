@@ -0,0 +1,56 @@
+import datetime
+import sqlalchemy
+from sqlalchemy.orm import Session
+import content_store
+from models import Resource, Type
+from query_builder import ResourceQuery
+from resource_entity import Base, ResourceEntity
+from resource_rows import ResourceListResponse, dumps, ndjson, row_dict, select_rows
+
+
+def test_rows_encode_like_the_resource_model():
+    engine = sqlalchemy.create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    resources = [
+        Resource(id="link", content="https://example.com", type=Type.url),
+        Resource(
+            id="expiring",
+            content="https://example.com/soon",
+            type=Type.url,
+            expiration_time=datetime.datetime(2031, 10, 1, 12, 30, 0, 123456),
+            created_at=datetime.datetime(2025, 1, 1),
+        ),
+        Resource(id="text", content='short "quoted" é 😀', type=Type.text),
+        # Compressed by the storage codec
+        Resource(id="large", content="x" * 5000, type=Type.text, access_count=7),
+    ]
+    with Session(engine) as session:
+        for resource in resources:
+            session.add(ResourceEntity.from_model(resource))
+        content_store.acquire(
+            session.connection(),
+            [resource.content for resource in resources if resource.type == Type.text],
+        )
+        session.commit()
+
+        rows = (
+            session.connection()
+            .execute(ResourceQuery().statement(base=select_rows()))
+            .all()
+        )
+        models = [
+            entity.to_model() for entity in session.scalars(ResourceQuery().statement())
+        ]
+
+    assert [dumps(row_dict(row)) for row in rows] == [
+        model.model_dump_json().encode() for model in models
+    ]
+    assert ndjson(rows).splitlines() == [
+        model.model_dump_json().encode() for model in models
+    ]
+    response = ResourceListResponse(rows)
+    assert response.headers["content-type"] == "application/json"
+    assert (
+        response.body
+        == b"[" + b",".join(model.model_dump_json().encode() for model in models) + b"]"
+    )
@@ -1,8 +1,22 @@
+import asyncio
+import threading
+import time
+import pytest
 from unittest.mock import MagicMock
 from services import ResourceServices
 from models import Resource, Type
 import sqlite3
+import content_store
+import database
+from bulk_delete import delete_batch
 from database import DatabaseService
+from database_startup import engine
+from cache import ResourceCache
+from access_counter import AccessCounter
+from id_generator import IdGenerator, RandomIdGenerator
+from resource_entity import ContentBlobEntity, ResourceEntity
+from sqlalchemy import update
+from sqlalchemy.orm import Session
 from datetime import datetime, UTC
 from fastapi.responses import RedirectResponse
 
@@ -11,8 +25,15 @@ def test_dummy():
     assert True == True
 
 
+@pytest.fixture
 def db_service():
-    return MagicMock(spec=DatabaseService)
+    session = Session(engine, expire_on_commit=False)
+    service = DatabaseService(
+        session, ResourceCache(), AccessCounter(engine, flush_interval=0)
+    )
+    yield service
+    asyncio.run(service.delete_all_entries())
+    session.close()
 
 
 def test_resource_exists(db_service: DatabaseService):
@@ -26,16 +47,167 @@ def test_resource_exists(db_service: DatabaseService):
         type=Type.text,
         vanity_url="test-vanity",
     )
-    db_service.add_entry(test_resource)
+    asyncio.run(db_service.add_entry(test_resource))
 
     # Test existing id
-    assert db_service.resource_exists(id="test123") == True
+    assert asyncio.run(db_service.resource_exists(id="test123")) == True
     # Test non-existing id
-    assert db_service.resource_exists(id="nonexistent") == False
+    assert asyncio.run(db_service.resource_exists(id="nonexistent")) == False
     # Test existing vanity_url
-    assert db_service.resource_exists(vanity_url="test-vanity") == True
+    assert asyncio.run(db_service.resource_exists(vanity_url="test-vanity")) == True
     # Test non-existing vanity_url
-    assert db_service.resource_exists(vanity_url="no-vanity") == False
+    assert asyncio.run(db_service.resource_exists(vanity_url="no-vanity")) == False
+
+
+def test_id_taken(db_service: DatabaseService):
+    asyncio.run(
+        db_service.add_entry(
+            Resource(id="taken", content="x", type=Type.text, vanity_url="taken")
+        )
+    )
+
+    assert asyncio.run(db_service.id_taken("taken")) == True
+    assert asyncio.run(db_service.id_taken("free")) == False
+
+
+def test_duplicate_id_is_rejected_by_the_index(db_service: DatabaseService):
+    asyncio.run(db_service.add_entry(Resource(id="dup", content="x", type=Type.text)))
+
+    with pytest.raises(database.DuplicateKeyError):
+        asyncio.run(
+            db_service.add_entry(Resource(id="dup", content="y", type=Type.text))
+        )
+
+    # The failed insert is rolled back and the session stays usable
+    asyncio.run(db_service.add_entry(Resource(id="other", content="z", type=Type.text)))
+    assert asyncio.run(db_service.get_entry("dup")).content == "x"
+
+
+def test_create_resources_in_batches(db_service: DatabaseService):
+    service = ResourceServices(db_service, RandomIdGenerator())
+    items = [{"content": f"item {i}", "type": "text"} for i in range(5)]
+    items.append({"content": "named", "type": "text", "id": "named"})
+    items.append({"content": "again", "type": "text", "id": "named"})
+    results = asyncio.run(service.create_resources(items, batch_size=2))
+
+    assert [r.index for r in results] == list(range(7))
+    assert [r.status for r in results] == ["created"] * 6 + ["conflict"]
+    assert asyncio.run(db_service.taken_keys({r.id for r in results})) == {
+        r.id for r in results
+    }
+
+
+def test_generated_ids_are_distinct_within_a_batch(db_service: DatabaseService):
+    class RepeatingIdGenerator(IdGenerator):
+        ids = iter(["same", "same", "same", "named", "other", "same", "third"])
+
+        def next_id(self) -> str:
+            return next(self.ids)
+
+    service = ResourceServices(db_service, RepeatingIdGenerator())
+    items = [{"content": f"item {i}", "type": "text"} for i in range(3)]
+    items.append({"content": "named", "type": "text", "id": "named"})
+    results = asyncio.run(service.create_resources(items))
+
+    assert [r.status for r in results] == ["created"] * 4
+    assert [r.id for r in results] == ["same", "third", "other", "named"]
+
+
+def test_delete_all_waits_for_locked_rows(db_service: DatabaseService, monkeypatch):
+    asyncio.run(
+        db_service.add_entries(
+            [
+                Resource(id=f"purge-{i}", content="https://example.com", type=Type.url)
+                for i in range(5)
+            ]
+        )
+    )
+    locked = threading.Event()
+
+    def hold_lock():
+        with engine.begin() as connection:
+            connection.execute(
+                update(ResourceEntity)
+                .where(ResourceEntity.id == "purge-0")
+                .values(access_count=1)
+            )
+            locked.set()
+            time.sleep(0.3)
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    assert locked.wait(5)
+    # The first batch leaves a row out, as SKIP LOCKED would
+    calls = []
+
+    def short_first_batch(connection, where, batch_size, **kwargs):
+        calls.append(batch_size)
+        size = batch_size - 1 if len(calls) == 1 else batch_size
+        return delete_batch(connection, where, size, **kwargs)
+
+    monkeypatch.setattr(database, "delete_batch", short_first_batch)
+    asyncio.run(db_service.delete_all_entries(batch_size=2))
+    holder.join()
+    assert asyncio.run(db_service.taken_keys({f"purge-{i}" for i in range(5)})) == set()
+
+
+def blob_refcounts() -> dict[str, int]:
+    with Session(engine) as session:
+        return {
+            blob.content: blob.refcount for blob in session.query(ContentBlobEntity)
+        }
+
+
+def test_text_content_is_stored_once(db_service: DatabaseService):
+    for id in ("dup-a", "dup-b"):
+        asyncio.run(
+            db_service.add_entry(Resource(id=id, content="same", type=Type.text))
+        )
+    asyncio.run(
+        db_service.add_entries([Resource(id="dup-c", content="same", type=Type.text)])
+    )
+    assert blob_refcounts() == {"same": 3}
+
+    asyncio.run(db_service.update_entry("dup-a", "changed"))
+    assert blob_refcounts() == {"same": 2, "changed": 1}
+    assert asyncio.run(db_service.get_entry("dup-a")).content == "changed"
+
+    assert asyncio.run(db_service.delete_entry("dup-b")).content == "same"
+    asyncio.run(db_service.delete_entry("dup-a"))
+    assert blob_refcounts() == {"same": 1}
+
+    asyncio.run(db_service.delete_all_entries())
+    assert blob_refcounts() == {}
+
+
+def test_blobs_are_built_off_the_event_loop(db_service: DatabaseService, monkeypatch):
+    threads = []
+    blob_row = content_store._blob_row
+
+    def recorded_blob_row(*args):
+        threads.append(threading.current_thread())
+        return blob_row(*args)
+
+    monkeypatch.setattr(content_store, "_blob_row", recorded_blob_row)
+    asyncio.run(
+        db_service.add_entry(Resource(id="blob-a", content="same", type=Type.text))
+    )
+    # blob-a is taken: only the new row references the blob
+    inserted = asyncio.run(
+        db_service.add_entries(
+            [
+                Resource(id="blob-a", content="same", type=Type.text),
+                Resource(id="blob-b", content="same", type=Type.text),
+                Resource(id="blob-c", content="other", type=Type.text),
+            ]
+        )
+    )
+    asyncio.run(db_service.update_entry("blob-c", "changed"))
+
+    assert inserted == {"blob-b", "blob-c"}
+    assert blob_refcounts() == {"same": 2, "changed": 1}
+    assert len(threads) == 4
+    assert threading.main_thread() not in threads
 
 
 # def global_setup():
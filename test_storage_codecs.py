@@ -0,0 +1,40 @@
+import json
+import pytest
+from storage_codecs import CODECS, StorageCodec, decode_payload, json_payload
+
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_codecs_round_trip(name: str):
+    content = 'line "one"\nline two ünïcode\n' * 100
+    codec, data = StorageCodec(name, threshold=10).encode(content)
+    assert codec == name
+    assert len(data) < len(content)
+    assert decode_payload(codec, data) == content
+
+
+def test_small_or_incompressible_content_is_stored_as_text():
+    assert StorageCodec("gzip", threshold=1024).encode("short") == (None, None)
+    assert StorageCodec("identity").encode("x" * 10000) == (None, None)
+    random_text = bytes(range(256)).hex()
+    assert StorageCodec("lzma", threshold=10).encode(random_text[:40]) == (
+        None,
+        None,
+    )
+    with pytest.raises(ValueError):
+        StorageCodec("brotli")
+
+
+def test_payload_is_the_json_response_body():
+    assert json.loads(json_payload('a "quoted"\n')) == 'a "quoted"\n'
+
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_encode_chunks_matches_encode(name: str):
+    content = "streamed line\n" * 500
+    payload = json_payload(content)
+    chunks = [payload[i : i + 1000] for i in range(0, len(payload), 1000)]
+    codec, data = StorageCodec(name, threshold=10).encode_chunks(
+        len(content), len(payload), chunks
+    )
+    assert codec == name
+    assert decode_payload(codec, data) == content